@@ -0,0 +1,275 @@
+import logging as log
+import os
+import ROOT
+
+# ------------------------------------------------------------------------------
+
+""" Generators for synthetic trees with the same branch layout as the trees
+    written by the Marlin processors in source/ (WWObservables,
+    SingleWObservables and DifermionObservables, each with the HeaderInfo
+    branches), so that the production can be run without the real samples.
+    The distributions are only roughly physical: they fill all bins and all
+    selections but carry no physics meaning.
+"""
+
+# ------------------------------------------------------------------------------
+
+cpp_generators = r'''
+#include "TFile.h"
+#include "TMath.h"
+#include "TRandom3.h"
+#include "TTree.h"
+#include <cmath>
+#include <string>
+#include <vector>
+
+namespace PrEWBench {
+
+// Branches written by Utils::HeaderInfo
+struct Header {
+  int process_ID = 0;
+  double energy = 250.0;
+  double weight = 1.0;
+  int eM_chirality = 0;
+  int eP_chirality = 0;
+  double cross_section = 0.0;
+  double cross_section_err = 0.0;
+
+  void connect(TTree &tree) {
+    tree.Branch("process_ID", &process_ID, "process_ID/I");
+    tree.Branch("energy", &energy, "energy/D");
+    tree.Branch("weight", &weight, "weight/D");
+    tree.Branch("eM_chirality", &eM_chirality, "eM_chirality/I");
+    tree.Branch("eP_chirality", &eP_chirality, "eP_chirality/I");
+    tree.Branch("cross_section", &cross_section, "cross_section/D");
+    tree.Branch("cross_section_err", &cross_section_err,
+                "cross_section_err/D");
+  }
+};
+
+// Angle with a linear asymmetry a in [-1,1] (accept-reject)
+double costh(TRandom3 &rng, double a) {
+  while (true) {
+    double x = rng.Uniform(-1.0, 1.0);
+    if (rng.Uniform(0.0, 1.0 + std::abs(a)) < 1.0 + a * x) { return x; }
+  }
+}
+
+void write_WW(const char *path, long long n_events, int eM, int eP,
+              double cross_section, int n_weights, unsigned int seed) {
+  TFile file(path, "RECREATE");
+  auto tree = new TTree("WWObservables", "WWObservables"); // Owned by the file
+  Header header;
+  header.process_ID = 250106;
+  header.eM_chirality = eM;
+  header.eP_chirality = eP;
+  header.cross_section = cross_section;
+  header.cross_section_err = 0.001 * cross_section;
+  header.connect(*tree);
+
+  bool decay_to_mu = false, decay_to_tau = false;
+  int l_charge = 0;
+  double phi_l_star = 0, costh_l_star = 0, costh_Wminus_star = 0, costh_l = 0;
+  tree->Branch("decay_to_mu", &decay_to_mu, "decay_to_mu/O");
+  tree->Branch("decay_to_tau", &decay_to_tau, "decay_to_tau/O");
+  tree->Branch("l_charge", &l_charge, "l_charge/I");
+  tree->Branch("phi_l_star", &phi_l_star, "phi_l_star/D");
+  tree->Branch("costh_l_star", &costh_l_star, "costh_l_star/D");
+  tree->Branch("costh_Wminus_star", &costh_Wminus_star, "costh_Wminus_star/D");
+  tree->Branch("costh_l", &costh_l, "costh_l/D");
+
+  // Same leaf list as the WW processor for the rescan weights
+  std::vector<double> weights(n_weights, 1.0);
+  if (n_weights > 0) {
+    std::string leaves{""};
+    for (int p = 0; p < n_weights; p++) {
+      leaves += "weight" + std::to_string(p) + "/D:";
+    }
+    leaves.pop_back();
+    tree->Branch("rescan_weights", &weights[0], leaves.c_str());
+  }
+
+  TRandom3 rng(seed);
+  for (long long i = 0; i < n_events; i++) {
+    double decay = rng.Uniform();
+    decay_to_mu = decay < 0.35;
+    decay_to_tau = !decay_to_mu && decay < 0.7;
+    l_charge = rng.Uniform() < 0.5 ? -1 : 1;
+    costh_Wminus_star = costh(rng, eM < 0 ? 0.8 : 0.2);
+    costh_l_star = costh(rng, 0.3 * l_charge);
+    phi_l_star = rng.Uniform(-TMath::Pi(), TMath::Pi());
+    costh_l = TMath::Max(-1.0, TMath::Min(1.0,
+      costh_Wminus_star * l_charge * -0.7 + rng.Gaus(0.0, 0.3)));
+    for (int p = 0; p < n_weights; p++) {
+      weights[p] = 1.0 + 0.01 * (p % 3 + 1) * (p < n_weights / 2 ? 1 : -1)
+                         * (costh_Wminus_star + 0.5 * costh_l_star);
+    }
+    tree->Fill();
+  }
+  tree->Write();
+  file.Close();
+}
+
+void write_SingleW(const char *path, long long n_events, int eM, int eP,
+                   double cross_section, unsigned int seed) {
+  TFile file(path, "RECREATE");
+  auto tree = new TTree("SingleWObservables", "SingleWObservables"); // Owned by the file
+  Header header;
+  header.process_ID = 250108;
+  header.eM_chirality = eM;
+  header.eP_chirality = eP;
+  header.cross_section = cross_section;
+  header.cross_section_err = 0.001 * cross_section;
+  header.connect(*tree);
+
+  int e_charge = 0;
+  double costh_e_star = 0, costh_Whad_star = 0, m_enu = 0;
+  tree->Branch("e_charge", &e_charge, "e_charge/I");
+  tree->Branch("costh_e_star", &costh_e_star, "costh_e_star/D");
+  tree->Branch("costh_Whad_star", &costh_Whad_star, "costh_Whad_star/D");
+  tree->Branch("m_enu", &m_enu, "m_enu/D");
+
+  TRandom3 rng(seed);
+  for (long long i = 0; i < n_events; i++) {
+    // Same-sign chiralities only produce one of the charges
+    if (eM == eP) {
+      e_charge = eM < 0 ? 1 : -1;
+    } else {
+      e_charge = rng.Uniform() < 0.5 ? -1 : 1;
+    }
+    costh_e_star = costh(rng, 0.4 * e_charge);
+    costh_Whad_star = costh(rng, -0.5);
+    m_enu = rng.Uniform() < 0.6 ? rng.BreitWigner(80.4, 2.1)
+                                : rng.Uniform(0.0, 240.0);
+    tree->Fill();
+  }
+  tree->Write();
+  file.Close();
+}
+
+void write_Difermion(const char *path, long long n_events, int eM, int eP,
+                     double cross_section, bool hadronic, unsigned int seed) {
+  TFile file(path, "RECREATE");
+  auto tree = new TTree("DifermionObservables", "DifermionObservables"); // Owned by the file
+  Header header;
+  header.process_ID = hadronic ? 250101 : 250103;
+  header.eM_chirality = eM;
+  header.eP_chirality = eP;
+  header.cross_section = cross_section;
+  header.cross_section_err = 0.001 * cross_section;
+  header.connect(*tree);
+
+  int f_pdg = 0;
+  double costh_f_star = 0, costh_f_star_true = 0, m_ff = 0, pz_ff = 0;
+  double costh_f = 0, costh_fbar = 0;
+  tree->Branch("f_pdg", &f_pdg, "f_pdg/I");
+  tree->Branch("costh_f_star", &costh_f_star, "costh_f_star/D");
+  tree->Branch("costh_f_star_true", &costh_f_star_true, "costh_f_star_true/D");
+  tree->Branch("m_ff", &m_ff, "m_ff/D");
+  tree->Branch("pz_ff", &pz_ff, "pz_ff/D");
+  tree->Branch("costh_f", &costh_f, "costh_f/D");
+  tree->Branch("costh_fbar", &costh_fbar, "costh_fbar/D");
+
+  const int hadronic_pdgs[] = {1, 2, 3, 4, 5};
+  const int leptonic_pdgs[] = {13, 15};
+  TRandom3 rng(seed);
+  for (long long i = 0; i < n_events; i++) {
+    f_pdg = hadronic ? hadronic_pdgs[rng.Integer(5)]
+                     : leptonic_pdgs[rng.Integer(2)];
+    // Return-to-Z (boosted along the beam) or high-Q2 events
+    bool return_to_Z = rng.Uniform() < 0.5;
+    m_ff = return_to_Z ? rng.BreitWigner(91.19, 2.5) : rng.Uniform(150, 250);
+    pz_ff = return_to_Z ? (rng.Uniform() < 0.5 ? -1 : 1) * rng.Uniform(90, 120)
+                        : rng.Gaus(0.0, 5.0);
+    costh_f_star_true = costh(rng, eM < 0 ? 0.5 : -0.3);
+    costh_f_star = TMath::Max(-1.0, TMath::Min(1.0,
+      costh_f_star_true + rng.Gaus(0.0, 0.02)));
+    costh_f = TMath::Max(-1.0, TMath::Min(1.0,
+      costh_f_star + (return_to_Z ? 0.3 * TMath::Sign(1.0, pz_ff) : 0.0)));
+    costh_fbar = TMath::Max(-1.0, TMath::Min(1.0,
+      -costh_f_star + (return_to_Z ? 0.3 * TMath::Sign(1.0, pz_ff) : 0.0)));
+    tree->Fill();
+  }
+  tree->Write();
+  file.Close();
+}
+
+} // namespace PrEWBench
+'''
+
+declared = False
+
+def declare_generators():
+  """ Declare the C++ generators (only once per process).
+  """
+  global declared
+  if not declared:
+    ROOT.gInterpreter.Declare(cpp_generators)
+    declared = True
+
+# ------------------------------------------------------------------------------
+
+# Chirality names (as used in the file names) -> (e- chirality, e+ chirality)
+chiralities = { "eL_pR": (-1, 1), "eR_pL": (1, -1),
+                "eL_pL": (-1, -1), "eR_pR": (1, 1) }
+
+# Tree name and (roughly realistic) cross sections of each synthetic process
+processes = {
+  "4f_WW_sl": ("WWObservables",
+               { "eL_pR": 1.4e4, "eR_pL": 1.4e2 }),
+  "4f_sW_sl": ("SingleWObservables",
+               { "eL_pR": 5.4e3, "eR_pL": 1.2e2,
+                 "eL_pL": 2.5e2, "eR_pR": 2.5e2 }),
+  "2f_Z_l":   ("DifermionObservables",
+               { "eL_pR": 1.5e4, "eR_pL": 1.2e4 }),
+  "2f_Z_h":   ("DifermionObservables",
+               { "eL_pR": 7.8e4, "eR_pL": 4.6e4 }),
+}
+
+def tree_name(process):
+  """ Name of the tree the synthetic process is written to.
+  """
+  return processes[process][0]
+
+def file_path(dir, process, chirality, n_events, seed, n_weights):
+  """ Path of the synthetic file, encodes all generator settings.
+  """
+  weights = "_{}weights".format(n_weights) if process == "4f_WW_sl" else ""
+  return "{}/{}_{}_{}evts_seed{}{}.root".format(dir, process, chirality,
+                                               n_events, seed, weights)
+
+def generate(dir, process, chirality, n_events, seed=1, n_weights=18):
+  """ Write a synthetic tree of the process (see processes) for the chirality
+      unless it already exists, returns the file path.
+      n_weights is the number of rescan weights (only used for WW), it has to
+      be at least the number of TGC deviation points.
+  """
+  if process not in processes:
+    raise ValueError("Unknown synthetic process: {}".format(process))
+  path = file_path(dir, process, chirality, n_events, seed, n_weights)
+  if os.path.isfile(path):
+    return path
+
+  declare_generators()
+  os.makedirs(dir, exist_ok=True)
+  eM, eP = chiralities[chirality]
+  cross_section = processes[process][1][chirality]
+  log.info("Generating {} events of {} {}".format(n_events, process,
+                                                   chirality))
+
+  # Written to a temporary file first so that interrupted runs don't leave
+  # incomplete files behind
+  tmp_path = "{}.tmp{}.root".format(path[:-len(".root")], os.getpid())
+  if process == "4f_WW_sl":
+    ROOT.PrEWBench.write_WW(tmp_path, n_events, eM, eP, cross_section,
+                            n_weights, seed)
+  elif process == "4f_sW_sl":
+    ROOT.PrEWBench.write_SingleW(tmp_path, n_events, eM, eP, cross_section,
+                                 seed)
+  else:
+    ROOT.PrEWBench.write_Difermion(tmp_path, n_events, eM, eP, cross_section,
+                                   process == "2f_Z_h", seed)
+  os.replace(tmp_path, path)
+  return path
+
+# ------------------------------------------------------------------------------
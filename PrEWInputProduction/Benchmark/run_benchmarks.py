@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+# ------------------------------------------------------------------------------
+
+""" Benchmark of the PrEW input production on synthetic trees (see
+    SyntheticTrees), e.g.:
+      prew-benchmark --n-events 1000000 --save-baseline baseline.json
+      prew-benchmark --n-events 1000000 --baseline baseline.json
+    Each case is timed end-to-end and per stage (see Core/Profiling). When
+    compared to a baseline (measured with the same settings) the script fails
+    if any case got slower than the tolerance allows.
+"""
+
+# ------------------------------------------------------------------------------
+
+import argparse
+import json
+import logging as log
+import math
+import os
+import platform
+import shutil
+import sys
+import time
+
+import ROOT
+
+# Local modules
+from PrEWInputProduction.Benchmark import SyntheticTrees as ST
+from PrEWInputProduction.Core import CreatePrEWInput as CPI
+from PrEWInputProduction.Core import Profiling as PF
+from PrEWInputProduction.IO import InputHelpers as IH
+from PrEWInputProduction.IO import OutputHelpers as OH
+from PrEWInputProduction.IO import TGCConfigReader as ITCR
+from PrEWInputProduction.Physics import PhysicsOptions as PPO
+from PrEWInputProduction.ROOTHelp import DistrHelpers as DH
+from PrEWInputProduction.Systematics import SystematicsOptions as SSO
+
+# Location of the package, used to find the configuration files
+base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# ------------------------------------------------------------------------------
+# Benchmark cases, mirroring the production scripts
+
+config_dir = os.path.normpath(os.path.join(base_dir, "../scripts/config"))
+
+coords_1D = [ DH.Coordinate("costh_f_star", 20, -1.0, 1.0) ]
+coords_3D = [ DH.Coordinate("costh_Wminus_star", 20, -1.0, 1.0),
+              DH.Coordinate("costh_l_star", 10, -1.0, 1.0),
+              DH.Coordinate("phi_l_star", 10, -math.pi, math.pi) ]
+coords_SingleW = [ DH.Coordinate("costh_Whad_star", 20, -1.0, 1.0),
+                   DH.Coordinate("costh_e_star", 10, -1.0, 1.0),
+                   DH.Coordinate("m_enu", 20, 0.0, 240.0) ]
+
+mass_cuts = { "81to101": "(m_ff > 81) && (m_ff < 101)",
+              "180to275": "(m_ff > 180) && (m_ff < 275)" }
+WW_cuts = { "mu{}".format(charge): "(decay_to_mu == 1) && (l_charge == {})"
+            .format(value) for charge, value in [("minus", -1), ("plus", +1)] }
+
+def TGC_options():
+  return PPO.PhysicsOptions(
+    use_TGCs=True,
+    TGC_config_path="{}/tgc.config".format(config_dir),
+    TGC_points_path="{}/tgc_dev_points_g1z_ka_la.config".format(config_dir),
+    TGC_weight_base="rescan_weights.weight")
+
+# name -> (process, chiralities, coords, {distr_name: cuts}, syst, phys)
+cases = {
+  "Difermion_1D": (
+    "2f_Z_l", ["eL_pR", "eR_pL"], coords_1D,
+    { "2f_mu_{}".format(mass): "(f_pdg == 13) && {}".format(cut)
+      for mass, cut in mass_cuts.items() },
+    SSO.SystematicsOptions(), PPO.PhysicsOptions()),
+  "Difermion_1D_muacc": (
+    "2f_Z_l", ["eL_pR", "eR_pL"], coords_1D,
+    { "2f_mu_{}".format(mass): "(f_pdg == 13) && {}".format(cut)
+      for mass, cut in mass_cuts.items() },
+    SSO.SystematicsOptions(use_muon_acc=True,
+                           costh_branch=["costh_f", "costh_fbar"]),
+    PPO.PhysicsOptions()),
+  "DifermionHadronic_1D": (
+    "2f_Z_h", ["eL_pR", "eR_pL"], coords_1D,
+    { "2f_{}_{}".format(fs, mass): "{} && {}".format(fs_cut, cut)
+      for fs, fs_cut in [("uds", "(f_pdg < 4)"), ("c", "(f_pdg == 4)"),
+                         ("b", "(f_pdg == 5)")]
+      for mass, cut in mass_cuts.items() },
+    SSO.SystematicsOptions(), PPO.PhysicsOptions()),
+  "SingleW_3D": (
+    "4f_sW_sl", ["eL_pR", "eR_pL", "eL_pL", "eR_pR"], coords_SingleW,
+    { "SingleW_eminus": "(e_charge == -1)",
+      "SingleW_eplus": "(e_charge == +1)" },
+    SSO.SystematicsOptions(), PPO.PhysicsOptions()),
+  "WW_3D": (
+    "4f_WW_sl", ["eL_pR", "eR_pL"], coords_3D, WW_cuts,
+    SSO.SystematicsOptions(), PPO.PhysicsOptions()),
+  "WW_3D_muacc": (
+    "4f_WW_sl", ["eL_pR", "eR_pL"], coords_3D, WW_cuts,
+    SSO.SystematicsOptions(use_muon_acc=True, costh_branch="costh_l"),
+    PPO.PhysicsOptions()),
+  "WW_3D_TGC": (
+    "4f_WW_sl", ["eL_pR", "eR_pL"], coords_3D, WW_cuts,
+    SSO.SystematicsOptions(), TGC_options()),
+  "WW_3D_muacc_TGC": (
+    "4f_WW_sl", ["eL_pR", "eR_pL"], coords_3D, WW_cuts,
+    SSO.SystematicsOptions(use_muon_acc=True, costh_branch="costh_l"),
+    TGC_options()),
+}
+
+# ------------------------------------------------------------------------------
+
+def run_case(name, work_dir, n_events, engine, create_plots):
+  """ Produce all distributions of the case from freshly written output
+      directories and return its profile report.
+  """
+  process, chiralities, coords, distrs, syst, phys = cases[name]
+  input_dir = "{}/inputs".format(work_dir)
+  output_dir = "{}/output/{}".format(work_dir, name)
+  shutil.rmtree(output_dir, ignore_errors=True)
+
+  # One rescan weight per TGC deviation point
+  generate_args = {}
+  if phys.use_TGCs:
+    generate_args["n_weights"] = len(ITCR.TGCConfigReader(
+      phys.TGC_config_path, phys.TGC_points_path).dev_points)
+
+  inputs = [ IH.InputInfo(ST.generate(input_dir, process, chirality, n_events,
+                                      **generate_args),
+                          ST.tree_name(process), 250)
+             for chirality in chiralities ]
+
+  profiler = PF.Profiler()
+  batch = CPI.PrEWInputBatch(engine, force=True, profiler=profiler)
+  for input in inputs:
+    for distr_name, cuts in distrs.items():
+      batch.add(input, OH.OutputInfo(output_dir, distr_name, create_plots),
+                coords, cuts, syst, phys)
+  batch.run()
+  return profiler.report()
+
+def compare(results, baseline, tolerance):
+  """ Print the comparison of the wall times to the baseline, returns the
+      names of the cases that are slower than the tolerance allows.
+  """
+  regressions = []
+  print("Comparison to baseline (tolerance {:.0f}%):".format(tolerance*100))
+  for name, result in results.items():
+    if name not in baseline["cases"]:
+      print("\t{:24s} no baseline".format(name))
+      continue
+    reference = baseline["cases"][name]["wall_time"]
+    change = result["wall_time"] / reference - 1.0
+    regressed = change > tolerance
+    print("\t{:24s} {:8.2f}s vs {:8.2f}s ({:+.1f}%){}".format(
+      name, result["wall_time"], reference, change*100,
+      "  REGRESSION" if regressed else ""))
+    if regressed:
+      regressions.append(name)
+  return regressions
+
+# ------------------------------------------------------------------------------
+
+def parse_args():
+  parser = argparse.ArgumentParser(
+    description="Benchmark the PrEW input production on synthetic trees.")
+  parser.add_argument("--cases", nargs="+", choices=sorted(cases),
+                      default=sorted(cases), help="Cases to run (default: all)")
+  parser.add_argument("--n-events", type=int, default=100000,
+                      help="Events per synthetic input file")
+  parser.add_argument("--engine", choices=["rdf", "numpy"], default="rdf",
+                      help="Histogram filling engine")
+  parser.add_argument("--n-threads", type=int, default=1,
+                      help="RDataFrame threads (implicit multi-threading)")
+  parser.add_argument("--plots", action="store_true",
+                      help="Also create the plots")
+  parser.add_argument("--work-dir", default="/tmp/prew_benchmark",
+                      help="Directory for the synthetic inputs and output")
+  parser.add_argument("--baseline", help="Compare to this baseline file")
+  parser.add_argument("--save-baseline", help="Save the results as baseline")
+  parser.add_argument("--tolerance", type=float, default=0.2,
+                      help="Allowed relative slowdown (default: 0.2)")
+  parser.add_argument("--report", help="Write the full JSON report here")
+  return parser.parse_args()
+
+def main():
+  """ Run the benchmark cases and compare them to / save them as baseline.
+  """
+  args = parse_args()
+  log.basicConfig(level=log.WARNING)
+  ROOT.gROOT.SetBatch(True) # Don't show graphics at runtime
+  if args.n_threads > 1:
+    ROOT.EnableImplicitMT(args.n_threads)
+
+  settings = { "n_events": args.n_events, "engine": args.engine,
+               "n_threads": args.n_threads, "plots": args.plots,
+               "host": platform.node(), "root": ROOT.gROOT.GetVersion() }
+
+  results = {}
+  for name in args.cases:
+    print("Running {} ...".format(name))
+    start = time.perf_counter()
+    report = run_case(name, args.work_dir, args.n_events, args.engine,
+                      args.plots)
+    report["wall_time"] = time.perf_counter() - start
+    results[name] = report
+    print("\t{:.2f}s, {:.3g} events/s".format(
+      report["wall_time"], report.get("events_per_second", float("nan"))))
+
+  report = { "settings": settings, "cases": results }
+  if args.report is not None:
+    PF.write_json(args.report, report)
+  if args.save_baseline is not None:
+    PF.write_json(args.save_baseline, report)
+
+  if args.baseline is not None:
+    with open(args.baseline) as file:
+      baseline = json.load(file)
+    for key in ["n_events", "engine", "n_threads", "plots", "host"]:
+      if baseline["settings"].get(key) != settings[key]:
+        log.warning("Baseline was measured with {} = {} (now {}).".format(
+          key, baseline["settings"].get(key), settings[key]))
+    regressions = compare(results, baseline, args.tolerance)
+    if len(regressions) > 0:
+      sys.exit("Performance regression in: {}".format(", ".join(regressions)))
+
+# ------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+  main()
@@ -6,138 +6,583 @@
 # ------------------------------------------------------------------------------
 
 import logging as log
+import numpy as np
 import ROOT
 import pandas as pd
-import sys
+import time
 
 # Local modules
-import Conventions as Conv
-sys.path.append("../IO")
-import CSVMetadata as CSVM
-sys.path.append("../Physics")
-import PhysicsOptions as PPO
-import TGCs as PT
-sys.path.append("../ROOTHelp")
-import DistrHelpers as DH
-import DistrPlotting as DP
-sys.path.append("../Systematics")
-import MuonAcceptance as SMA
-import SystematicsOptions as SSO
-sys.path.append("../Validation")
-import MuonAccValidation as MAV
+from PrEWInputProduction.Core import Conventions as Conv
+from PrEWInputProduction.Core import Profiling as PF
+from PrEWInputProduction.Core import SamplingOptions as SO
+from PrEWInputProduction.IO import BinaryOutput as BO
+from PrEWInputProduction.IO import CSVMetadata as CSVM
+from PrEWInputProduction.IO import ProductionJournal as PJ
+from PrEWInputProduction.Physics import PhysicsOptions as PPO
+from PrEWInputProduction.Physics import TGCs as PT
+from PrEWInputProduction.ROOTHelp import CachedResults as CR
+from PrEWInputProduction.ROOTHelp import ColumnarFrame as CF
+from PrEWInputProduction.ROOTHelp import DistrHelpers as DH
+from PrEWInputProduction.ROOTHelp import DistrPlotting as DP
+from PrEWInputProduction.ROOTHelp import RDFActions as RA
+from PrEWInputProduction.ROOTHelp import RDFBooking as RB
+from PrEWInputProduction.Systematics import MuonAcceptance as SMA
+from PrEWInputProduction.Systematics import SystematicsOptions as SSO
+from PrEWInputProduction.Validation import MuonAccValidation as MAV
 
 # ------------------------------------------------------------------------------
 
-def create_PrEW_input(input, output, coords, cuts, 
-                      syst=SSO.SystematicsOptions(), phys=PPO.PhysicsOptions()):
-  """ Create the input CSV distributions for PrEW by setting up an RDataFrame
-      and extraction all relevant observables and coefficients and performing 
-      the requested cuts.
+class DistrBooking:
+  """ All RDataFrame instructions that are booked for a single distribution,
+      together with the post-processing that turns their results into the PrEW
+      input.
   """
+
+  def __init__(self, rdf, output, coords, cuts, syst, phys):
+    """ Book all instructions for the distribution on the given RDataFrame.
+        Nothing is triggered here, the event loop is run by the caller.
+        Without RDataFrame (rdf=None) nothing is booked and the results have
+        to be set from the cache (see set_result_arrays).
+    """
+    self.output = output
+    self.coords = coords
+
+    if rdf is None:
+      rdf_after_cuts = None
+      self.n_after_cuts_ptr = None
+      self.hist_ptr = None
+    else:
+      log.debug("Setting up RDataFrame instructions for {}".format(
+          output.distr_name))
+
+      # Apply generator level cuts
+      rdf_after_cuts = rdf.Filter(cuts)
+      self.n_after_cuts_ptr = rdf_after_cuts.Count()
+
+      # Create a RDataFrame histogram result pointer
+      self.hist_ptr = DH.get_hist_ptr(rdf_after_cuts, output.distr_name, 
+                                      coords)
+
+    # Prepare the muon acceptance box if requested
+    self.muon_acc = None
+    self.muon_acc_validator = None
+    if syst.use_muon_acc:
+      muon_acc_cut = SMA.default_acc_cut()
+      delta = SMA.default_delta()
+      
+      if syst.muon_acc_mode not in ["stacked", "scan"]:
+        raise ValueError("Unknown muon acceptance mode: {}".format(
+          syst.muon_acc_mode))
+
+      # In scan mode all cut variations are evaluated from one shared scan
+      muon_acc_scan = None
+      if syst.muon_acc_mode == "scan" and rdf_after_cuts is not None:
+        muon_acc_scan = SMA.MuonAccScan(rdf_after_cuts, coords,
+                                        syst.costh_branch)
+
+      self.muon_acc = SMA.MuonAccParametrisation(
+        rdf_after_cuts, muon_acc_cut, delta, syst.costh_branch,
+        output.distr_name, coords, muon_acc_scan)
+      self.muon_acc_validator = MAV.MuonAccValidator(
+        rdf_after_cuts, muon_acc_cut, delta, syst.costh_branch,
+        output.distr_name, coords, muon_acc_scan)
+
+    # Prepare TGCs if requested
+    self.tgc_par = None
+    if phys.use_TGCs:
+      self.tgc_par = PT.TGCParametrisation(
+        rdf_after_cuts, coords, phys.TGC_config_path, phys.TGC_points_path,
+        output.distr_name, phys.TGC_weight_base, phys.TGC_weight_array)
+
+  def result_slots(self):
+    """ All result pointers that are used in the post-processing, as 
+        name -> (owner, attribute, binned).
+    """
+    slots = { "n_after_cuts": (self, "n_after_cuts_ptr", False),
+              "hist": (self, "hist_ptr", False) }
+    if self.muon_acc is not None:
+      slots["muon_acc_nocut"] = (self.muon_acc, "histptr_nocut", False)
+      slots["muon_acc_cuts"] = (self.muon_acc, "cutptr", True)
+      slots["muon_acc_val_nocut"] = (self.muon_acc_validator, "histptr_nocut",
+                                     False)
+      slots["muon_acc_val_cuts"] = (self.muon_acc_validator, "cutptr", True)
+    if self.tgc_par is not None:
+      slots["tgc_SM"] = (self.tgc_par, "histptr_SM", False)
+      slots["tgc_dev"] = (self.tgc_par, "histptr_dev", True)
+    return slots
+
+  def get_result_arrays(self):
+    """ Arrays of all (triggered) results, binned variation results are stored
+        for the bins used in the output.
+    """
+    bins = DH.get_filled_bins(self.hist_ptr.GetValue())
+    if bins is None:
+      bins = np.arange(RA.n_bins_total(self.coords))
+    arrays = {}
+    for name, (owner, attribute, binned) in self.result_slots().items():
+      arrays.update(CR.to_arrays(name, getattr(owner, attribute), bins, binned))
+    return arrays
+
+  def set_result_arrays(self, arrays):
+    """ Replace all result pointers by the stored results.
+    """
+    for name, (owner, attribute, binned) in self.result_slots().items():
+      setattr(owner, attribute, CR.from_arrays(name, arrays))
+
+  def finish(self, input, n_total, cross_section, eM_chi, eP_chi,
+             profiler=None, sampling_fraction=None):
+    """ Use the (already triggered) results to produce the PrEW input.
+        Needs the metadata of the input file which is shared between all
+        distributions booked on it.
+        If only a fraction of the input was sampled, n_total is the number of
+        sampled events and the fraction is written to the metadata.
+        The time spent in each step is added to the profiler (if given).
+        All files are first written into a staging directory of this producer
+        and moved into the output directory once the distribution is
+        complete, so parallel producers never see partial outputs.
+        Returns the paths of the written data files.
+    """
+    final_output = self.output
+    output = final_output.staged()
+    profiler = PF.Profiler() if profiler is None else profiler
+
+    n_after_cuts = self.n_after_cuts_ptr.GetValue()
+    
+    # Result may be shared with other bookings (e.g. the muon acceptance), so
+    # normalise a copy
+    hist = self.hist_ptr.GetValue().Clone()
+
+    print("For distr {}:\n\tBefore cuts: {} , after cuts: {} ({}%)".format(
+        output.distr_name, n_total, n_after_cuts, n_after_cuts/n_total*100.0))
+    if sampling_fraction is not None:
+      print("\tSampled {:.3g}% of the input events!".format(
+        sampling_fraction*100.0))
+
+    # Base for output file name
+    output_base_name = Conv.csv_file_name(output.distr_name, input.energy,
+                                        eM_chi, eP_chi)
+    output_base = "{}/{}".format(output.dir, output_base_name)
+
+    # Correctly normalize the histogram
+    hist.Scale(cross_section/n_total)
+
+    # Plot the histogram if requested
+    if (output.create_plots):
+      log.debug("Create histogram plot.")
+      with profiler.stage("plotting"):
+        DP.draw_hist(hist, output, output_base_name)
+        if self.muon_acc is not None:
+          self.muon_acc.plot_cut_result(output, output_base_name)
+
+    # ----------------------- Producing PrEW input -----------------------------
+    log.debug("Start producing PrEW input.")
+
+    # Sparse (>3D) histograms only provide the filled bins, all other results 
+    # are extracted for the same bins
+    bins = DH.get_filled_bins(hist)
+
+    # Extract bin centers and cross sections from the histogram
+    with profiler.stage("bin_access"):
+      data = DH.get_data(hist, self.coords, bins)
+
+    # Try extracting the differential coefficients for the muon acceptance box.
+    if self.muon_acc is not None:
+      with profiler.stage("muon_acc_coefs"):
+        data = self.muon_acc.add_coefs_to_data(data, bins)
+
+    # Try extracting the differential TGC coefficients
+    if self.tgc_par:
+      with profiler.stage("tgc_coefs"):
+        data = self.tgc_par.add_coefs_to_data(data, bins)
+
+    # Create a pandas dataframe
+    df = pd.DataFrame(data)
+
+    # Metadata for the beginning of the file
+    metadata = CSVM.CSVMetadata()
+    metadata["Name"] = output.distr_name
+    metadata["Energy"] = input.energy
+    metadata["e-Chirality"] = eM_chi
+    metadata["e+Chirality"] = eP_chi
+    if sampling_fraction is not None:
+      metadata["SamplingFraction"] = sampling_fraction
+
+    written_files = []
+    if self.muon_acc is not None:
+      self.muon_acc.add_coefs_to_metadata(metadata)
+      with profiler.stage("muon_acc_validation"):
+        written_files += self.muon_acc_validator.write_validation_data(
+          data, output, output_base_name, metadata, n_total, cross_section, 
+          bins)
+
+    # Write the metadata and the dataframe in the requested formats
+    with profiler.stage("output_writing"):
+      written_files += BO.write_table(output_base, df, metadata, 
+                                      output.formats, output.float_dtype)
+
+    # Move the complete outputs into place
+    written_files = final_output.commit_staged(output, written_files)
+
+    log.debug("Done with distribution.")
+    return written_files
+
+# ------------------------------------------------------------------------------
+
+def get_cache_key(input, coords, cuts, syst, phys, sampling=None):
+  """ Key of the filled histograms of a distribution in the HistogramCache: 
+      the fingerprint of everything that is booked on the RDataFrame, without
+      the output settings.
+  """
+  return PJ.get_fingerprint(input, coords, cuts, syst, phys, sampling)
+
+def get_engine_rdf(input, engine, sampling=SO.SamplingOptions()):
+  """ Node on which the distributions of the input are booked for the given
+      engine:
+        "rdf"   : RDataFrame actions (identical bookings are only done once)
+        "numpy" : columns are loaded once and histograms are filled in NumPy
+      Only the sampled entries are used if sampling is active.
+  """
+  if sampling.is_active():
+    rdf = RA.sampled_rdf(input, sampling)
+  else:
+    rdf = input.get_rdf()
+
+  if engine == "rdf":
+    return RB.BookedRDF(rdf)
+  elif engine == "numpy":
+    return CF.ColumnarRDF(rdf)
+  else:
+    raise ValueError("Unknown engine: {}".format(engine))
+
+# ------------------------------------------------------------------------------
+
+class InputBooking:
+  """ Shared RDataFrame of a single input on which all distributions that use
+      this input are booked, so that they are all filled in one event loop.
+      If a HistogramCache is given the results of distributions are taken from
+      it and stored in it after the event loop. They are keyed by the
+      fingerprint of the booking only (see get_cache_key), so that changing
+      output settings doesn't require the event loop again.
+      The post-processing time is recorded in the (optional) profiler.
+      The events can be read from a different source with the same events
+      (e.g. a skim of the input, see SkimCache).
+      With active sampling only a part of the events is used, and the number
+      of sampled events is counted in the event loop.
+  """
+
+  def __init__(self, input, engine="rdf", cache=None, profiler=None,
+               source=None, sampling=SO.SamplingOptions()):
+    self.input = input
+    self.cache = cache
+    self.profiler = PF.Profiler() if profiler is None else profiler
+    self.distrs = []
+    self.fingerprints = []
+    self.cache_keys = []
+    self.cached = [] # Cached input metadata for each distribution (or None)
+
+    # Read in the tree
+    self.source = input if source is None else source
+    self.sampling = sampling
+    self.rdf = get_engine_rdf(self.source, engine, sampling)
+
+    # Get simple metadata about the process, directly from the file if it is
+    # constant, otherwise it has to be averaged in the event loop
+    metadata = self.source.get_metadata()
+    if metadata is not None:
+      if sampling.is_active():
+        self.n_total_ptr = self.rdf.Count()
+      else:
+        self.n_total_ptr = CR.ArrayPtr(metadata["n_total"])
+      self.cross_section_ptr = CR.ArrayPtr(metadata["cross_section"])
+      self.eM_chi_ptr = CR.ArrayPtr(metadata["eM_chirality"])
+      self.eP_chi_ptr = CR.ArrayPtr(metadata["eP_chirality"])
+    else:
+      self.n_total_ptr = self.rdf.Count()
+      self.cross_section_ptr = self.rdf.Mean("cross_section")
+      self.eM_chi_ptr = self.rdf.Mean("eM_chirality")
+      self.eP_chi_ptr = self.rdf.Mean("eP_chirality")
+
+  def book(self, output, coords, cuts, syst, phys, fingerprint=None):
+    """ Book a distribution on the shared RDataFrame.
+        If a fingerprint is given the finished distribution is recorded in the
+        production journal of its output directory.
+    """
+    # Cached distributions are not booked on the RDataFrame at all, so that 
+    # they are not filled again in the event loop of other distributions
+    arrays = None
+    cache_key = None
+    if self.cache is not None:
+      cache_key = get_cache_key(self.input, coords, cuts, syst, phys, 
+                                self.sampling)
+      with self.profiler.stage("cache_load"):
+        arrays = self.cache.load(cache_key)
+    
+    cached = None
+    if arrays is not None:
+      log.info("Using cached histograms for {}".format(output.distr_name))
+      distr = DistrBooking(None, output, coords, cuts, syst, phys)
+      distr.set_result_arrays(arrays)
+      cached = [ CR.from_arrays(name, arrays).GetValue() 
+                 for name in self.metadata_slots() ]
+    else:
+      distr = DistrBooking(self.rdf, output, coords, cuts, syst, phys)
+    
+    self.distrs.append(distr)
+    self.fingerprints.append(fingerprint)
+    self.cache_keys.append(cache_key)
+    self.cached.append(cached)
+
+  def metadata_slots(self):
+    """ Result pointers of the input metadata, in the order needed by finish.
+    """
+    return { "n_total": self.n_total_ptr, 
+             "cross_section": self.cross_section_ptr,
+             "eM_chirality": self.eM_chi_ptr, 
+             "eP_chirality": self.eP_chi_ptr }
+
+  def needs_event_loop(self):
+    """ Check if any distribution is not taken from the cache.
+    """
+    return any(cached is None for cached in self.cached)
+
+  def event_loop_ptr(self):
+    """ Result pointer that triggers the event loop of this input (None if no
+        event loop is needed).
+    """
+    for distr, cached in zip(self.distrs, self.cached):
+      if cached is None:
+        return distr.n_after_cuts_ptr
+    return None
+
+  def finish(self):
+    """ Post-process all distributions booked on this input.
+    """
+    for distr, fingerprint, cache_key, cached in zip(
+        self.distrs, self.fingerprints, self.cache_keys, self.cached):
+      if cached is None:
+        metadata = [ptr.GetValue() for ptr in self.metadata_slots().values()]
+        if cache_key is not None:
+          with self.profiler.stage("cache_store"):
+            arrays = distr.get_result_arrays()
+            for name, ptr in self.metadata_slots().items():
+              arrays.update(CR.to_arrays(name, ptr))
+            self.cache.store(cache_key, arrays)
+      else:
+        metadata = cached
+      
+      sampling_fraction = None
+      if self.sampling.is_active():
+        sampling_fraction = metadata[0] / self.source.get_n_entries()
+      files = distr.finish(self.input, *metadata, profiler=self.profiler,
+                           sampling_fraction=sampling_fraction)
+      key = PJ.get_key(distr.output.distr_name, self.input)
+      if fingerprint is not None:
+        PJ.ProductionJournal(distr.output.dir).record(key, fingerprint, files)
+      PJ.OutputManifest(distr.output.dir).record(key, files)
+
+# ------------------------------------------------------------------------------
+
+def run_graphs(ptrs):
+  """ Trigger the event loops of all RDataFrames the result pointers belong to.
+      Uses ROOT.RDF.RunGraphs to run them concurrently if available, otherwise
+      each RDataFrame is triggered in turn (which still runs all results booked
+      on it in a single event loop).
+  """
+  # Results of the columnar engine are not RDataFrame results
+  columnar_ptrs = [ptr for ptr in ptrs if isinstance(ptr, CF.ColumnarResult)]
+  ptrs = [ptr for ptr in ptrs if not isinstance(ptr, CF.ColumnarResult)]
+  for ptr in columnar_ptrs:
+    ptr.GetValue()
   
-  # ----------------------- Create RDF and set commands ------------------------
-  log.debug("Setting up RDataFrame instructions for {}".format(
-      output.distr_name))
-  
-  # Read in the tree
-  rdf = input.get_rdf()
-  
-  # Get simple metadata about the process
-  n_total_ptr = rdf.Count()
-  cross_section_ptr = rdf.Mean("cross_section")
-  eM_chi_ptr = rdf.Mean("eM_chirality")
-  eP_chi_ptr = rdf.Mean("eP_chirality")
-
-  # Apply generator level cuts
-  rdf_after_cuts = rdf.Filter(cuts)
-  n_after_cuts_ptr = rdf_after_cuts.Count()
-
-  # Create a RDataFrame histogram result pointer
-  hist_ptr = DH.get_hist_ptr(rdf_after_cuts, output.distr_name, coords)
-
-  # Prepare the muon acceptance box if requested
-  muon_acc = None
-  muon_acc_validator = None
+  if len(ptrs) == 0:
+    return
+  if hasattr(ROOT.RDF, "RunGraphs"):
+    ROOT.RDF.RunGraphs(ptrs)
+  else:
+    for ptr in ptrs:
+      ptr.GetValue()
+
+def get_spec_expressions(spec):
+  """ All expressions and column names of a registered distribution (to find
+      the branches it needs).
+  """
+  syst, phys = spec["syst"], spec["phys"]
+  expressions = [spec["cuts"]] + [coord.name for coord in spec["coords"]]
   if syst.use_muon_acc:
-    muon_acc_cut = SMA.default_acc_cut()
-    delta = SMA.default_delta()
-    muon_acc = SMA.MuonAccParametrisation(rdf_after_cuts, muon_acc_cut, delta, 
-                                          syst.costh_branch, output.distr_name, coords)
-    muon_acc_validator = MAV.MuonAccValidator(rdf_after_cuts, muon_acc_cut, delta, 
-                                              syst.costh_branch, output.distr_name, coords)
-                                              
-  # Prepare TGCs if requested
-  tgc_par = None
+    costh_branches = syst.costh_branch
+    if isinstance(costh_branches, str):
+      costh_branches = [costh_branches]
+    expressions += list(costh_branches)
   if phys.use_TGCs:
-    tgc_par = PT.TGCParametrisation(rdf_after_cuts, coords, 
-                                    phys.TGC_config_path, phys.TGC_points_path, 
-                                    output.distr_name, phys.TGC_weight_base)
+    expressions += [phys.TGC_weight_array or phys.TGC_weight_base]
+  return expressions
 
-  # ----------------------- Trigger RDF operations -----------------------------
-  log.debug("Triggering RDataFrame operations.")
-  
-  # Get all the requested values
-  n_total = n_total_ptr.GetValue()
-  cross_section = cross_section_ptr.GetValue()
-  eM_chi = eM_chi_ptr.GetValue()
-  eP_chi = eP_chi_ptr.GetValue()
-  n_after_cuts = n_after_cuts_ptr.GetValue()
-  hist = hist_ptr.GetValue()
-
-  print("For distr {}:\n\tBefore cuts: {} , after cuts: {} ({}%)".format(
-      output.distr_name, n_total, n_after_cuts, n_after_cuts/n_total*100.0))
-
-  # Base for output file name
-  output_base_name = Conv.csv_file_name(output.distr_name, input.energy, 
-                                      eM_chi, eP_chi)
-  output_base = "{}/{}".format(output.dir, output_base_name)
-
-  # Correctly normalize the histogram
-  hist.Scale(cross_section/n_total)
-
-  # Plot the histogram if requested
-  if (output.create_plots):
-    log.debug("Create histogram plot.")
-    DP.draw_hist(hist, output, output_base_name)
-    if muon_acc is not None:
-      muon_acc.plot_cut_result(output, output_base_name)
-
-  # ----------------------- Producing PrEW input -------------------------------
-  log.debug("Start producing PrEW input.")
-
-  # Extract bin centers and cross sections from the histogram
-  data = DH.get_data(hist, coords)
-
-  # Try extracting the differential coefficients for the muon acceptance box.
-  if muon_acc is not None:
-    data = muon_acc.add_coefs_to_data(data)
+def get_spec_fingerprint(spec, sampling=None):
+  """ Fingerprint of a registered distribution (see ProductionJournal).
+  """
+  return PJ.get_fingerprint(spec["input"], spec["coords"], spec["cuts"],
+                            spec["syst"], spec["phys"], sampling,
+                            spec["output"])
+
+def get_output(output, sampling=None):
+  """ Output of a distribution, the outputs of sampled productions are written
+      to a separate subdirectory (see SamplingOptions.output_subdir) so that a
+      quick look never replaces the full production and its journal entries.
+  """
+  if sampling is None or not sampling.is_active():
+    return output
+  return output.in_subdir(sampling.output_subdir())
+
+def is_up_to_date(spec, fingerprint=None, sampling=None):
+  """ Check if the distribution was already produced from unchanged inputs and
+      settings.
+  """
+  if fingerprint is None:
+    fingerprint = get_spec_fingerprint(spec, sampling)
+  journal = PJ.ProductionJournal(get_output(spec["output"], sampling).dir)
+  return journal.is_up_to_date(
+    PJ.get_key(spec["output"].distr_name, spec["input"]), fingerprint)
+
+# ------------------------------------------------------------------------------
+
+class PrEWInputBatch:
+  """ Collection of distributions that are to be created.
+      All distributions of the same input are booked on a single RDataFrame so
+      that each input file is only read once, the event loops of all inputs are
+      run together before the PrEW input is written for each distribution.
+      The engine ("rdf" or "numpy") selects how the histograms are filled, see
+      get_engine_rdf.
+      Distributions that are up to date (same fingerprint of input and 
+      settings as in the production journal) are skipped unless forced.
+      With a HistogramCache the filled histograms are reused, so that forcing
+      the post-processing doesn't need to rerun the event loop.
+      With a SkimCache the events are read from local skims that only contain
+      the branches needed by the distributions of each input.
+      With active SamplingOptions only a sample of the events is used (the
+      normalisation accounts for it), such outputs are tagged in their
+      metadata and written to a subdirectory of the output directory (see
+      get_output).
+      The time of each stage, the event loop throughput and the number of
+      booked nodes are recorded in the profiler (see Profiling.Profiler).
+      RDataFrame compiles the jitted expressions and actions when the event
+      loops are triggered, this is recorded as the "jitting" stage (time until
+      the first event loop starts) separate from the "event_loop" stage.
+  """
+
+  def __init__(self, engine="rdf", force=False, cache=None, profiler=None,
+               skim_cache=None, sampling=SO.SamplingOptions()):
+    self.engine = engine
+    self.force = force
+    self.cache = cache
+    self.profiler = PF.Profiler() if profiler is None else profiler
+    self.skim_cache = skim_cache
+    self.sampling = sampling
+    self.specs = []
+
+  def add(self, input, output, coords, cuts,
+          syst=SSO.SystematicsOptions(), phys=PPO.PhysicsOptions()):
+    """ Register a distribution, arguments are the same as for
+        create_PrEW_input.
+    """
+    self.specs.append(
+      { "input": input, "output": output, "coords": coords, "cuts": cuts,
+        "syst": syst, "phys": phys })
+
+  def book(self):
+    """ Book all registered distributions, one InputBooking per input file.
+    """
+    # Collect the outdated distributions of each input
+    input_specs = {}
+    for spec in self.specs:
+      fingerprint = get_spec_fingerprint(spec, self.sampling)
+      if not self.force and is_up_to_date(spec, fingerprint, self.sampling):
+        print("Skipping {} from {}, up to date.".format(
+          spec["output"].distr_name, spec["input"].file_path))
+        continue
+      input_specs.setdefault(spec["input"].key(), []).append(
+        (spec, fingerprint))
     
-  # Try extracting the differential TGC coefficients
-  if tgc_par:
-    data = tgc_par.add_coefs_to_data(data)
-
-  # Create a pandas dataframe
-  df = pd.DataFrame(data)
-
-  # Write the dataframe to a csv file
-  file_path = "{}.csv".format(output_base)
-  df.to_csv(file_path)
-
-  # Attach metadata to beginning of file
-  metadata = CSVM.CSVMetadata()
-  metadata["Name"] = output.distr_name
-  metadata["Energy"] = input.energy
-  metadata["e-Chirality"] = eM_chi
-  metadata["e+Chirality"] = eP_chi
-
-  if muon_acc is not None:
-    muon_acc.add_coefs_to_metadata(metadata)
-    muon_acc_validator.write_validation_data(data, output, output_base_name, 
-                                             metadata, n_total, cross_section)
-
-  # Attach the metadata to the data file
-  metadata.write(file_path)
-  
-  log.debug("Done with distribution.")
+    bookings = {}
+    for input_key, specs in input_specs.items():
+      input = specs[0][0]["input"]
+      source = None
+      if self.skim_cache is not None:
+        with self.profiler.stage("skimming"):
+          source = self.skim_cache.get(
+            input, [expr for spec, fingerprint in specs 
+                    for expr in get_spec_expressions(spec)])
+      bookings[input_key] = InputBooking(input, self.engine, self.cache,
+                                         self.profiler, source, self.sampling)
+      for spec, fingerprint in specs:
+        bookings[input_key].book(get_output(spec["output"], self.sampling),
+                                 spec["coords"], spec["cuts"], spec["syst"],
+                                 spec["phys"], fingerprint)
+      
+    for booking in bookings.values():
+      cache = booking.rdf.cache
+      log.debug("Booked {} nodes/results on {}, reused {} identical ones."
+                .format(cache.n_booked(), booking.input.file_path, 
+                        cache.n_reused))
+      self.profiler.count("booked_nodes", cache.n_booked())
+      self.profiler.count("reused_nodes", cache.n_reused)
+      self.profiler.count("distributions", len(booking.distrs))
+    return list(bookings.values())
+
+  def run(self):
+    """ Book everything, run the event loop(s) and produce the PrEW input.
+    """
+    with self.profiler.stage("booking"):
+      input_bookings = self.book()
 
-# ------------------------------------------------------------------------------
\ No newline at end of file
+    # Any result of an RDataFrame triggers all results booked on it
+    log.debug("Triggering RDataFrame operations.")
+    looped = [booking for booking in input_bookings 
+              if booking.needs_event_loop()]
+    ptrs = [booking.event_loop_ptr() for booking in looped]
+    
+    # Jitting happens when the loops are triggered, it is timed separately
+    # until the first event loop starts
+    clock = RA.LoopStartClock(ptrs)
+    start_wall = time.perf_counter()
+    start_cpu = time.process_time()
+    run_graphs(ptrs)
+    wall_time = time.perf_counter() - start_wall
+    cpu_time = time.process_time() - start_cpu
+    jit_time = min(clock.time_to_start(), wall_time)
+    self.profiler.add("jitting", jit_time, min(jit_time, cpu_time))
+    self.profiler.add("event_loop", wall_time - jit_time,
+                      cpu_time - min(jit_time, cpu_time))
+    self.profiler.count("events", 
+                        sum(int(booking.n_total_ptr.GetValue())
+                            for booking in looped))
+    self.profiler.count("event_loops", len(looped))
+
+    with self.profiler.stage("post_processing"):
+      for booking in input_bookings:
+        booking.finish()
+
+# ------------------------------------------------------------------------------
+
+def create_PrEW_input(input, output, coords, cuts,
+                      syst=SSO.SystematicsOptions(), phys=PPO.PhysicsOptions(),
+                      engine="rdf", force=False, cache=None, skim_cache=None,
+                      sampling=SO.SamplingOptions()):
+  """ Create the input CSV distributions for PrEW by setting up an RDataFrame
+      and extraction all relevant observables and coefficients and performing
+      the requested cuts.
+      The engine ("rdf" or "numpy") selects how the histograms are filled.
+      The distribution is only produced if it isn't up to date or if forced.
+      An optional HistogramCache allows redoing the post-processing without
+      the event loop, an optional SkimCache reads the events from a local skim
+      of the needed branches. With active SamplingOptions only a sample of the
+      events is used for a quick look (written to a subdirectory of the output
+      directory, see get_output).
+      To create multiple distributions from the same input in a single event
+      loop use PrEWInputBatch instead.
+  """
+  batch = PrEWInputBatch(engine, force, cache, skim_cache=skim_cache,
+                         sampling=sampling)
+  batch.add(input, output, coords, cuts, syst, phys)
+  batch.run()
+
+# ------------------------------------------------------------------------------
@@ -0,0 +1,205 @@
+# ------------------------------------------------------------------------------
+
+""" Driver that distributes the production of the PrEW input over a pool of
+    processes, each with its own share of a global thread budget.
+"""
+
+# ------------------------------------------------------------------------------
+
+import concurrent.futures as cf
+import logging as log
+import multiprocessing as mp
+import os
+import resource
+import ROOT
+import sys
+import time
+
+# Local modules
+from PrEWInputProduction.Core import CreatePrEWInput as CPI
+from PrEWInputProduction.Core import Profiling as PF
+from PrEWInputProduction.Core import SamplingOptions as SO
+from PrEWInputProduction.Physics import PhysicsOptions as PPO
+from PrEWInputProduction.Systematics import SystematicsOptions as SSO
+
+# ------------------------------------------------------------------------------
+
+def run_job(specs, engine, force, cache, n_threads, log_level,
+            profile_dir=None, skim_cache=None,
+            sampling=SO.SamplingOptions()):
+  """ Produce all distributions of one input in a worker process, using the
+      given number of RDataFrame threads.
+      If a profile directory is given, the cProfile statistics of the job are
+      written to it.
+      Returns the timing information and the profile report of the job.
+  """
+  log.basicConfig(level=log_level)
+  ROOT.gROOT.SetBatch(True) # Don't show graphics at runtime
+  if n_threads > 1:
+    ROOT.EnableImplicitMT(n_threads)
+
+  start_wall = time.perf_counter()
+  start_cpu = time.process_time()
+
+  profile_path = None
+  if profile_dir is not None:
+    profile_path = "{}/job_{}.prof".format(profile_dir, os.getpid())
+
+  profiler = PF.Profiler()
+  with PF.cprofile(profile_path):
+    batch = CPI.PrEWInputBatch(engine, force, cache, profiler, skim_cache,
+                               sampling)
+    for spec in specs:
+      batch.add(**spec)
+    batch.run()
+
+  return { "input": specs[0]["input"].file_path,
+           "distributions": [spec["output"].distr_name for spec in specs],
+           "pid": os.getpid(),
+           "n_threads": n_threads,
+           "wall_time": time.perf_counter() - start_wall,
+           "cpu_time": time.process_time() - start_cpu,
+           "profile": profiler.report() }
+
+# ------------------------------------------------------------------------------
+
+def split_budget(n_cores, n_jobs, max_workers=None):
+  """ Divide the core budget into a number of workers and the threads each
+      worker uses, returns (n_workers, n_threads).
+  """
+  n_workers = min(n_jobs, n_cores)
+  if max_workers is not None:
+    n_workers = min(n_workers, max_workers)
+  n_workers = max(n_workers, 1)
+  return n_workers, max(n_cores // n_workers, 1)
+
+def print_timing(results, wall_time):
+  """ Print the timing report of all jobs.
+  """
+  print("Timing of {} jobs (total wall time {:.1f}s):".format(
+    len(results), wall_time))
+  for result in sorted(results, key=lambda r: -r["wall_time"]):
+    print("\t{:8.1f}s wall {:8.1f}s CPU {:3d} threads  {} ({} distributions)"
+          .format(result["wall_time"], result["cpu_time"],
+                  result["n_threads"], result["input"],
+                  len(result["distributions"])))
+    events_per_second = result["profile"].get("events_per_second")
+    if events_per_second is not None:
+      print("\t\t{:.3g} events/s, peak RSS {:.0f}MB".format(
+        events_per_second, result["profile"]["peak_rss_mb"]))
+
+def get_run_report(results, wall_time, n_workers, n_threads):
+  """ Machine-readable report of a run (all jobs and their profiles).
+  """
+  stages = {}
+  counters = {}
+  for result in results:
+    for name, stage in result["profile"]["stages"].items():
+      total = stages.setdefault(name, { "wall_time": 0.0, "cpu_time": 0.0,
+                                        "calls": 0 })
+      for key in total:
+        total[key] += stage[key]
+    for name, value in result["profile"]["counters"].items():
+      counters[name] = counters.get(name, 0) + value
+
+  return { "command": sys.argv,
+           "wall_time": wall_time,
+           "n_workers": n_workers,
+           "n_threads": n_threads,
+           "peak_rss_mb": max([PF.peak_rss_mb(), 
+                               PF.peak_rss_mb(resource.RUSAGE_CHILDREN)]),
+           "stages": stages,
+           "counters": counters,
+           "jobs": results }
+
+# ------------------------------------------------------------------------------
+
+class ParallelPrEWInputBatch:
+  """ Same interface as PrEWInputBatch, but the inputs are processed
+      concurrently in separate processes.
+      All distributions of one input form a single job (so that each input
+      file is still only read once), the core budget (default: all cores) is
+      split among the workers which each enable their share of RDataFrame
+      threads.
+      Distributions that are up to date are skipped unless forced (see
+      PrEWInputBatch), inputs without any outdated distribution don't start a
+      job.
+      Each job is profiled (see Profiling), if a report path is given the
+      summary of the run is written to it as JSON. With a profile directory
+      the cProfile statistics of each job are written as well.
+      An optional SkimCache and SamplingOptions are used by all jobs (see
+      PrEWInputBatch).
+  """
+
+  def __init__(self, n_cores=None, max_workers=None, engine="rdf",
+               force=False, cache=None, report_path=None, profile_dir=None,
+               skim_cache=None, sampling=SO.SamplingOptions()):
+    self.n_cores = os.cpu_count() if n_cores is None else n_cores
+    self.max_workers = max_workers
+    self.engine = engine
+    self.force = force
+    self.cache = cache
+    self.report_path = report_path
+    self.profile_dir = profile_dir
+    self.skim_cache = skim_cache
+    self.sampling = sampling
+    self.jobs = {}
+
+  def add(self, input, output, coords, cuts,
+          syst=SSO.SystematicsOptions(), phys=PPO.PhysicsOptions()):
+    """ Register a distribution, arguments are the same as for
+        create_PrEW_input.
+    """
+    spec = { "input": input, "output": output, "coords": coords, "cuts": cuts,
+             "syst": syst, "phys": phys }
+    if not self.force and CPI.is_up_to_date(spec, sampling=self.sampling):
+      print("Skipping {} from {}, up to date.".format(
+        output.distr_name, input.file_path))
+      return
+    input_key = input.key()
+    self.jobs.setdefault(input_key, []).append(spec)
+
+  def run(self):
+    """ Run all jobs in the process pool and report their timing.
+        Raises a RuntimeError after all jobs finished if any of them failed.
+    """
+    if len(self.jobs) == 0:
+      return []
+
+    n_workers, n_threads = split_budget(self.n_cores, len(self.jobs),
+                                        self.max_workers)
+    log.info("Running {} jobs on {} workers with {} threads each.".format(
+      len(self.jobs), n_workers, n_threads))
+
+    start = time.perf_counter()
+    results = []
+    failures = []
+
+    # Spawn fresh processes, ROOT's state can't be shared by forking
+    context = mp.get_context("spawn")
+    with cf.ProcessPoolExecutor(max_workers=n_workers,
+                                mp_context=context) as executor:
+      log_level = log.getLogger().getEffectiveLevel()
+      futures = { executor.submit(run_job, specs, self.engine, self.force,
+                                  self.cache, n_threads, log_level,
+                                  self.profile_dir, self.skim_cache,
+                                  self.sampling): key
+                  for key, specs in self.jobs.items() }
+      for future in cf.as_completed(futures):
+        try:
+          results.append(future.result())
+        except Exception as error:
+          log.error("Job for {} failed: {}".format(futures[future][0], error))
+          failures.append((futures[future], error))
+
+    wall_time = time.perf_counter() - start
+    print_timing(results, wall_time)
+    if self.report_path is not None:
+      PF.write_json(self.report_path, 
+                    get_run_report(results, wall_time, n_workers, n_threads))
+    if len(failures) > 0:
+      raise RuntimeError("{} of {} jobs failed.".format(
+        len(failures), len(self.jobs)))
+    return results
+
+# ------------------------------------------------------------------------------
@@ -0,0 +1,222 @@
+# ------------------------------------------------------------------------------
+
+""" Reading of declarative production job files (TOML or YAML) and their
+    expansion into the list of distributions that are to be produced.
+
+    Structure of a job file (TOML, YAML uses the same keys):
+
+      [run]                  # Optional defaults for the runner
+      n_cores = 32           #   total thread budget
+      engine = "rdf"         #   "rdf" or "numpy"
+      cache_dir = "..."      #   enables the histogram cache
+      skim_dir = "..."       #   enables the skims of the inputs
+
+      [[jobs]]               # One block per process (set of input files)
+      tree = "WWObservables"
+      energy = 250
+      output_dir = "..."
+      create_plots = true
+      formats = ["csv", "arrow"] # optional, see BinaryOutput (default: csv)
+      float_dtype = "float32"    # optional, precision of binary outputs
+      coords = [ { name = "costh_l", n_bins = 20, min = -1.0, max = 1.0 } ]
+      inputs = { eL_pR = "...root", eR_pL = "...root" } # chirality -> file
+                                        # (or glob, manifest or list, see
+                                        #  InputHelpers.resolve_files)
+      tgc = { config = "...", points = "...", weight_base = "..." } # optional
+
+      [[jobs.distributions]]
+      name = "2f_{final_state}_{mass}" # Python format strings using the
+      cuts = "{fs_cut} && {mass_cut}"  # variables of the variations
+      chiralities = ["eL_pR", "eR_pL"] # optional, default: all inputs
+      muon_acc = { costh_branch = "costh_l", mode = "stacked" } # optional
+      use_tgc = true                   # optional
+      vary.final_state = [ { final_state = "c", fs_cut = "(f_pdg == 4)" } ]
+      vary.mass = [ { mass = "81to101", mass_cut = "(m_ff > 81)" } ]
+
+    Each distribution is produced for the cartesian product of all its
+    variations and chiralities.
+    Relative paths are relative to the job file.
+"""
+
+# ------------------------------------------------------------------------------
+
+import itertools
+import os
+
+try:
+  import tomllib
+except ImportError:
+  try:
+    import tomli as tomllib
+  except ImportError:
+    tomllib = None
+
+try:
+  import yaml
+except ImportError:
+  yaml = None
+
+# Local modules
+from PrEWInputProduction.IO import InputHelpers as IH
+from PrEWInputProduction.IO import OutputHelpers as OH
+from PrEWInputProduction.Physics import PhysicsOptions as PPO
+from PrEWInputProduction.ROOTHelp import DistrHelpers as DH
+from PrEWInputProduction.Systematics import SystematicsOptions as SSO
+
+# ------------------------------------------------------------------------------
+
+def read_config(path):
+  """ Read the TOML or YAML job file into a dictionary.
+  """
+  extension = os.path.splitext(path)[1].lower()
+  if extension == ".toml":
+    if tomllib is None:
+      raise ImportError("Reading TOML job files requires tomli (Python<3.11)")
+    with open(path, "rb") as file:
+      return tomllib.load(file)
+  elif extension in [".yaml", ".yml"]:
+    if yaml is None:
+      raise ImportError("Reading YAML job files requires PyYAML")
+    with open(path) as file:
+      return yaml.safe_load(file)
+  else:
+    raise ValueError("Unknown job file type: {}".format(path))
+
+def resolve_path(path, base_dir):
+  """ Path relative to the job file directory (absolute paths are kept), also
+      for each path of a list.
+  """
+  if path is None:
+    return None
+  elif isinstance(path, list):
+    return [resolve_path(item, base_dir) for item in path]
+  return os.path.normpath(os.path.join(base_dir, os.path.expanduser(path)))
+
+# ------------------------------------------------------------------------------
+
+def expand_variations(vary):
+  """ All combinations of the variations: vary maps a dimension name to the
+      list of its variants, each variant is a dictionary of variables.
+      Returns the list of merged variable dictionaries.
+  """
+  dimensions = [vary[name] for name in sorted(vary)]
+  combinations = []
+  for variants in itertools.product(*dimensions):
+    variables = {}
+    for variant in variants:
+      variables.update(variant)
+    combinations.append(variables)
+  return combinations
+
+def format_value(value, variables):
+  """ Fill the variables into all strings of the (nested) value.
+  """
+  if isinstance(value, str):
+    return value.format(**variables)
+  elif isinstance(value, list):
+    return [format_value(item, variables) for item in value]
+  elif isinstance(value, dict):
+    return { key: format_value(item, variables)
+             for key, item in value.items() }
+  return value
+
+# ------------------------------------------------------------------------------
+
+def expand_job(job, base_dir):
+  """ Expand a job into the plain description (entry) of each distribution.
+  """
+  for key in ["tree", "energy", "output_dir", "inputs", "distributions"]:
+    if key not in job:
+      raise ValueError("Job is missing the key '{}'".format(key))
+
+  entries = []
+  for distr in job["distributions"]:
+    for variables in expand_variations(distr.get("vary", {})):
+      variables = dict(variables, energy=job["energy"])
+      settings = format_value(
+        { key: value for key, value in distr.items() if key != "vary" },
+        variables)
+
+      chiralities = settings.get("chiralities", list(job["inputs"]))
+      for chirality in chiralities:
+        if chirality not in job["inputs"]:
+          raise ValueError("Unknown chirality {} in {}".format(
+            chirality, settings["name"]))
+        entries.append({
+          "file_path": resolve_path(job["inputs"][chirality], base_dir),
+          "tree": job["tree"],
+          "energy": job["energy"],
+          "chirality": chirality,
+          "output_dir": resolve_path(
+            settings.get("output_dir", job["output_dir"]), base_dir),
+          "name": settings["name"],
+          "create_plots": settings.get("create_plots",
+                                       job.get("create_plots", True)),
+          "formats": settings.get("formats", job.get("formats", ["csv"])),
+          "float_dtype": settings.get("float_dtype",
+                                      job.get("float_dtype", "float64")),
+          "coords": settings.get("coords", job.get("coords")),
+          "cuts": settings.get("cuts", "true"),
+          "muon_acc": settings.get("muon_acc"),
+          "tgc": job.get("tgc") if settings.get("use_tgc", False) else None,
+          "base_dir": base_dir })
+  return entries
+
+def get_plan(paths):
+  """ Read all job files and return the runner options (from the [run] tables,
+      later files take precedence) and the entries of all distributions.
+  """
+  run_options = {}
+  entries = []
+  for path in paths:
+    config = read_config(path)
+    base_dir = os.path.dirname(os.path.abspath(path))
+    run_options.update(config.get("run", {}))
+    for job in config.get("jobs", []):
+      entries += expand_job(job, base_dir)
+  return run_options, entries
+
+# ------------------------------------------------------------------------------
+
+def get_spec(entry):
+  """ Arguments for PrEWInputBatch.add for the distribution entry.
+  """
+  if not entry["coords"]:
+    raise ValueError("No coordinates given for {}".format(entry["name"]))
+  coords = [ DH.Coordinate(coord["name"], coord["n_bins"], coord["min"],
+                           coord["max"]) for coord in entry["coords"] ]
+
+  syst = SSO.SystematicsOptions()
+  if entry["muon_acc"] is not None:
+    syst = SSO.SystematicsOptions(
+      use_muon_acc=True,
+      costh_branch=entry["muon_acc"].get("costh_branch", "costh"),
+      muon_acc_mode=entry["muon_acc"].get("mode", "stacked"))
+
+  phys = PPO.PhysicsOptions()
+  if entry["tgc"] is not None:
+    tgc = entry["tgc"]
+    phys = PPO.PhysicsOptions(
+      use_TGCs=True,
+      TGC_config_path=resolve_path(tgc["config"], entry["base_dir"]),
+      TGC_points_path=resolve_path(tgc["points"], entry["base_dir"]),
+      TGC_weight_base=tgc.get("weight_base"),
+      TGC_weight_array=tgc.get("weight_array"))
+
+  return {
+    "input": IH.InputInfo(entry["file_path"], entry["tree"], entry["energy"]),
+    "output": OH.OutputInfo(entry["output_dir"], entry["name"],
+                            entry["create_plots"], entry["formats"],
+                            entry["float_dtype"]),
+    "coords": coords, "cuts": entry["cuts"], "syst": syst, "phys": phys }
+
+def describe(entry):
+  """ One-line description of a distribution entry.
+  """
+  file_path = entry["file_path"]
+  if isinstance(file_path, list):
+    file_path = "{} (+{} more)".format(file_path[0], len(file_path)-1)
+  return "{} [{}] {}: {}".format(entry["name"], entry["chirality"],
+                                 os.path.basename(file_path), entry["cuts"])
+
+# ------------------------------------------------------------------------------
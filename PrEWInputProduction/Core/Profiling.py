@@ -0,0 +1,126 @@
+# ------------------------------------------------------------------------------
+
+""" Instrumentation of the production: wall and CPU time of each stage,
+    counters (e.g. processed events, booked nodes) and the peak memory, which
+    are summarised in a JSON report.
+"""
+
+# ------------------------------------------------------------------------------
+
+import contextlib
+import cProfile
+import json
+import os
+import resource
+import sys
+import time
+
+# ------------------------------------------------------------------------------
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+  """ Peak resident set size in MB (of this process or of its children).
+  """
+  max_rss = resource.getrusage(who).ru_maxrss
+  # Linux reports kB, macOS bytes
+  return max_rss / (1024.0**2 if sys.platform == "darwin" else 1024.0)
+
+def write_json(path, content):
+  """ Write the content as JSON file (atomically).
+  """
+  dir = os.path.dirname(os.path.abspath(path))
+  os.makedirs(dir, exist_ok=True)
+  tmp_path = "{}.tmp{}".format(path, os.getpid())
+  with open(tmp_path, "w") as file:
+    json.dump(content, file, indent=2, sort_keys=True)
+  os.replace(tmp_path, path)
+
+# ------------------------------------------------------------------------------
+
+class Profiler:
+  """ Accumulates the time spent in named stages and arbitrary counters.
+      Stages with the same name are summed up (e.g. the CSV writing of all
+      distributions), nested stages are timed independently.
+  """
+
+  def __init__(self):
+    self.stages = {}
+    self.counters = {}
+    self.start_wall = time.perf_counter()
+    self.start_cpu = time.process_time()
+
+  @contextlib.contextmanager
+  def stage(self, name):
+    """ Context manager that adds the time spent in the block to the stage.
+    """
+    start_wall = time.perf_counter()
+    start_cpu = time.process_time()
+    try:
+      yield
+    finally:
+      self.add(name, time.perf_counter() - start_wall,
+               time.process_time() - start_cpu)
+
+  def add(self, name, wall_time, cpu_time=0.0):
+    """ Add a separately measured time to the stage.
+    """
+    stage = self.stages.setdefault(
+      name, { "wall_time": 0.0, "cpu_time": 0.0, "calls": 0 })
+    stage["wall_time"] += wall_time
+    stage["cpu_time"] += cpu_time
+    stage["calls"] += 1
+
+  def count(self, name, n=1):
+    """ Increase the counter by n.
+    """
+    self.counters[name] = self.counters.get(name, 0) + n
+
+  def report(self):
+    """ Dictionary summarising all stages and counters of this process.
+        If events were counted, the event loop throughput is added.
+    """
+    report = { "pid": os.getpid(),
+               "wall_time": time.perf_counter() - self.start_wall,
+               "cpu_time": time.process_time() - self.start_cpu,
+               "peak_rss_mb": peak_rss_mb(),
+               "stages": self.stages,
+               "counters": self.counters }
+    loop_time = self.stages.get("event_loop", {}).get("wall_time", 0.0)
+    if loop_time > 0.0 and "events" in self.counters:
+      report["events_per_second"] = self.counters["events"] / loop_time
+    return report
+
+  def print_summary(self):
+    """ Print the time spent in each stage.
+    """
+    report = self.report()
+    print("Profile (wall {:.1f}s, CPU {:.1f}s, peak RSS {:.0f}MB):".format(
+      report["wall_time"], report["cpu_time"], report["peak_rss_mb"]))
+    for name, stage in sorted(self.stages.items(),
+                              key=lambda item: -item[1]["wall_time"]):
+      print("\t{:8.2f}s wall {:8.2f}s CPU {:5d}x  {}".format(
+        stage["wall_time"], stage["cpu_time"], stage["calls"], name))
+    if "events_per_second" in report:
+      print("\tEvent loop: {:.3g} events/s".format(
+        report["events_per_second"]))
+
+# ------------------------------------------------------------------------------
+
+@contextlib.contextmanager
+def cprofile(path):
+  """ Run the block with cProfile and dump the statistics to the path (no
+      profiling if the path is None).
+      The statistics can be inspected with pstats or e.g. snakeviz.
+  """
+  if path is None:
+    yield
+    return
+  profile = cProfile.Profile()
+  profile.enable()
+  try:
+    yield
+  finally:
+    profile.disable()
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    profile.dump_stats(path)
+
+# ------------------------------------------------------------------------------
@@ -0,0 +1,41 @@
+# ------------------------------------------------------------------------------
+
+class SamplingOptions:
+  """ Class that stores the settings for processing only a sample of the input
+      events (e.g. for quick checks of binnings or cuts during development).
+  """
+  
+  def __init__(self, fraction=None, max_entries=None, seed=1):
+    """ Sampling is turned off by default.
+        fraction : random fraction of the entries that is used (entries are
+                   selected by a hash of the entry number, reproducible for
+                   the same seed)
+        max_entries : only the first max_entries entries are used
+    """
+    if fraction is not None and not 0 < fraction <= 1:
+      raise ValueError("Sampling fraction must be in (0,1]: {}".format(
+        fraction))
+    if max_entries is not None and max_entries <= 0:
+      raise ValueError("Number of sampled entries must be positive: {}".format(
+        max_entries))
+    self.fraction = fraction
+    self.max_entries = max_entries
+    self.seed = seed
+    
+  def is_active(self):
+    """ Check if only a sample of the events is used.
+    """
+    return self.fraction is not None or self.max_entries is not None
+    
+  def output_subdir(self):
+    """ Subdirectory (of the output directory) for the outputs produced with
+        these settings, so that they never replace the full production.
+    """
+    parts = []
+    if self.fraction is not None:
+      parts.append("fraction{}_seed{}".format(self.fraction, self.seed))
+    if self.max_entries is not None:
+      parts.append("first{}".format(self.max_entries))
+    return "sampled/{}".format("_".join(parts))
+    
+# ------------------------------------------------------------------------------
@@ -1,26 +1,21 @@
 import ROOT
 import logging as log
 import math
-import sys
 
 # Local modules
-sys.path.append("../Core")
-import CreatePrEWInput as CPI
-sys.path.append("../IO")
-import InputHelpers as IH
-import OutputHelpers as OH
-sys.path.append("../ROOTHelp")
-import DistrHelpers as DH
+from PrEWInputProduction.Core import ParallelProduction as PP
+from PrEWInputProduction.IO import InputHelpers as IH
+from PrEWInputProduction.IO import OutputHelpers as OH
+from PrEWInputProduction.ROOTHelp import DistrHelpers as DH
 
 # ------------------------------------------------------------------------------
 
 def main():
     """ Run the hadronic difermion code for different cases.
     """
-    n_threads = 10 # Number of threads to use 
+    n_cores = 10 # Total number of cores used by all worker processes
     
     log.basicConfig(level=log.WARNING) # Set logging level
-    ROOT.EnableImplicitMT(n_threads) # Enable multithreading in RDataFrame
     ROOT.gROOT.SetBatch(True) # Don't show graphics at runtime
 
     # Input
@@ -54,17 +49,24 @@ def main():
       [180, 1.1*energy]
     ]
 
+    # Collect all distributions, they are filled in one event loop per input
+    # and the inputs are processed in parallel (n_cores is the total budget)
+    batch = PP.ParallelPrEWInputBatch(n_cores=n_cores)
+
     # Create distributions for opposite-sign chiralities (both charges)
     for input in inputs:
       for final_state, fs_cut in final_state_cuts.items():
         for m_low, m_high in mass_cuts:
           distr_name = "2f_{}_{}to{}".format(final_state,int(m_low),int(m_high))
           cuts = "{} && (m_ff > {}) && (m_ff < {})".format(fs_cut,m_low,m_high)
-          CPI.create_PrEW_input(
+          batch.add(
             input = input, coords = coords, 
             output = OH.OutputInfo( output_dir, distr_name = distr_name, create_plots = create_plots), 
             cuts = cuts)
 
+    # Run the event loops and write the PrEW input
+    batch.run()
+
     print("Done.")
 
 # ------------------------------------------------------------------------------
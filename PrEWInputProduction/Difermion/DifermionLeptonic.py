@@ -1,28 +1,22 @@
 import ROOT
 import logging as log
 import math
-import sys
 
 # Local modules
-sys.path.append("../Core")
-import CreatePrEWInput as CPI
-sys.path.append("../IO")
-import InputHelpers as IH
-import OutputHelpers as OH
-sys.path.append("../ROOTHelp")
-import DistrHelpers as DH
-sys.path.append("../Systematics")
-import SystematicsOptions as SSO
+from PrEWInputProduction.Core import ParallelProduction as PP
+from PrEWInputProduction.IO import InputHelpers as IH
+from PrEWInputProduction.IO import OutputHelpers as OH
+from PrEWInputProduction.ROOTHelp import DistrHelpers as DH
+from PrEWInputProduction.Systematics import SystematicsOptions as SSO
 
 # ------------------------------------------------------------------------------
 
 def main():
     """ Run the leptonic difermion code for different cases.
     """
-    n_threads = 10 # Number of threads to use 
+    n_cores = 10 # Total number of cores used by all worker processes
     
     log.basicConfig(level=log.WARNING) # Set logging level
-    ROOT.EnableImplicitMT(n_threads) # Enable multithreading in RDataFrame
     ROOT.gROOT.SetBatch(True) # Don't show graphics at runtime
 
     # Input
@@ -69,12 +63,16 @@ def main():
         cut_dict[mass_cut_name] = mass_cut
       
     
+    # Collect all distributions, they are filled in one event loop per input
+    # and the inputs are processed in parallel (n_cores is the total budget)
+    batch = PP.ParallelPrEWInputBatch(n_cores=n_cores)
+    
     # --- Muons (w/ systematics) ------------------------------------------------
     for input in inputs:
       for cut_name, cuts in cut_dict.items():
         distr_name = "2f_mu_{}".format(cut_name)
         distr_cuts = "(f_pdg == 13) && {}".format(cuts)
-        CPI.create_PrEW_input(
+        batch.add(
           input = input, coords = coords, 
           output = OH.OutputInfo( output_dir, distr_name = distr_name, create_plots = create_plots), 
           cuts = distr_cuts, 
@@ -85,7 +83,7 @@ def main():
       for cut_name, cuts in cut_dict.items():
         distr_name = "2f_tau_{}".format(cut_name)
         distr_cuts = "(f_pdg == 15) && {}".format(cuts)
-        CPI.create_PrEW_input(
+        batch.add(
           input = input, coords = coords, 
           output = OH.OutputInfo( output_dir, distr_name = distr_name, create_plots = create_plots), 
           cuts = distr_cuts)
@@ -98,11 +96,14 @@ def main():
       for cut_name, cuts in cut_dict.items():
         distr_name = "2f_mu_{}_true".format(cut_name)
         distr_cuts = "(f_pdg == 13) && {}".format(cuts)
-        CPI.create_PrEW_input(
+        batch.add(
           input = input, coords = coords, 
           output = OH.OutputInfo( output_dir, distr_name = distr_name, create_plots = False), 
           cuts = distr_cuts)      
     
+    # Run the event loops and write the PrEW input
+    batch.run()
+
     print("Done.")
 
 # ------------------------------------------------------------------------------
@@ -0,0 +1,39 @@
+import numpy as np
+
+# ------------------------------------------------------------------------------
+
+""" Helpers for fitting models that are linear in their coefficients.
+"""
+
+# ------------------------------------------------------------------------------
+
+def batched_weighted_lstsq(design, values, sigma):
+  """ Solve the weighted linear least-squares problem 
+        min_x sum_k ( (design x - values[:,b])_k / sigma[k,b] )^2
+      for all bins b at once (using a batched QR decomposition).
+      Needs:
+        design ... (K x n_coefs) design matrix, same for all bins
+        values ... (K x n_bins) values at each of the K points
+        sigma ... (K x n_bins) uncertainty of each value
+      Returns the (n_bins x n_coefs) coefficients.
+      A uniform scaling of sigma within a bin does not change the result.
+  """
+  design = np.asarray(design, dtype=float)
+  
+  # Normalise the columns (which can differ by orders of magnitude) for a 
+  # better conditioned problem
+  col_scale = np.max(np.abs(design), axis=0)
+  col_scale[col_scale == 0] = 1.0
+  design = design / col_scale
+  
+  weights = 1.0 / np.transpose(sigma) # (n_bins x K)
+  design_w = design[None,:,:] * weights[:,:,None]
+  values_w = np.transpose(values) * weights
+  
+  Q, R = np.linalg.qr(design_w)
+  Qt_values = np.einsum("bkc,bk->bc", Q, values_w)
+  coefs = np.linalg.solve(R, Qt_values[:,:,None])[:,:,0]
+  
+  return coefs / col_scale
+
+# ------------------------------------------------------------------------------
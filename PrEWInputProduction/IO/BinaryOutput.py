@@ -0,0 +1,115 @@
+import json
+import numpy as np
+import os
+import shutil
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+# Local modules
+from PrEWInputProduction.IO import CSVMetadata as CSVM
+
+# ------------------------------------------------------------------------------
+
+""" Binary output of the distributions next to (or instead of) the CSV files.
+    The same columns are stored together with the CSVMetadata key/values
+    (JSON encoded) as file-level metadata, in one of the formats:
+      "arrow"   : Arrow IPC file <base>.arrow (needs pyarrow), can be memory
+                  mapped with pyarrow.memory_map + pyarrow.ipc.open_file
+      "columns" : directory <base>.columns with one .npy file per column and
+                  a metadata.json, can be memory mapped with
+                  numpy.load(..., mmap_mode="r")
+"""
+
+# ------------------------------------------------------------------------------
+
+formats = { "csv": ".csv", "arrow": ".arrow", "columns": ".columns" }
+
+def output_path(base_path, format):
+    """ Path of the output in the given format.
+    """
+    if format not in formats:
+        raise ValueError("Unknown output format: {}".format(format))
+    return base_path + formats[format]
+
+def get_columns(df, float_dtype):
+    """ Dictionary of the column arrays of the dataframe, floating point columns
+        are converted to the given precision.
+    """
+    columns = {}
+    for name in df.columns:
+        values = df[name].to_numpy()
+        if np.issubdtype(values.dtype, np.floating):
+            values = values.astype(float_dtype)
+        columns[str(name)] = values
+    return columns
+
+def metadata_dict(metadata):
+    """ CSVMetadata key/values with JSON encoded values.
+    """
+    return { key: json.dumps(value, default=lambda v: np.asarray(v).tolist())
+             for key, value in metadata.metadata.items() }
+
+# ------------------------------------------------------------------------------
+
+def write_arrow(path, df, metadata, float_dtype="float64"):
+    """ Write the dataframe and metadata as (uncompressed, so that it can be
+        memory mapped) Arrow IPC file.
+    """
+    if pa is None:
+        raise ImportError("Arrow output requires pyarrow")
+    table = pa.Table.from_pydict(get_columns(df, float_dtype))
+    table = table.replace_schema_metadata(metadata_dict(metadata))
+    tmp_path = CSVM.tmp_path(path)
+    with pa.OSFile(tmp_path, "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(tmp_path, path)
+
+def write_columns(path, df, metadata, float_dtype="float64"):
+    """ Write the dataframe as directory with one .npy file per column and the
+        metadata (and the column order) in metadata.json.
+    """
+    tmp_path = CSVM.tmp_path(path)
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    columns = get_columns(df, float_dtype)
+    files = {}
+    for i, (name, values) in enumerate(columns.items()):
+        files[name] = "column{}.npy".format(i)
+        np.save("{}/{}".format(tmp_path, files[name]), values)
+    with open("{}/metadata.json".format(tmp_path), "w") as file:
+        json.dump({ "columns": list(columns), "files": files,
+                    "metadata": metadata_dict(metadata) }, file)
+
+    # Directories can't be replaced atomically, move the old one away first
+    if os.path.isdir(path):
+        old_path = "{}.old{}".format(path, os.getpid())
+        os.replace(path, old_path)
+        os.replace(tmp_path, path)
+        shutil.rmtree(old_path, ignore_errors=True)
+    else:
+        os.replace(tmp_path, path)
+
+def write_table(base_path, df, metadata, formats=("csv",),
+                float_dtype="float64"):
+    """ Write the dataframe and its metadata in all requested formats (see
+        above, "csv" is the CSV file with the metadata header).
+        Returns the written paths.
+    """
+    paths = []
+    for format in formats:
+        path = output_path(base_path, format)
+        if format == "csv":
+            metadata.write_csv(path, df)
+        elif format == "arrow":
+            write_arrow(path, df, metadata, float_dtype)
+        else:
+            write_columns(path, df, metadata, float_dtype)
+        paths.append(path)
+    return paths
+
+# ------------------------------------------------------------------------------
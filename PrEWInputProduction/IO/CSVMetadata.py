@@ -1,3 +1,16 @@
+import os
+import shutil
+
+# ------------------------------------------------------------------------------
+
+def tmp_path(path):
+    """ Temporary path next to the file (same file system, so it can be
+        renamed atomically).
+    """
+    return "{}.tmp{}".format(path, os.getpid())
+
+# ------------------------------------------------------------------------------
+
 class CSVMetadata:
     """ Class to add metadata to the top of a CSV file.
     """
@@ -31,13 +44,23 @@ class CSVMetadata:
         metadata_str += self.end_marker + "\n"
         return metadata_str
 
-    def write(self, csv_path):
-        """ Write all the given metadata to the top of the file.
+    def write_csv(self, csv_path, df, chunk_size=100000):
+        """ Write the CSV file of the pandas dataframe with the metadata at the
+            top in a single pass, the rows are written in chunks.
+            The file is replaced atomically.
         """
-        metadata_str = self.get_metadata_str()
+        path = tmp_path(csv_path)
+        with open(path, "w", newline="") as file:
+            file.write(self.get_metadata_str())
+            df.to_csv(file, chunksize=chunk_size)
+        os.replace(path, csv_path)
 
-        file = open(csv_path, 'r+')
-        data = file.read() # read previous file contents 
-        file.seek(0,0)  # get to the first position
-        file.write("{}{}".format(metadata_str,data))
-        file.close()
+    def write(self, csv_path):
+        """ Write all the given metadata to the top of an existing file.
+            Prefer write_csv, which doesn't need to copy the file.
+        """
+        path = tmp_path(csv_path)
+        with open(path, "w") as file, open(csv_path, "r") as data:
+            file.write(self.get_metadata_str())
+            shutil.copyfileobj(data, file)
+        os.replace(path, csv_path)
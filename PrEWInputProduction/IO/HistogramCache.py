@@ -0,0 +1,101 @@
+import logging as log
+import numpy as np
+import os
+
+# Local modules
+from PrEWInputProduction.IO import OutputHelpers as OH
+
+# ------------------------------------------------------------------------------
+
+""" Persistent on-disk cache of the filled histograms of each distribution,
+    so that the post-processing can be re-run without the event loop.
+"""
+
+# ------------------------------------------------------------------------------
+
+def default_cache_dir():
+    """ Cache directory, can be set with the PREW_HIST_CACHE environment
+        variable.
+    """
+    return os.environ.get("PREW_HIST_CACHE",
+                          os.path.expanduser("~/.cache/prew_histograms"))
+
+# ------------------------------------------------------------------------------
+
+def evict_lru(dir, extension, max_size, keep_after=None, keep=()):
+    """ Remove the least recently used (oldest modification time) files with
+        the extension from the directory until their total size is below the
+        maximum size. Temporary files, files modified after the time stamp
+        keep_after and the paths in keep are not touched.
+    """
+    entries = []
+    for name in os.listdir(dir):
+        if not name.endswith(extension) or ".tmp" in name:
+            continue
+        path = "{}/{}".format(dir, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+
+    total_size = sum(size for mtime, size, path in entries)
+    for mtime, size, path in sorted(entries):
+        if total_size <= max_size:
+            break
+        if (keep_after is not None and mtime >= keep_after) or path in keep:
+            continue
+        try:
+            os.remove(path)
+            log.debug("Evicted cache entry {}".format(path))
+        except OSError:
+            pass
+        total_size -= size
+
+# ------------------------------------------------------------------------------
+
+class HistogramCache:
+    """ Cache of named arrays (one compressed .npz file per key, the key is the
+        booking fingerprint of the distribution).
+        If the total size exceeds max_size (in bytes) the least recently used
+        entries are removed.
+    """
+    def __init__(self, cache_dir=None, max_size=10*1024**3):
+        self.dir = default_cache_dir() if cache_dir is None else cache_dir
+        self.max_size = max_size
+
+    def entry_path(self, key):
+        return "{}/{}.npz".format(self.dir, key)
+
+    def load(self, key):
+        """ Return the dictionary of arrays stored for the key, None if the key
+            is not cached.
+        """
+        path = self.entry_path(key)
+        try:
+            with np.load(path) as entry:
+                arrays = { name: entry[name] for name in entry.files }
+        except (OSError, ValueError):
+            return None
+        os.utime(path) # Mark as recently used
+        log.debug("Loaded cached histograms {}".format(key))
+        return arrays
+
+    def store(self, key, arrays):
+        """ Store the dictionary of arrays for the key (written atomically) and
+            evict old entries if needed.
+        """
+        OH.create_dir(self.dir)
+        path = self.entry_path(key)
+        tmp_path = "{}.tmp{}.npz".format(path[:-len(".npz")], os.getpid())
+        np.savez_compressed(tmp_path, **arrays)
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def evict(self):
+        """ Remove the least recently used entries until the cache fits into
+            its maximum size.
+        """
+        evict_lru(self.dir, ".npz", self.max_size)
+
+# ------------------------------------------------------------------------------
@@ -1,4 +1,8 @@
 import ROOT
+import glob
+import logging as log
+import numpy as np
+import os
 
 # ------------------------------------------------------------------------------
 
@@ -7,16 +11,161 @@ import ROOT
 
 # ------------------------------------------------------------------------------
 
+def read_manifest(path):
+    """ Paths listed in a manifest file (one per line, relative paths are
+        relative to the manifest, empty lines and # comments are ignored).
+    """
+    dir = os.path.dirname(os.path.abspath(path))
+    paths = []
+    with open(path) as file:
+        for line in file:
+            line = line.split("#")[0].strip()
+            if line:
+                paths.append(os.path.join(dir, line))
+    return paths
+
+def resolve_files(file_path):
+    """ List of the ROOT files described by the file path, which can be a single
+        file, a glob pattern, a manifest file (any path not ending on .root,
+        see read_manifest) or a list of those.
+    """
+    if not isinstance(file_path, str):
+        return [path for item in file_path for path in resolve_files(item)]
+    if glob.has_magic(file_path):
+        paths = sorted(glob.glob(file_path))
+        if len(paths) == 0:
+            raise ValueError("No files match {}".format(file_path))
+        return paths
+    if not file_path.endswith(".root"):
+        return resolve_files(read_manifest(file_path))
+    return [file_path]
+
+# ------------------------------------------------------------------------------
+
+# Branches of the header info that are constant within a file
+metadata_branches = ["cross_section", "eM_chirality", "eP_chirality"]
+
+input_metadata = {} # Cache, each input file is only inspected once per run
+
+def read_metadata(file_path, tree_name, n_samples=100):
+    """ Read the per-file constants (see metadata_branches) from the first
+        entry of the tree and check that they are the same for a sample of
+        entries spread over the tree. The number of events is taken from the
+        tree.
+        Returns the dictionary of the values (and "n_total"), or None if the
+        values are not constant (only "n_total" for an empty tree).
+        The values are floats (e.g. the integer chiralities), as they are when
+        averaged in the event loop, so the output metadata is the same.
+    """
+    root_file = ROOT.TFile.Open(file_path)
+    if not root_file or root_file.IsZombie():
+        raise OSError("Can't open input file {}".format(file_path))
+    tree = root_file.Get(tree_name)
+    if not tree:
+        root_file.Close()
+        raise ValueError("No tree {} in {}".format(tree_name, file_path))
+
+    n_total = tree.GetEntries()
+    metadata = { "n_total": 0 }
+    if n_total > 0:
+        # Only read the needed branches
+        tree.SetBranchStatus("*", 0)
+        for branch in metadata_branches:
+            tree.SetBranchStatus(branch, 1)
+
+        entries = np.unique(np.linspace(0, n_total-1,
+                                        min(n_samples, n_total)).astype(int))
+        samples = []
+        for entry in entries:
+            tree.GetEntry(int(entry))
+            samples.append(tuple(float(getattr(tree, branch))
+                                 for branch in metadata_branches))
+        if len(set(samples)) == 1:
+            metadata = dict(zip(metadata_branches, samples[0]),
+                            n_total=n_total)
+        else:
+            metadata = None
+            log.warning("Metadata of {} not constant over the tree.".format(
+                file_path))
+    root_file.Close()
+    return metadata
+
+def file_metadata(file_path, tree_name):
+    """ Cached read_metadata, for each file and its modification time.
+    """
+    path = os.path.abspath(file_path)
+    stat = os.stat(path)
+    key = (path, tree_name, stat.st_size, stat.st_mtime_ns)
+    if key not in input_metadata:
+        input_metadata[key] = read_metadata(path, tree_name)
+    return input_metadata[key]
+
+def combine_metadata(metadatas):
+    """ Metadata of a chain of files: the events are summed and the cross
+        section is the event-weighted average (as for a hadd-merged file).
+        Empty files are ignored. None if any file has no constant metadata
+        or the files have different chiralities.
+    """
+    if any(metadata is None for metadata in metadatas):
+        return None
+    metadatas = [metadata for metadata in metadatas if metadata["n_total"] > 0]
+    if len(metadatas) == 0:
+        return None
+    chiralities = set((metadata["eM_chirality"], metadata["eP_chirality"])
+                      for metadata in metadatas)
+    if len(chiralities) > 1:
+        log.warning("Input files have different chiralities: {}".format(
+            chiralities))
+        return None
+    n_total = sum(metadata["n_total"] for metadata in metadatas)
+    cross_section = sum(metadata["n_total"] * metadata["cross_section"]
+                        for metadata in metadatas) / n_total
+    return dict(metadatas[0], n_total=n_total, cross_section=cross_section)
+
+# ------------------------------------------------------------------------------
+
 class InputInfo:
     """ Class containing typical input information.
+        The file path can also be a glob pattern, a manifest file or a list of
+        those (see resolve_files), in which case all files are chained (so
+        that they don't need to be merged).
     """
     def __init__(self,file_path,tree_name,energy):
         self.file_path = file_path
         self.tree_name = tree_name
         self.energy = energy
+        self.file_paths = resolve_files(file_path)
+
+    def key(self):
+        """ Identity of the input (for grouping distributions of the same
+            input).
+        """
+        return (tuple(self.file_paths), self.tree_name, self.energy)
 
     def get_rdf(self):
-        """ Get the ROOT RDataFrame for the given tree in the input file.
+        """ Get the ROOT RDataFrame for the given tree in the input file(s).
+        """
+        if len(self.file_paths) == 1:
+            return ROOT.RDataFrame(self.tree_name, self.file_paths[0])
+        return ROOT.RDataFrame(self.tree_name,
+                               ROOT.std.vector("string")(self.file_paths))
+
+    def get_metadata(self):
+        """ Number of events, cross section and chiralities of the input
+            (see read_metadata and combine_metadata), None if they can't be
+            read without the event loop.
         """
-        return ROOT.RDataFrame(self.tree_name, self.file_path)
-# ------------------------------------------------------------------------------
\ No newline at end of file
+        return combine_metadata([file_metadata(path, self.tree_name)
+                                 for path in self.file_paths])
+
+    def get_n_entries(self):
+        """ Number of entries in all files of the input.
+        """
+        metadata = self.get_metadata()
+        if metadata is not None:
+            return metadata["n_total"]
+        chain = ROOT.TChain(self.tree_name)
+        for path in self.file_paths:
+            chain.Add(path)
+        return chain.GetEntries()
+# ------------------------------------------------------------------------------
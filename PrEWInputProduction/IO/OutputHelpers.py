@@ -1,4 +1,9 @@
 import ROOT
+import copy
+import os
+import shutil
+import socket
+import uuid
 from pathlib import Path
 
 # ------------------------------------------------------------------------------
@@ -13,17 +18,88 @@ def create_dir(dir):
   """
   Path(dir).mkdir(parents=True, exist_ok=True)
 
+def job_id():
+  """ Identifier of this producer (host, process and a random part), unique 
+      among parallel producers writing into the same directory.
+  """
+  return "{}_{}_{}".format(socket.gethostname(), os.getpid(), 
+                           uuid.uuid4().hex[:8])
+
+def replace_path(src, dst):
+  """ Move the file or directory src to dst, replacing dst if it exists.
+      Files are replaced atomically, directories can't be and are swapped
+      via a temporary name.
+  """
+  if os.path.isdir(src) and os.path.isdir(dst):
+    old_path = "{}.old{}".format(dst, os.getpid())
+    os.replace(dst, old_path)
+    os.replace(src, dst)
+    shutil.rmtree(old_path, ignore_errors=True)
+  else:
+    os.replace(src, dst)
+
+def move_outputs(src_dir, dst_dir, unit_suffixes=(".columns",)):
+  """ Move everything below src_dir into the same place below dst_dir (on the
+      same filesystem), directories ending on one of the unit_suffixes are 
+      outputs themselves and are moved as a whole.
+      Returns the dictionary of moved source path -> destination path.
+  """
+  moved = {}
+  create_dir(dst_dir)
+  for name in sorted(os.listdir(src_dir)):
+    src = os.path.join(src_dir, name)
+    dst = os.path.join(dst_dir, name)
+    if os.path.isdir(src) and not name.endswith(unit_suffixes):
+      moved.update(move_outputs(src, dst, unit_suffixes))
+    else:
+      replace_path(src, dst)
+      moved[src] = dst
+  return moved
+
 # ------------------------------------------------------------------------------
 
 class OutputInfo:
   """ Class containing typical output information.
+      The data can be written in several formats ("csv", "arrow" or 
+      "columns", see BinaryOutput), the floating point precision 
+      (float_dtype) applies to the binary formats.
   """
-  def __init__(self,output_dir,distr_name,create_plots=True):
+  def __init__(self,output_dir,distr_name,create_plots=True,formats=("csv",),
+               float_dtype="float64"):
     self.dir = output_dir
     self.distr_name = distr_name
     self.create_plots = create_plots
+    self.formats = tuple(formats)
+    self.float_dtype = float_dtype
     
     # Create the needed output directory structure
     create_dir(output_dir)
+
+  def in_subdir(self, subdir):
+    """ Copy of the output info that writes into the given subdirectory of 
+        the output directory.
+    """
+    output = copy.copy(self)
+    output.dir = "{}/{}".format(self.dir, subdir)
+    create_dir(output.dir)
+    return output
+
+  def staged(self):
+    """ Copy of the output info that writes into a new staging directory of
+        this producer (below .staging in the output directory), so that 
+        parallel producers never write into the same files. 
+        See commit_staged.
+    """
+    return self.in_subdir(".staging/{}".format(job_id()))
+
+  def commit_staged(self, staged, paths):
+    """ Move the outputs written into the staging directory into the output 
+        directory and remove the staging directory.
+        Returns the final locations of the given staged paths.
+    """
+    moved = move_outputs(staged.dir, self.dir)
+    moved = { os.path.normpath(src): dst for src, dst in moved.items() }
+    shutil.rmtree(staged.dir, ignore_errors=True)
+    return [moved[os.path.normpath(path)] for path in paths]
         
 # ------------------------------------------------------------------------------
\ No newline at end of file
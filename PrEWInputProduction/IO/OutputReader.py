@@ -0,0 +1,215 @@
+import ast
+import json
+import logging as log
+import numpy as np
+import os
+import pandas as pd
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+# Local modules
+from PrEWInputProduction.IO import BinaryOutput as BO
+from PrEWInputProduction.IO import CSVMetadata as CSVM
+
+# ------------------------------------------------------------------------------
+
+""" Reading of the produced PrEW input (CSV files with metadata header and the
+    binary formats, see BinaryOutput), and an index of all outputs in an
+    output directory so that they can be found without opening every file.
+"""
+
+# ------------------------------------------------------------------------------
+
+def parse_value(value_str):
+    """ Python value of a metadata value as written in the CSV header (e.g.
+        numbers or lists), the string itself if it isn't a Python literal.
+    """
+    try:
+        return ast.literal_eval(value_str)
+    except (ValueError, SyntaxError):
+        return value_str
+
+def read_csv_metadata(file):
+    """ Read the metadata header from the open CSV file, the file is left at
+        the beginning of the data.
+    """
+    metadata = {}
+    line = file.readline()
+    if line.strip() != CSVM.CSVMetadata.begin_marker:
+        raise ValueError("No metadata header in {}".format(file.name))
+    for line in file:
+        if line.strip() == CSVM.CSVMetadata.end_marker:
+            return metadata
+        key, value_str = line.rstrip("\n").split(": ", 1)
+        metadata[key] = parse_value(value_str)
+    raise ValueError("Metadata header of {} not terminated".format(file.name))
+
+def json_metadata(metadata):
+    """ Metadata from the JSON encoded key/values of the binary formats.
+    """
+    return { key: json.loads(value) for key, value in metadata.items() }
+
+# ------------------------------------------------------------------------------
+
+def read_csv(path):
+    """ Read the CSV file, returns the metadata dictionary and the dataframe.
+    """
+    with open(path, newline="") as file:
+        metadata = read_csv_metadata(file)
+        df = pd.read_csv(file, index_col=0)
+    return metadata, df
+
+def read_arrow(path, memory_map=True):
+    """ Read the Arrow IPC file (memory mapped by default), returns the
+        metadata dictionary and the dataframe.
+    """
+    if pa is None:
+        raise ImportError("Reading Arrow output requires pyarrow")
+    source = pa.memory_map(path) if memory_map else pa.OSFile(path)
+    table = pa.ipc.open_file(source).read_all()
+    metadata = { key.decode(): value.decode()
+                 for key, value in (table.schema.metadata or {}).items() }
+    return json_metadata(metadata), table.to_pandas()
+
+def read_columns_metadata(path):
+    """ Content of the metadata.json of a column directory.
+    """
+    with open("{}/metadata.json".format(path)) as file:
+        return json.load(file)
+
+def read_columns(path, memory_map=True):
+    """ Read the column directory, returns the metadata dictionary and the
+        dictionary of column arrays (memory mapped by default).
+    """
+    content = read_columns_metadata(path)
+    mmap_mode = "r" if memory_map else None
+    columns = { name: np.load("{}/{}".format(path, content["files"][name]),
+                              mmap_mode=mmap_mode)
+                for name in content["columns"] }
+    return json_metadata(content["metadata"]), columns
+
+def read(path):
+    """ Read any output file, returns the metadata dictionary and the dataframe.
+    """
+    if path.endswith(BO.formats["arrow"]):
+        return read_arrow(path)
+    elif path.endswith(BO.formats["columns"]):
+        metadata, columns = read_columns(path)
+        return metadata, pd.DataFrame(columns)
+    return read_csv(path)
+
+def read_metadata(path):
+    """ Only the metadata of any output file.
+    """
+    if path.endswith(BO.formats["arrow"]):
+        if pa is None:
+            raise ImportError("Reading Arrow output requires pyarrow")
+        schema = pa.ipc.open_file(pa.memory_map(path)).schema
+        return json_metadata({ key.decode(): value.decode()
+                               for key, value
+                               in (schema.metadata or {}).items() })
+    elif path.endswith(BO.formats["columns"]):
+        return json_metadata(read_columns_metadata(path)["metadata"])
+    with open(path, newline="") as file:
+        return read_csv_metadata(file)
+
+# ------------------------------------------------------------------------------
+
+class OutputIndex:
+    """ Persistent index (JSON file in the output directory) of all outputs
+        below the directory, with the name, energy and chiralities of each.
+        Updating only reads the metadata of new or modified files.
+    """
+    index_name = ".prew_index.json"
+    keys = ["Name", "Energy", "e-Chirality", "e+Chirality"]
+
+    def __init__(self, output_dir):
+        self.dir = output_dir
+        self.path = "{}/{}".format(output_dir, self.index_name)
+        self.entries = {}
+        try:
+            with open(self.path) as file:
+                self.entries = json.load(file)
+        except (OSError, ValueError):
+            pass
+
+    def output_paths(self):
+        """ Relative paths of all (finished) outputs below the directory.
+        """
+        paths = []
+        for dir, subdirs, files in os.walk(self.dir):
+            # Column directories are outputs themselves, skip hidden ones
+            outputs = [d for d in subdirs if d.endswith(BO.formats["columns"])
+                       and ".tmp" not in d and ".old" not in d]
+            subdirs[:] = [d for d in subdirs
+                          if not d.startswith(".") and d not in outputs]
+            files = [f for f in files if ".tmp" not in f and
+                     (f.endswith(BO.formats["csv"]) or
+                      f.endswith(BO.formats["arrow"]))]
+            paths += [os.path.relpath(os.path.join(dir, name), self.dir)
+                      for name in files + outputs]
+        return sorted(paths)
+
+    def update(self):
+        """ Bring the index up to date with the directory and save it.
+            Returns the index itself.
+        """
+        entries = {}
+        for path in self.output_paths():
+            full_path = os.path.join(self.dir, path)
+            if os.path.isdir(full_path):
+                full_path = "{}/metadata.json".format(full_path)
+            stat = os.stat(full_path)
+            entry = self.entries.get(path)
+            if entry is None or entry["size"] != stat.st_size or \
+               entry["mtime"] != stat.st_mtime_ns:
+                try:
+                    metadata = read_metadata(os.path.join(self.dir, path))
+                except (ValueError, ImportError) as error:
+                    log.debug("Not indexing {}: {}".format(path, error))
+                    continue
+                entry = { key: metadata.get(key) for key in self.keys }
+                entry.update(size=stat.st_size, mtime=stat.st_mtime_ns,
+                             validation="_valdata" in os.path.basename(path),
+                             sampled="SamplingFraction" in metadata)
+            entries[path] = entry
+        self.entries = entries
+        self.save()
+        return self
+
+    def save(self):
+        """ Write the index (atomically).
+        """
+        tmp_path = CSVM.tmp_path(self.path)
+        with open(tmp_path, "w") as file:
+            json.dump(self.entries, file, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    def find(self, name=None, energy=None, eM_chirality=None,
+             eP_chirality=None, validation=False, sampled=False,
+             format=None):
+        """ Full paths of all indexed outputs that match the given values
+            (None matches everything). Outputs of sampled quick looks are
+            only found with sampled=True (or None).
+        """
+        values = dict(zip(self.keys,
+                          [name, energy, eM_chirality, eP_chirality]))
+        paths = []
+        for path, entry in sorted(self.entries.items()):
+            if any(value is not None and entry[key] != value
+                   for key, value in values.items()):
+                continue
+            if validation is not None and entry["validation"] != validation:
+                continue
+            if sampled is not None and entry.get("sampled", False) != sampled:
+                continue
+            if format is not None and \
+               not path.endswith(BO.output_path("", format)):
+                continue
+            paths.append(os.path.join(self.dir, path))
+        return paths
+
+# ------------------------------------------------------------------------------
@@ -0,0 +1,184 @@
+import hashlib
+import json
+import logging as log
+import os
+import ROOT
+import socket
+import time
+
+# Local modules
+from PrEWInputProduction.IO import OutputHelpers as OH
+
+# ------------------------------------------------------------------------------
+
+""" Content-addressed bookkeeping of the produced distributions, so that
+    distributions whose inputs and settings didn't change are not produced
+    again.
+"""
+
+# ------------------------------------------------------------------------------
+
+input_fingerprints = {} # Cache, each input file is only inspected once per run
+
+def file_hash(path):
+    """ Hash of the contents of a (small, e.g. config) file, None if no path.
+    """
+    if path is None:
+        return None
+    with open(path, "rb") as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+def file_fingerprint(path):
+    """ Identity of a single input file: path, size, modification time and
+        the ROOT file UUID.
+    """
+    path = os.path.abspath(path)
+    if path not in input_fingerprints:
+        stat = os.stat(path)
+        root_file = ROOT.TFile.Open(path)
+        uuid = root_file.GetUUID().AsString() if root_file else None
+        if root_file:
+            root_file.Close()
+        input_fingerprints[path] = { "path": path, "size": stat.st_size,
+                                     "mtime": stat.st_mtime_ns, "uuid": uuid }
+    return input_fingerprints[path]
+
+def input_fingerprint(input):
+    """ Identity of the input: its file(s), the tree and the energy.
+    """
+    if len(input.file_paths) == 1:
+        return dict(file_fingerprint(input.file_paths[0]),
+                    tree=input.tree_name, energy=input.energy)
+    return { "files": [file_fingerprint(path) for path in input.file_paths],
+             "tree": input.tree_name, "energy": input.energy }
+
+def get_fingerprint(input, coords, cuts, syst, phys, sampling=None,
+                    output=None):
+    """ Fingerprint of everything that determines the output of a
+        distribution. The TGC configuration files enter with their contents.
+        Sampled productions (see SamplingOptions) get a different
+        fingerprint, so they are never taken as the full production.
+        Output formats other than the default CSV also enter, as does
+        switching the plots off (so that a later run with plots produces
+        them).
+    """
+    phys_content = dict(vars(phys))
+    phys_content["TGC_config_content"] = file_hash(phys.TGC_config_path)
+    phys_content["TGC_points_content"] = file_hash(phys.TGC_points_path)
+    content = {
+        "input": input_fingerprint(input),
+        "cuts": cuts,
+        "coords": [(c.name, c.n_bins, c.min, c.max) for c in coords],
+        "syst": vars(syst),
+        "phys": phys_content }
+    if sampling is not None and sampling.is_active():
+        content["sampling"] = vars(sampling)
+    if output is not None and (output.formats != ("csv",) or
+                               output.float_dtype != "float64" or
+                               not output.create_plots):
+        content["output"] = { "formats": output.formats,
+                              "float_dtype": output.float_dtype,
+                              "create_plots": output.create_plots }
+    return hashlib.sha256(
+        json.dumps(content, sort_keys=True, default=str).encode()).hexdigest()
+
+def get_key(distr_name, input):
+    """ Journal key of a distribution created from the given input.
+    """
+    if isinstance(input.file_path, str):
+        source = os.path.abspath(input.file_path)
+    else:
+        source = [os.path.abspath(path) for path in input.file_path]
+    input_id = hashlib.sha256(repr((source, input.tree_name, input.energy))
+                              .encode()).hexdigest()[:12]
+    return "{}_{}".format(distr_name, input_id)
+
+# ------------------------------------------------------------------------------
+
+class ProductionJournal:
+    """ Journal in the output directory with one entry per produced
+        distribution, containing its fingerprint and the written files.
+        Entries are only written after the distribution is complete, so a run
+        that stopped halfway resumes with the missing distributions.
+    """
+    def __init__(self, output_dir):
+        self.dir = "{}/.prew_journal".format(output_dir)
+
+    def entry_path(self, key):
+        return "{}/{}.json".format(self.dir, key)
+
+    def is_up_to_date(self, key, fingerprint):
+        """ Check if the distribution was produced with the same fingerprint
+            and all its files still exist.
+        """
+        try:
+            with open(self.entry_path(key)) as file:
+                entry = json.load(file)
+        except (OSError, ValueError):
+            return False
+        return entry.get("fingerprint") == fingerprint and \
+               all(os.path.exists(path) for path in entry.get("files", []))
+
+    def record(self, key, fingerprint, files):
+        """ Record the finished distribution (written atomically).
+        """
+        OH.create_dir(self.dir)
+        path = self.entry_path(key)
+        tmp_path = "{}.tmp{}".format(path, os.getpid())
+        with open(tmp_path, "w") as file:
+            json.dump({ "fingerprint": fingerprint, "files": files }, file,
+                      indent=2)
+        os.replace(tmp_path, path)
+        log.debug("Recorded {} in the production journal.".format(key))
+
+# ------------------------------------------------------------------------------
+
+class OutputManifest:
+    """ Manifest of the completed outputs in the output directory.
+        Every producer process appends to its own file in .prew_manifest, so
+        parallel producers need no locking. Reading merges all files, for
+        each key the latest record is used.
+    """
+    def __init__(self, output_dir):
+        self.dir = "{}/.prew_manifest".format(output_dir)
+
+    def producer_path(self):
+        return "{}/{}_{}.jsonl".format(self.dir, socket.gethostname(),
+                                       os.getpid())
+
+    def record(self, key, files):
+        """ Record the completed (and moved into place) outputs.
+        """
+        OH.create_dir(self.dir)
+        line = json.dumps({ "key": key, "files": files, "time": time.time() })
+        with open(self.producer_path(), "a") as file:
+            file.write(line + "\n")
+
+    def entries(self):
+        """ Dictionary of key -> record of all producers. Incomplete lines
+            (from a producer that was killed while writing) are ignored.
+        """
+        records = []
+        if os.path.isdir(self.dir):
+            for name in sorted(os.listdir(self.dir)):
+                if not name.endswith(".jsonl"):
+                    continue
+                with open("{}/{}".format(self.dir, name)) as file:
+                    for line in file:
+                        try:
+                            records.append(json.loads(line))
+                        except ValueError:
+                            log.debug("Skipping incomplete line in {}".format(
+                                name))
+        entries = {}
+        for record in sorted(records, key=lambda record: record["time"]):
+            entries[record["key"]] = record
+        return entries
+
+    def completed_files(self):
+        """ All recorded output files that still exist.
+        """
+        return sorted(set(path for entry in self.entries().values()
+                          for path in entry["files"] if os.path.exists(path)))
+
+# ------------------------------------------------------------------------------
@@ -0,0 +1,132 @@
+import hashlib
+import json
+import logging as log
+import os
+import re
+import time
+import ROOT
+
+# Local modules
+from PrEWInputProduction.IO import HistogramCache as HC
+from PrEWInputProduction.IO import InputHelpers as IH
+from PrEWInputProduction.IO import OutputHelpers as OH
+from PrEWInputProduction.IO import ProductionJournal as PJ
+
+# ------------------------------------------------------------------------------
+
+""" Local skims of the input trees that only contain the branches used by the
+    booked distributions, so that repeated productions read much less data.
+"""
+
+# ------------------------------------------------------------------------------
+
+def default_skim_dir():
+    """ Skim directory, can be set with the PREW_SKIM_CACHE environment
+        variable.
+    """
+    return os.environ.get("PREW_SKIM_CACHE",
+                          os.path.expanduser("~/.cache/prew_skims"))
+
+def get_chain(input):
+    """ TChain over all files of the input.
+    """
+    chain = ROOT.TChain(input.tree_name)
+    for path in input.file_paths:
+        chain.Add(path)
+    chain.LoadTree(0) # Needed to access the branches
+    return chain
+
+def needed_branches(tree, expressions):
+    """ Top-level branches of the tree that are used in any of the expressions
+        (cuts, column names, weight branch bases, ...). A leaf list branch is
+        needed if any of its leaves ("branch.leaf") is used. The metadata
+        branches are always kept.
+    """
+    tokens = set(IH.metadata_branches)
+    for expr in expressions:
+        tokens.update(re.findall(r"[A-Za-z_][\w.]*", expr))
+
+    branches = []
+    for branch in tree.GetListOfBranches():
+        name = branch.GetName()
+        if any(token == name or token.startswith(name + ".")
+               for token in tokens):
+            branches.append(name)
+    return sorted(branches)
+
+# ------------------------------------------------------------------------------
+
+class SkimCache:
+    """ Cache of skimmed inputs (one ROOT file per key, the key is the
+        fingerprint of the input files together with the kept branches, so the
+        skim is recreated if either changes).
+        The skim is compressed with LZ4 (fast to read) and uses large baskets.
+        If the total size exceeds max_size (in bytes) the least recently used
+        skims are removed after a new skim was written. Skims used since the
+        cache was created (i.e. in the current run, also by the worker
+        processes that received a copy of it) or within the grace period (in
+        seconds, e.g. by other runs) are never removed.
+    """
+    def __init__(self, skim_dir=None, max_size=100*1024**3,
+                 compression=404, basket_size=256*1024, grace_period=3600):
+        self.dir = default_skim_dir() if skim_dir is None else skim_dir
+        self.max_size = max_size
+        self.compression = compression
+        self.basket_size = basket_size
+        self.grace_period = grace_period
+        self.run_start = time.time()
+        self.used = set()
+
+    def entry_path(self, key):
+        return "{}/{}.root".format(self.dir, key)
+
+    def get(self, input, expressions):
+        """ InputInfo of the skim of the input that contains all branches used
+            in the expressions, the skim is created if it doesn't exist yet.
+        """
+        chain = get_chain(input)
+        branches = needed_branches(chain, expressions)
+        content = { "input": PJ.input_fingerprint(input),
+                    "branches": branches }
+        key = hashlib.sha256(json.dumps(content, sort_keys=True, default=str)
+                             .encode()).hexdigest()
+
+        path = self.entry_path(key)
+        self.used.add(path)
+        if os.path.isfile(path):
+            os.utime(path) # Mark as recently used
+            log.debug("Using skim {} of {}".format(path, input.file_path))
+        else:
+            self.create(chain, branches, path)
+            self.evict()
+        return IH.InputInfo(path, input.tree_name, input.energy)
+
+    def evict(self):
+        """ Remove the least recently used skims that are neither used in the
+            current run nor within the grace period.
+        """
+        keep_after = min(self.run_start, time.time() - self.grace_period)
+        HC.evict_lru(self.dir, ".root", self.max_size, keep_after, self.used)
+
+    def create(self, chain, branches, path):
+        """ Copy the branches of the chain into the skim file (written
+            atomically).
+        """
+        log.info("Skimming {} branches of {} entries into {}".format(
+            len(branches), chain.GetEntries(), path))
+        OH.create_dir(self.dir)
+        tmp_path = "{}.tmp{}.root".format(path[:-len(".root")], os.getpid())
+
+        chain.SetBranchStatus("*", 0)
+        for branch in branches:
+            chain.SetBranchStatus(branch, 1)
+
+        skim_file = ROOT.TFile(tmp_path, "RECREATE", "", self.compression)
+        skim = chain.CloneTree(0)
+        skim.SetBasketSize("*", self.basket_size)
+        skim.CopyEntries(chain)
+        skim.Write()
+        skim_file.Close()
+        os.replace(tmp_path, path)
+
+# ------------------------------------------------------------------------------
@@ -7,12 +7,16 @@ class PhysicsOptions:
   
   def __init__(self, 
                use_TGCs=False, TGC_config_path=None, TGC_points_path=None, 
-                                                     TGC_weight_base=None):
+                                                     TGC_weight_base=None,
+                                                     TGC_weight_array=None):
     """ All the potential options can be set here and are turned off by default.
+        The TGC weights are either read from the branches TGC_weight_base+i or
+        from a single RVec<double> branch TGC_weight_array.
     """
     self.use_TGCs = use_TGCs
     self.TGC_config_path = TGC_config_path
     self.TGC_points_path = TGC_points_path
     self.TGC_weight_base = TGC_weight_base
+    self.TGC_weight_array = TGC_weight_array
     
 # ------------------------------------------------------------------------------
\ No newline at end of file
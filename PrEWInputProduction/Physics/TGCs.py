@@ -1,16 +1,12 @@
 import logging as log
 import numpy as np
-import ROOT
-import scipy.optimize as opt
-import sys
-from tqdm import tqdm
 
 # Local modules
-sys.path.append("../IO")
-import OutputHelpers as OH
-import TGCConfigReader as ITCR
-sys.path.append("../ROOTHelp")
-import DistrHelpers as DH
+from PrEWInputProduction.Fitting import LinearFits as LF
+from PrEWInputProduction.IO import OutputHelpers as OH
+from PrEWInputProduction.IO import TGCConfigReader as ITCR
+from PrEWInputProduction.ROOTHelp import DistrHelpers as DH
+from PrEWInputProduction.ROOTHelp import RDFActions as RA
   
 # ------------------------------------------------------------------------------
 
@@ -27,105 +23,54 @@ def TGC_factor(TGC_dev, k_g, k_k, k_l, k_g2, k_k2, k_l2, k_gk, k_gl, k_kl):
          
 # ------------------------------------------------------------------------------
   
-def get_init_coef_guess(TGC_dev_points, R):
-  """ Get an initial guess for the 9 coefficients of the TGC polynomial,
-      using 9 deviation points and solving the linear system.
+def TGC_design(TGC_dev_points):
+  """ Design matrix of the (linear in the coefficients) TGC factor minus one for
+      the given deviation points, the columns belong to the coefficients in the
+      order of the TGC_factor arguments.
   """
-  if len(TGC_dev_points) != 9:
-    raise Exception("Need exactly 9 points")
-    
-  dg = TGC_dev_points[:,0]
-  dk = TGC_dev_points[:,1]
-  dl = TGC_dev_points[:,2]
-  
-  # Calculate the polynomial points (compare "TGC_factor" function)
-  pol_point_arr = np.stack([ dg, dk, dl,
-                             dg**2, dk**2, dl**2,
-                             dg * dk, dg * dl, dk * dl ], axis=1)
-  
-  return np.linalg.solve(pol_point_arr, R-1.0)
-  
-  
-def get_fitted_coefs(TGC_dev_points, R, sigma):
-  """ Perform fit to extract the coefficients of the 3D quadratic polynomial
-      using a wider array of points:
-      - First get an initial estimate for the coef's by solving the exact 
-        equation system for the first 9 point
-      - First try to estimate an uncertainty on the bin values using the 
-        MC statistics uncertainty
-      - Check if that leads to a good initial chi^2, if not scale the 
-        uncertainties
-      - Then perform fit using all points
-      Needs:
-        TGC_dev_points ... TGC deviation points (d g1z, d ka, d la)
-        R ... ration wrt. SM at each point
-        sigma ... estimation of uncertainty on R at each point
-  """
-  TGC_dev_points = np.array(TGC_dev_points)
-  R = np.array(R)
-  sigma = np.array(sigma)
-  
-  # Solve linear equation system for first 9 points to get intial coefs
-  coefs_ini = get_init_coef_guess(TGC_dev_points[:9], R[:9])
-  
-  # Determine fit starting point
-  R_prefit = TGC_factor(TGC_dev_points, *coefs_ini) # * converts array to args
-      
-  # Perform fit
-  coefs, cov = opt.curve_fit(TGC_factor, TGC_dev_points, R, sigma=sigma, p0=coefs_ini)
-  return coefs
+  dg, dk, dl = np.transpose(TGC_dev_points)
+  return np.stack([ dg, dk, dl,
+                    dg**2, dk**2, dl**2,
+                    dg * dk, dg * dl, dk * dl ], axis=1)
 
 # ------------------------------------------------------------------------------
 
-def get_coef_data(hist_SM, hists_dev, TGC_dev_points):
+def get_coef_data(N_SM, N_dev, sumw2_dev, TGC_dev_points):
   """ Calculate all the coefficients and return them in a dictionary that can be
       written out by pandas into CSV.
-      A two step approach is used:
-        1. Six specific cuts are used to solve the linear equations for a first
-           estimate of the coefficients.
-        2. Using the first estimates as starting values, and a larger number of
-           cuts, a fit is performed to get more accurate coefficients.
-      Seven histograms are needed for the first step:
-        - original without any cut at all
-        - 6 histograms with cuts at predetermined points to determine the
-          polynomial coefficients.
+      The TGC factor is linear in the coefficients, so the fit of the ratios 
+      wrt. the SM in each bin is a weighted linear least-squares problem which
+      is solved for all bins at once.
+      The bin contents are needed as arrays:
+        - N_SM: Standard Model (unweighted) (n_bins)
+        - N_dev: weighted with the weights of each deviation point (P x n_bins)
+        - sumw2_dev: sum of squared weights for each deviation point 
+                     (P x n_bins)
   """
-  coefs = []
+  N_SM = np.asarray(N_SM, dtype=float)
+  N_dev = np.asarray(N_dev, dtype=float)
+  sumw2_dev = np.asarray(sumw2_dev, dtype=float)
+  coefs = np.zeros((len(N_SM), 9))
+  
+  # Check that there's at least one event
+  insufficient = N_SM < 0.5
+  insufficient_MC_bins = np.count_nonzero(insufficient)
   
-  # Doing this in loop instead of with TH1-operators to control each case
-  bin_range = DH.get_bin_range(hist_SM)
-  insufficient_MC_bins = 0 # Count the number of bins w/ insufficient MC
-  for bin in tqdm(bin_range, desc="Calculate TGC coef's"):
-    # Skip overflow and underflow bins
-    if hist_SM.IsBinUnderflow(bin) or hist_SM.IsBinOverflow(bin): 
-      continue
-      
-    N_SM = hist_SM.GetBinContent(bin)
+  fit = ~insufficient
+  if np.any(fit):
+    N = N_SM[fit]
     
-    # Check that there's at least one event
-    if (N_SM < 0.5):
-      bin_coefs = np.zeros(9)
-      if coefs:
-        coefs.append(bin_coefs)
-      else:
-        coefs = [bin_coefs]
-      insufficient_MC_bins += 1
-      continue 
-      
-    # Ratios in this bin for each histogram (with different cut points)
-    R = np.array([float(hist.GetBinContent(bin)) / N_SM for hist in hists_dev])
+    # Ratios in each bin for each deviation point
+    R = N_dev[:,fit] / N
     
-    # Estimate the uncertainty on the ratio
-    bin_unc = lambda hist: np.sqrt(float(hist.GetBinError(bin)**2 - hist.GetBinContent(bin)**2/N_SM) / (N_SM * (N_SM-1)))
-    sigma = np.array([bin_unc(hist) if N_SM > 1 else float(hist.GetBinError(bin)) for hist in hists_dev])
+    # Estimate the uncertainty on the ratio (only possible with >1 event)
+    with np.errstate(divide="ignore", invalid="ignore"):
+      bin_unc = np.sqrt((sumw2_dev[:,fit] - N_dev[:,fit]**2/N) / (N * (N-1)))
+    sigma = np.where(N > 1, bin_unc, np.sqrt(sumw2_dev[:,fit]))
     
     # Extract the coefficients
-    bin_coefs = get_fitted_coefs(TGC_dev_points, R, sigma)
-    
-    if coefs:
-      coefs.append(bin_coefs)
-    else:
-      coefs = [bin_coefs]
+    coefs[fit] = LF.batched_weighted_lstsq(TGC_design(TGC_dev_points), 
+                                           R - 1.0, sigma)
 
   if (insufficient_MC_bins > 0):
     log.info("Had to skip {} bins due to insufficient MC.".format(insufficient_MC_bins))
@@ -133,7 +78,6 @@ def get_coef_data(hist_SM, hists_dev, TGC_dev_points):
   coef_base = "TGC"
   coef_names = ["k_g","k_k","k_l","k_g2","k_k2","k_l2","k_gk","k_gl","k_kl"]
   coef_dict = {}
-  coefs = np.array(coefs)
   for c in range(len(coef_names)):
     coef_name = "{}_{}".format(coef_base, coef_names[c])
     coef_dict[coef_name] = coefs[:,c]
@@ -148,7 +92,7 @@ class TGCParametrisation:
   """
   
   def __init__(self, rdf, coords, TGC_config_path, TGC_points_path, distr_name, 
-               w_branch_base):
+               w_branch_base, w_array=None):
     """ Constructor takes:
          rdf : RDataFrame that hold all events
          coords : coordinates of the n-dimensional distribution
@@ -156,37 +100,51 @@ class TGCParametrisation:
          TGC_points_path : path to the file that contains the TGC dev. points
          distr_name : name of the distribution
          w_branch_base : base of the weight branches
+         w_array : (optional) single RVec<double> branch with all weights, 
+                   used instead of the separate weight branches
+        Without dataframe (rdf=None) nothing is booked and the result pointers
+        have to be set from cached results.
     """
+    # Read the TGC configuration file
+    tcr = ITCR.TGCConfigReader(TGC_config_path, TGC_points_path)
+    self.TGC_dev_points = tcr.scale * tcr.dev_points
+    
+    if rdf is None:
+      self.histptr_SM = None
+      self.histptr_dev = None
+      return
+    
     # Ignore any events with 0 weights 
     # (here test by 0.01 because only small deviations are tested so all weights
     #  will be around 1)
-    rdf_trimmed = rdf.Filter("{}1 > 0.01".format(w_branch_base))
+    if w_array:
+      rdf_trimmed = rdf.Filter("{}[1] > 0.01".format(w_array))
+    else:
+      rdf_trimmed = rdf.Filter("{}1 > 0.01".format(w_branch_base))
     
     # Histogram for the Standard Model case
     self.histptr_SM =  DH.get_hist_ptr(rdf_trimmed, distr_name + "_SM", coords)
-
-    # Read the TGC configuration file
-    tcr = ITCR.TGCConfigReader(TGC_config_path, TGC_points_path)
-    self.TGC_dev_points = tcr.scale * tcr.dev_points
     
-    # Create the histograms for each TGC deviation point
-    ROOT.TH1.SetDefaultSumw2() # Make sure the weight square errors are tracked
-    self.histptrs_dev = []
-    for p in range(len(self.TGC_dev_points)):
-      w_branch = "{}{}".format(w_branch_base, p)
-      self.histptrs_dev.append( 
-        DH.get_hist_ptr(rdf_trimmed, 
-                        distr_name + "_TGC_dev_".format(p), coords, w_branch) )
+    # All TGC deviation points are filled in a single multi-weight action
+    if w_array:
+      w_branches = w_array
+    else:
+      w_branches = ["{}{}".format(w_branch_base, p) 
+                    for p in range(len(self.TGC_dev_points))]
+    self.histptr_dev = RA.get_multi_weight_ptr(
+      rdf_trimmed, distr_name + "_TGC_dev", coords, w_branches,
+      len(self.TGC_dev_points))
   
-  def add_coefs_to_data(self, distr_data):
+  def add_coefs_to_data(self, distr_data, bins=None):
     """ Parametrisation uses 2nd order polynomial approach for 2 parameters.
         Details are not described here (probably in PrEW, else in thesis).
-        Coefficients are added to data.
+        Coefficients are added to data (for the given flat bin indices if the
+        data only contains those bins).
     """
-    hist_SM = self.histptr_SM.GetValue()
-    hists_dev = [histptr.GetValue() for histptr in self.histptrs_dev]
+    N_SM = DH.get_values(self.histptr_SM.GetValue(), bins)
+    N_dev, sumw2_dev = self.histptr_dev.GetValue(bins)
     
-    coef_data = get_coef_data(hist_SM, hists_dev, self.TGC_dev_points)
+    coef_data = get_coef_data(N_SM, N_dev, sumw2_dev, self.TGC_dev_points)
     
     for coef_name, coefs in coef_data.items():
         distr_data["Coef:{}".format(coef_name)] = coefs
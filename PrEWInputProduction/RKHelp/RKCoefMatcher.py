@@ -1,9 +1,13 @@
 from copy import copy
 import logging as log
 import numpy as np
-from tqdm import tqdm
 
-import RKDistrReader as RKDR
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
+from PrEWInputProduction.RKHelp import RKDistrReader as RKDR
 
 # ------------------------------------------------------------------------------
 
@@ -33,14 +37,19 @@ class RKCoefMatcher:
       "WW_semilep_AntiMuNu" : lambda x: np.array([x[0], x[1], (x[2] - np.pi) * 9.0/10.0])
     }
     
+    # Maximum difference of each bin center coordinate for matching bins
+    match_tolerance = 0.001
+    
     def __init__(self, RK_distrs=None):
         self.RK_distrs = [] if (RK_distrs == None) else RK_distrs
+        self.bin_indices = {} # Lookup of the (manipulated) RK bin centers
         
     def add_RK_file(self, file_path, tree_name):
         """ Use the RK distributions from the tree in the given file.
         """
         for distr in RKDR.RKDistrReader(file_path, tree_name).distrs:
             self.RK_distrs.append(distr)
+        self.bin_indices = {}
 
     def get_distr(self, name):
         """ Return the distribution of the given name.
@@ -58,6 +67,61 @@ class RKCoefMatcher:
           
         return found_distrs[0]    
 
+    def get_RK_coords(self, RK_name):
+        """ Bin centers of the RK distribution, manipulated if needed (see
+            RK_bin_manipulator).
+        """
+        RK_coords = copy(self.get_distr(RK_name).bin_centers) # Copy RK bin center array
+        
+        # See if bins are supposed to be manipulated
+        if RK_name in self.RK_bin_manipulator:
+          log.debug("Got bin manipulator.")
+          bin_manipulator = self.RK_bin_manipulator[RK_name]
+          RK_coords = np.apply_along_axis(bin_manipulator, axis=1, arr=RK_coords)
+        return RK_coords
+        
+    def get_bin_index(self, RK_name):
+        """ Lookup structure of the RK bin centers, only built once per 
+            distribution: a KD-tree if scipy is available, otherwise the 
+            coordinate array itself.
+        """
+        if not RK_name in self.bin_indices:
+            RK_coords = self.get_RK_coords(RK_name)
+            self.bin_indices[RK_name] = (RK_coords, cKDTree(RK_coords) if cKDTree is not None else None)
+        return self.bin_indices[RK_name]
+        
+    def match_bins(self, RK_name, coords):
+        """ Indices of the RK bins whose centers match the given bin centers
+            (rows of coords) within the match tolerance in every coordinate.
+            Each bin needs exactly one matching RK bin.
+        """
+        RK_coords, tree = self.get_bin_index(RK_name)
+        tol = self.match_tolerance
+        if tree is not None:
+            # Two nearest neighbours in the max-norm, the second one must not match
+            distances, neighbours = tree.query(coords, k=2, p=np.inf, distance_upper_bound=tol)
+            n_found = np.sum(distances < tol, axis=1)
+        else:
+            # Brute force comparison, in chunks to limit the memory
+            n_found = np.zeros(len(coords), dtype=int)
+            neighbours = np.zeros((len(coords), 2), dtype=int)
+            chunk_size = max(1, 2**22 // max(1, RK_coords.size))
+            for start in range(0, len(coords), chunk_size):
+                chunk = coords[start:start+chunk_size]
+                matches = np.all(np.absolute(RK_coords[None,:,:] - chunk[:,None,:]) < tol, axis=2)
+                n_found[start:start+chunk_size] = np.sum(matches, axis=1)
+                neighbours[start:start+chunk_size,0] = np.argmax(matches, axis=1)
+        
+        # Check if exactly one index was found
+        for b in np.where(n_found != 1)[0]:
+            if n_found[b] == 0:
+              raise ValueError("Didn't find matching bin {} \nAvailable bins : {}".format(coords[b],RK_coords))
+            else:
+              indices = np.where(np.all(np.absolute(RK_coords - coords[b]) < tol, axis=1))[0]
+              raise ValueError("Found more than one fitting bin for {}: {}".format(coords[b],[RK_coords[i] for i in indices]))
+        log.debug("Found indices for {} bins.".format(len(coords)))
+        return neighbours[:,0]
+
     def add_coefs_to_data(self, distr_name, eM_chirality, eP_chirality, distr_data):
         """ Add the correct coefficients to the given distribution.
             Needs the distribution data which contains the bins.
@@ -70,57 +134,27 @@ class RKCoefMatcher:
         
         RK_name = self.MC_to_RK_names[distr_name]
         RK_distr = self.get_distr(RK_name)
-        RK_coords = copy(RK_distr.bin_centers) # Copy RK bin center array
-          
-        # See if bins are supposed to be manipulated
-        bin_manipulator = False
-        if RK_name in self.RK_bin_manipulator:
-          log.debug("Got bin manipulator.")
-          bin_manipulator = self.RK_bin_manipulator[RK_name]
-          RK_coords = np.apply_along_axis(bin_manipulator, axis=1, arr=RK_coords)
         
-        # Dictionary for collecting the coefficients in the right order
-        coef_dict = {}
-        for coef_label in RK_distr.coef_labels:
-            coef_dict[coef_label] = []
+        # Find the RK bin for each bin (all at once)
+        coords = np.column_stack([distr_data["BinCenters:{}".format(coord_name)] for coord_name in self.RK_binning[RK_name]])
+        indices = self.match_bins(RK_name, coords)
         
-        # Find the coefficients for each bin
-        bin_range = range(len(distr_data["Cross sections"]))
-        for b in tqdm(bin_range, desc="\tMatching RK coefs"):
-            # Get the (adjusted coordinates) of
-            coords = [distr_data["BinCenters:{}".format(coord_name)][b] for coord_name in self.RK_binning[RK_name]]
-            
-            # Find the correct bin
-            index = None
-            diff = np.absolute( RK_coords - coords )
-            diff_check = np.all(diff < 0.001, axis=1) # Check which coordinates match up
-            indices = np.where(diff_check)[0]
-            
-            # Check if exactly one index was found
-            if len(indices) == 0:
-              raise ValueError("Didn't find matching bin {} \nAvailable bins : {}".format(coords,RK_coords))
-            elif (len(indices) > 1):
-              raise ValueError("Found more than one fitting bin for {}: {}".format(coords,[RK_coords[i] for i in indices]))
-            else:
-              log.debug("Found index for bin {}.".format(b))
-              
-            index = indices[0]
-            
-            # Find and add the appropriate coefs from the RK distribution
-            for co in range(len(RK_distr.coef_labels)):
-                coef = None
-                if (eM_chirality == -1) and (eP_chirality == +1):
-                    coef = RK_distr.coefs_LR[index][co]
-                elif (eM_chirality == +1) and (eP_chirality == -1):
-                    coef = RK_distr.coefs_RL[index][co]
-                elif (eM_chirality == -1) and (eP_chirality == -1):
-                    coef = RK_distr.coefs_LL[index][co]
-                elif (eM_chirality == +1) and (eP_chirality == +1):
-                    coef = RK_distr.coefs_RR[index][co]
-                else:
-                    raise ValueError("Unknown chiralities {} {}".format(eM_chirality, eP_chirality))
-                    
-                coef_dict[RK_distr.coef_labels[co]].append(coef)
+        # Take the coefficients of all bins from the appropriate chiralities
+        if (eM_chirality == -1) and (eP_chirality == +1):
+            RK_coefs = RK_distr.coefs_LR
+        elif (eM_chirality == +1) and (eP_chirality == -1):
+            RK_coefs = RK_distr.coefs_RL
+        elif (eM_chirality == -1) and (eP_chirality == -1):
+            RK_coefs = RK_distr.coefs_LL
+        elif (eM_chirality == +1) and (eP_chirality == +1):
+            RK_coefs = RK_distr.coefs_RR
+        else:
+            raise ValueError("Unknown chiralities {} {}".format(eM_chirality, eP_chirality))
+        coefs = np.asarray(RK_coefs)[indices]
+        
+        coef_dict = {}
+        for co, coef_label in enumerate(RK_distr.coef_labels):
+            coef_dict[coef_label] = coefs[:,co]
             
         # Add the coefficients to the distribution data
         for coef_name, coefs in coef_dict.items():
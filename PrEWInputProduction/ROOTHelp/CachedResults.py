@@ -0,0 +1,133 @@
+import json
+import numbers
+import numpy as np
+
+# Local modules
+from PrEWInputProduction.ROOTHelp import ColumnarFrame as CF
+from PrEWInputProduction.ROOTHelp import DistrHelpers as DH
+
+# ------------------------------------------------------------------------------
+
+""" Conversion of filled results (numbers, histograms and binned variation
+    results) to plain arrays and back, so that they can be stored outside of
+    the event loop (see IO/HistogramCache).
+    Binned variation results (e.g. the stacked muon acceptance cuts or the TGC
+    weights) are stored for the bins that are used in the output.
+"""
+
+# ------------------------------------------------------------------------------
+
+class ArrayPtr:
+    """ Result pointer for an already known value.
+    """
+    def __init__(self, value):
+        self.value = value
+
+    def GetValue(self):
+        return self.value
+
+    def GetPtr(self):
+        return self.value
+
+class BinnedArrayPtr:
+    """ Result pointer of a binned variation result that was stored for the
+        given flat bin indices, same interface as RDFActions.StackedHistPtr
+        (or MultiWeightPtr if multiple arrays are stored).
+    """
+    def __init__(self, bins, arrays):
+        self.bins = np.asarray(bins, dtype=np.int64)
+        self.arrays = arrays
+
+    def GetValue(self, bins=None):
+        if bins is None:
+            bins = self.bins
+        bins = np.asarray(bins, dtype=np.int64)
+        if len(self.bins) == 0:
+            values = [np.zeros((len(array), len(bins))) for array in self.arrays]
+        else:
+            pos = np.minimum(np.searchsorted(self.bins, bins), len(self.bins)-1)
+            found = self.bins[pos] == bins
+            values = [np.where(found, array[:,pos], 0.0)
+                      for array in self.arrays]
+        return values[0] if len(values) == 1 else tuple(values)
+
+# ------------------------------------------------------------------------------
+
+def hist_model(hist):
+    """ Histo*D model tuple (name, title, n_bins, min, max per axis) of the
+        fixed-width ROOT histogram.
+    """
+    model = [hist.GetName(), hist.GetTitle()]
+    for axis in DH.get_axes(hist):
+        model += [axis.GetNbins(), axis.GetXmin(), axis.GetXmax()]
+    return model
+
+def to_arrays(name, ptr, bins=None, binned=False):
+    """ Arrays that describe the value of the result pointer, the keys start
+        with the given name. Binned results are evaluated for the given bins.
+    """
+    if binned:
+        values = ptr.GetValue(bins)
+        values = values if isinstance(values, tuple) else (values,)
+        arrays = { "{}:kind".format(name): np.array("binned"),
+                   "{}:bins".format(name): np.asarray(bins, dtype=np.int64) }
+        for i, array in enumerate(values):
+            arrays["{}:array{}".format(name, i)] = array
+        return arrays
+
+    value = ptr.GetValue()
+    if isinstance(value, numbers.Number):
+        return { "{}:kind".format(name): np.array("number"),
+                 "{}:value".format(name): np.array(value) }
+    if isinstance(value, DH.SparseHist):
+        coords = [(c.name, c.n_bins, c.min, c.max) for c in value.coords]
+        return { "{}:kind".format(name): np.array("sparse"),
+                 "{}:name".format(name): np.array(value.name),
+                 "{}:coords".format(name): np.array(json.dumps(coords)),
+                 "{}:bins".format(name): value.bins,
+                 "{}:values".format(name): value.values,
+                 "{}:sumw2".format(name): value.sumw2 }
+
+    # ROOT histogram, stored with under- and overflow
+    n_cells = value.GetNcells()
+    sumw2 = np.array([])
+    if value.GetSumw2N() > 0:
+        sumw2 = DH.as_numpy(value.GetSumw2().GetArray(), n_cells).copy()
+    return { "{}:kind".format(name): np.array("hist"),
+             "{}:model".format(name): np.array(json.dumps(hist_model(value))),
+             "{}:cells".format(name):
+               DH.as_numpy(value.GetArray(), n_cells).copy(),
+             "{}:sumw2".format(name): sumw2,
+             "{}:entries".format(name): np.array(value.GetEntries()) }
+
+def from_arrays(name, arrays):
+    """ Result pointer for the arrays created by to_arrays.
+    """
+    kind = str(arrays["{}:kind".format(name)])
+    if kind == "binned":
+        n_arrays = len([key for key in arrays
+                        if key.startswith("{}:array".format(name))])
+        return BinnedArrayPtr(arrays["{}:bins".format(name)],
+                              [ arrays["{}:array{}".format(name, i)]
+                                for i in range(n_arrays) ])
+    elif kind == "number":
+        return ArrayPtr(arrays["{}:value".format(name)].item())
+    elif kind == "sparse":
+        coords = [ DH.Coordinate(*coord) for coord
+                   in json.loads(str(arrays["{}:coords".format(name)])) ]
+        return ArrayPtr(DH.SparseHist(str(arrays["{}:name".format(name)]),
+                                      coords,
+                                      arrays["{}:bins".format(name)],
+                                      arrays["{}:values".format(name)],
+                                      arrays["{}:sumw2".format(name)]))
+    elif kind == "hist":
+        model = json.loads(str(arrays["{}:model".format(name)]))
+        sumw2 = arrays["{}:sumw2".format(name)]
+        return ArrayPtr(CF.array_to_hist(tuple(model),
+                                         arrays["{}:cells".format(name)],
+                                         sumw2 if len(sumw2) > 0 else None,
+                                         float(arrays["{}:entries".format(name)])))
+    else:
+        raise ValueError("Unknown cached result kind: {}".format(kind))
+
+# ------------------------------------------------------------------------------
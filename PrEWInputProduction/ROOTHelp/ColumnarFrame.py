@@ -0,0 +1,450 @@
+import logging as log
+import numpy as np
+import ROOT
+
+# Local modules
+from PrEWInputProduction.ROOTHelp import DistrHelpers as DH
+from PrEWInputProduction.ROOTHelp import RDFActions as RA
+from PrEWInputProduction.ROOTHelp import RDFBooking as RB
+
+# ------------------------------------------------------------------------------
+
+""" Columnar (NumPy) engine with the same booking interface as the RDataFrame
+    nodes used by the histogram helpers.
+    All needed columns are loaded once (in a single RDataFrame.AsNumpy event
+    loop), cuts become boolean masks and all histograms are filled with
+    np.bincount on bin indices that are calculated only once per coordinate
+    set and reused for every cut and weight variation.
+    C++ filter and define expressions are still evaluated by the RDataFrame
+    (as columns in the same event loop), so their semantics don't change.
+"""
+
+# ------------------------------------------------------------------------------
+
+def axis_bins(values, n, min, max):
+    """ ROOT bin index (0 underflow, n+1 overflow) on a fixed-width axis, same
+        convention as TAxis::FindFixBin (NaN is overflow).
+    """
+    values = np.asarray(values, dtype=np.float64)
+    bins = np.full(len(values), n+1, dtype=np.int64)
+    bins[values < min] = 0
+    inside = (values >= min) & (values < max)
+    bins[inside] = 1 + (n * (values[inside] - min) / (max - min)).astype(np.int64)
+    return bins
+
+def coords_from_model(model, columns):
+    """ Coordinates described by a Histo*D model tuple and the columns filled.
+    """
+    dim = (len(model) - 2) // 3
+    return [ DH.Coordinate(columns[d], *model[2+3*d:5+3*d]) for d in range(dim) ]
+
+def array_to_hist(model, cells, sumw2, n_entries):
+    """ Create the ROOT histogram for the model tuple with the given cell
+        contents (ROOT order, incl. under- and overflow).
+    """
+    dim = (len(model) - 2) // 3
+    hist = [ROOT.TH1D, ROOT.TH2D, ROOT.TH3D][dim-1](*model)
+    hist.SetDirectory(ROOT.nullptr) # Same as RDataFrame results
+    n_cells = hist.GetNcells()
+    DH.as_numpy(hist.GetArray(), n_cells)[:] = cells
+    if sumw2 is not None:
+        hist.Sumw2()
+        hist_sumw2 = hist.GetSumw2()
+        DH.as_numpy(hist_sumw2.GetArray(), n_cells)[:] = sumw2
+    hist.SetEntries(n_entries)
+    return hist
+
+def filled_bin_sums(bins, weights):
+    """ Unique filled bins (bins < 0 are ignored) with the sum of weights and
+        sum of squared weights.
+    """
+    inside = bins >= 0
+    bins = bins[inside]
+    weights = np.ones(len(bins)) if weights is None else weights[inside]
+    filled, inverse = np.unique(bins, return_inverse=True)
+    sumw = np.bincount(inverse, weights=weights, minlength=len(filled))
+    sumw2 = np.bincount(inverse, weights=weights**2, minlength=len(filled))
+    return filled, sumw, sumw2
+
+# ------------------------------------------------------------------------------
+
+class ColumnarResult:
+    """ Lazy result of the columnar engine, loads the columns and calculates
+        the value on first access.
+    """
+    def __init__(self, calculate):
+        self.calculate = calculate
+        self.value = None
+        self.done = False
+
+    def GetValue(self):
+        if not self.done:
+            self.value = self.calculate()
+            self.done = True
+        return self.value
+
+    def GetPtr(self):
+        return self.GetValue()
+
+class TakeAction:
+    """ Mimics RDataFrame.Take[type](column), the type is only used for the
+        conversion of the loaded column.
+    """
+    def __init__(self, node):
+        self.node = node
+
+    def __getitem__(self, column_type):
+        dtypes = { "double": np.float64, "float": np.float32,
+                   "long long": np.int64, "int": np.int32, "bool": bool }
+        return lambda column: self.node.get_result(
+            ("Take", column),
+            lambda: self.node.masked(
+                      self.node.column(column)).astype(dtypes[column_type]),
+            [column])
+
+class MultiWeightColumnarResult:
+    """ Multi-weight result with the same interface as 
+        RDFActions.MultiWeightPtr. Only the filled bins are stored.
+    """
+    def __init__(self, result, n_bins):
+        self.result = result
+        self.n_bins = n_bins
+
+    def GetValue(self, bins=None):
+        filled, sumw, sumw2 = self.result.GetValue()
+        if bins is None:
+            bins = np.arange(self.n_bins)
+        bins = np.asarray(bins, dtype=np.int64)
+        if len(filled) == 0:
+            return np.zeros((len(sumw), len(bins))), \
+                   np.zeros((len(sumw), len(bins)))
+        pos = np.minimum(np.searchsorted(filled, bins), len(filled)-1)
+        found = filled[pos] == bins
+        return np.where(found, sumw[:,pos], 0.0), \
+               np.where(found, sumw2[:,pos], 0.0)
+
+class StackedColumnarResult:
+    """ Stacked cut-variation result with the same interface as
+        RDFActions.StackedHistPtr. Only the filled bins are stored.
+    """
+    def __init__(self, result, n_bins):
+        self.result = result
+        self.n_bins = n_bins
+
+    def GetValue(self, bins=None):
+        filled, values = self.result.GetValue()
+        if bins is None:
+            bins = np.arange(self.n_bins)
+        bins = np.asarray(bins, dtype=np.int64)
+        if len(filled) == 0:
+            return np.zeros((len(values), len(bins)))
+        pos = np.minimum(np.searchsorted(filled, bins), len(filled)-1)
+        return np.where(filled[pos] == bins, values[:,pos], 0.0)
+
+# ------------------------------------------------------------------------------
+
+class ColumnarData:
+    """ Column store of one input that is shared between all nodes. Columns
+        are requested while booking and loaded together on first access.
+    """
+    def __init__(self, rdf):
+        self.rdf = rdf # Root node with all defined columns
+        self.defines = {}
+        self.requested = set()
+        self.columns = {}
+        self.bins = {}
+        self.nodes = {}
+        self.results = {}
+        self.n_reused = 0
+        self.n_loads = 0
+
+    def n_booked(self):
+        """ Number of distinct nodes and results that were booked.
+        """
+        return len(self.nodes) + len(self.results)
+
+    def define(self, name, expr):
+        """ Define the column on the root node (only once per name).
+        """
+        if name in self.defines:
+            if self.defines[name] != RB.canonical_expr(expr):
+                raise ValueError("Column {} already defined as {}".format(
+                                 name, self.defines[name]))
+            return
+        self.defines[name] = RB.canonical_expr(expr)
+        self.rdf = self.rdf.Define(name, expr)
+
+    def request(self, columns):
+        self.requested.update(columns)
+
+    def load(self):
+        """ Load all requested columns that are not loaded yet (one event loop).
+        """
+        missing = sorted(self.requested - set(self.columns))
+        if len(missing) == 0:
+            return
+        self.n_loads += 1
+        log.debug("Loading {} columns (event loop {}).".format(
+                  len(missing), self.n_loads))
+        arrays = self.rdf.AsNumpy(missing)
+        for column in missing:
+            self.columns[column] = np.asarray(arrays[column])
+
+    def column(self, column):
+        self.request([column])
+        self.load()
+        return self.columns[column]
+
+    def axis_bins(self, coord):
+        """ ROOT bin index of all events on the coordinate axis, calculated
+            once and reused by all histograms.
+        """
+        key = (coord.name, coord.n_bins, coord.min, coord.max)
+        if key not in self.bins:
+            self.bins[key] = axis_bins(self.column(coord.name), coord.n_bins,
+                                       coord.min, coord.max)
+        return self.bins[key]
+
+    def flat_bins(self, coords):
+        """ Flat bin index (without under- and overflow, first axis varies
+            slowest, -1 if outside any axis) of all events.
+        """
+        key = ("flat",) + tuple((c.name, c.n_bins, c.min, c.max)
+                                for c in coords)
+        if key not in self.bins:
+            flat = np.zeros(len(self.axis_bins(coords[0])), dtype=np.int64)
+            outside = np.zeros(len(flat), dtype=bool)
+            for coord in coords:
+                bins = self.axis_bins(coord)
+                outside |= (bins == 0) | (bins == coord.n_bins + 1)
+                flat = flat * coord.n_bins + (bins - 1)
+            flat[outside] = -1
+            self.bins[key] = flat
+        return self.bins[key]
+
+    def root_bins(self, coords):
+        """ ROOT global bin index (incl. under- and overflow, x varies fastest)
+            of all events.
+        """
+        key = ("root",) + tuple((c.name, c.n_bins, c.min, c.max)
+                                for c in coords)
+        if key not in self.bins:
+            global_bin = np.zeros(len(self.axis_bins(coords[0])), dtype=np.int64)
+            for coord in reversed(coords):
+                global_bin = global_bin * (coord.n_bins + 2) \
+                             + self.axis_bins(coord)
+            self.bins[key] = global_bin
+        return self.bins[key]
+
+# ------------------------------------------------------------------------------
+
+class ColumnarRDF:
+    """ Node of the columnar engine: a set of cuts (boolean mask columns) on the
+        shared column store. Provides the RDataFrame methods used by the
+        histogram helpers, identical cuts and results are only booked once.
+    """
+    def __init__(self, rdf, data=None, masks=frozenset()):
+        self.data = ColumnarData(rdf) if data is None else data
+        self.cache = self.data # Same statistics interface as RDFBooking
+        self.masks = masks
+        self.mask_values = None
+        self.data.nodes[masks] = self
+
+    def get_result(self, key, calculate, columns=[]):
+        """ Return the result with the given key, book it if it doesn't exist.
+        """
+        key = (self.masks,) + key
+        if key in self.data.results:
+            self.data.n_reused += 1
+        else:
+            self.data.request(list(columns) + sorted(self.masks))
+            self.data.results[key] = ColumnarResult(calculate)
+        return self.data.results[key]
+
+    def column(self, column):
+        return self.data.column(column)
+
+    def mask(self):
+        """ Boolean mask of the events that pass all cuts of this node (None if
+            there are no cuts), calculated once.
+        """
+        if self.masks and self.mask_values is None:
+            self.mask_values = np.logical_and.reduce(
+              [self.column(mask_column) for mask_column in sorted(self.masks)])
+        return self.mask_values
+
+    def masked(self, values):
+        mask = self.mask()
+        return values if mask is None else values[mask]
+
+    def weights(self, w_branch):
+        if not w_branch:
+            return None
+        return self.masked(self.column(w_branch)).astype(np.float64)
+
+    # --- RDataFrame interface -------------------------------------------------
+
+    def Filter(self, expr, *args):
+        # The canonical terms identify the masks, an expression that isn't
+        # split into several terms is evaluated exactly as given
+        masks = set(self.masks)
+        terms = RB.canonical_terms(expr)
+        for term in terms:
+            mask_column = "prew_mask_{}".format(RA.unique_id(term))
+            mask_expr = expr if len(terms) == 1 else term
+            self.data.define(mask_column, "({})".format(mask_expr))
+            masks.add(mask_column)
+        masks = frozenset(masks)
+        if masks in self.data.nodes:
+            self.data.n_reused += 1
+            return self.data.nodes[masks]
+        return ColumnarRDF(None, self.data, masks)
+
+    def Define(self, name, expr):
+        RA.declare_helpers() # Expressions may use the C++ helpers
+        self.data.define(name, expr)
+        return self
+
+    def Count(self):
+        self.data.define("prew_event", "true")
+        return self.get_result(("Count",),
+                               lambda: len(self.masked(
+                                 self.column("prew_event"))),
+                               ["prew_event"])
+
+    def Mean(self, column):
+        return self.get_result(("Mean", column),
+                               lambda: float(np.mean(self.masked(
+                                 self.column(column).astype(np.float64)))),
+                               [column])
+
+    def Sum(self, column):
+        return self.get_result(("Sum", column),
+                               lambda: float(np.sum(self.masked(
+                                 self.column(column).astype(np.float64)))),
+                               [column])
+
+    @property
+    def Take(self):
+        return TakeAction(self)
+
+    def histo(self, model, *columns):
+        """ ROOT histogram from a Histo*D model and the filled (and optional
+            weight) columns.
+        """
+        coords = coords_from_model(model, columns)
+        w_branch = columns[len(coords)] if len(columns) > len(coords) else None
+
+        def calculate():
+            bins = self.masked(self.data.root_bins(coords))
+            weights = self.weights(w_branch)
+            n_cells = int(np.prod([c.n_bins + 2 for c in coords]))
+            cells = np.bincount(bins, weights=weights, minlength=n_cells)
+            sumw2 = None
+            if w_branch or ROOT.TH1.GetDefaultSumw2():
+                sumw2 = cells if weights is None else \
+                        np.bincount(bins, weights=weights**2, minlength=n_cells)
+            return array_to_hist(model, cells.astype(np.float64), sumw2,
+                                 len(bins))
+
+        return self.get_result(("Histo", tuple(model[2:]), columns),
+                               calculate, columns)
+
+    def Histo1D(self, model, *columns):
+        return self.histo(model, *columns)
+
+    def Histo2D(self, model, *columns):
+        return self.histo(model, *columns)
+
+    def Histo3D(self, model, *columns):
+        return self.histo(model, *columns)
+
+    # --- Actions of the histogram helpers -------------------------------------
+
+    def SparseHisto(self, distr_name, coords, w_branch=None):
+        """ Sparse histogram (see DistrHelpers.get_hist_ptr_nd).
+        """
+        def calculate():
+            return DH.SparseHist(distr_name, coords,
+              *filled_bin_sums(self.masked(self.data.flat_bins(coords)),
+                               self.weights(w_branch)))
+
+        columns = [coord.name for coord in coords] + ([w_branch] if w_branch
+                                                      else [])
+        key = ("SparseHisto", tuple((c.name, c.n_bins, c.min, c.max)
+                                    for c in coords), w_branch)
+        return self.get_result(key, calculate, columns)
+
+    def MultiCutHisto(self, distr_name, coords, branches, boxes):
+        """ Stacked cut-variation histogram (see
+            RDFActions.get_multi_cut_ptr), an event passes a box (low, high)
+            if all branch values are within it.
+        """
+        n_bins = RA.n_bins_total(coords)
+
+        def calculate():
+            bins = self.masked(self.data.flat_bins(coords))
+            values = np.array([ self.masked(self.column(branch))
+                                for branch in branches ], dtype=np.float64)
+            # NaN propagates so that all cuts fail for it
+            mins = np.min(values, axis=0)
+            maxs = np.max(values, axis=0)
+            inside = bins >= 0
+            filled, inverse = np.unique(bins[inside], return_inverse=True)
+            stacked = np.zeros((len(boxes), len(filled)))
+            for box, (low, high) in enumerate(boxes):
+                passed = ((mins > low) & (maxs < high))[inside]
+                stacked[box] = np.bincount(inverse[passed],
+                                           minlength=len(filled))
+            return filled, stacked
+
+        columns = [coord.name for coord in coords] + list(branches)
+        key = ("MultiCutHisto", tuple((c.name, c.n_bins, c.min, c.max)
+                                      for c in coords),
+               tuple(branches), tuple(boxes))
+        return StackedColumnarResult(
+          self.get_result(key, calculate, columns), n_bins)
+
+    def MultiWeightHisto(self, distr_name, coords, w_branches, n_weights=0):
+        """ Histogram filled with many weights (see 
+            RDFActions.get_multi_weight_ptr), the weights are either a list of
+            columns or a single vector column with n_weights elements.
+            The elements of a vector column are loaded as separate columns so
+            that each weight is a contiguous array.
+        """
+        n_bins = RA.n_bins_total(coords)
+        if isinstance(w_branches, str):
+            if not n_weights:
+                raise ValueError("Number of weights in {} needed by the "
+                                 "columnar engine".format(w_branches))
+            columns = []
+            for i in range(n_weights):
+                column = "prew_weight_{}_{}".format(RA.unique_id(w_branches), i)
+                self.data.define(column, "{}[{}]".format(w_branches, i))
+                columns.append(column)
+        else:
+            columns = list(w_branches)
+
+        def calculate():
+            bins = self.masked(self.data.flat_bins(coords))
+            weights = np.array([ self.masked(self.column(column)) 
+                                 for column in columns ], 
+                               dtype=np.float64).reshape(len(columns), -1)
+            inside = bins >= 0
+            filled, inverse = np.unique(bins[inside], return_inverse=True)
+            sumw = np.array([ np.bincount(inverse, weights=w[inside],
+                                          minlength=len(filled))
+                              for w in weights ]).reshape(-1, len(filled))
+            sumw2 = np.array([ np.bincount(inverse, weights=w[inside]**2,
+                                           minlength=len(filled))
+                               for w in weights ]).reshape(-1, len(filled))
+            return filled, sumw, sumw2
+
+        key = ("MultiWeightHisto", tuple((c.name, c.n_bins, c.min, c.max)
+                                         for c in coords), tuple(columns))
+        return MultiWeightColumnarResult(
+          self.get_result(key, calculate, 
+                          [coord.name for coord in coords] + columns), 
+          n_bins)
+
+# ------------------------------------------------------------------------------
@@ -1,5 +1,10 @@
 import ROOT
+import copy
 import logging as log
+import numpy as np
+
+# Local modules
+from PrEWInputProduction.ROOTHelp import RDFActions as RA
 
 # ------------------------------------------------------------------------------
 
@@ -20,129 +25,199 @@ class Coordinate:
 
 # ------------------------------------------------------------------------------
 
-def get_data_1d(root_hist, coords):
-    """ Extract data from TH1.
+class SparseHist:
+    """ N-dimensional histogram in which only the filled bins are stored (as 
+        sorted flat bin indices, first axis varies slowest).
+        Provides the parts of the ROOT histogram interface that are used on the
+        output histograms.
     """
-    # Find bin centers and values, skip overflow/underflow bins
-    bins_x={"Centers": [], "LowerEdges": [], "UpperEdges": []}
-    bin_values=[]
-    for x_bin in range(0, root_hist.GetNbinsX()+2):
-        bin = root_hist.GetBin(x_bin)
-            
-        # Skip overflow and underflow bins
-        if root_hist.IsBinUnderflow(bin) or root_hist.IsBinOverflow(bin): 
-            continue
-    
-        # Collect bin information and fill into array
-        bins_x["Centers"].append(root_hist.GetXaxis().GetBinCenter(x_bin))
-        bins_x["LowerEdges"].append(root_hist.GetXaxis().GetBinLowEdge(x_bin))
-        bins_x["UpperEdges"].append(root_hist.GetXaxis().GetBinUpEdge(x_bin))
-        value = root_hist.GetBinContent(bin)
-        bin_values.append(value)
-    
-    # Store the data in a dictionary for pandas
-    data = { "BinCenters:{}".format(coords[0].name): bins_x["Centers"],
-             "BinLow:{}".format(coords[0].name): bins_x["LowerEdges"],
-             "BinUp:{}".format(coords[0].name): bins_x["UpperEdges"],
-             "Cross sections": bin_values }
-    
-    return data
-  
-def get_data_2d(root_hist, coords):
-    """ Extract data from TH2.
+    def __init__(self, name, coords, bins, values, sumw2):
+        self.name = name
+        self.coords = coords
+        self.bins = np.asarray(bins, dtype=np.int64)
+        self.values = np.asarray(values, dtype=float)
+        self.sumw2 = np.asarray(sumw2, dtype=float)
+
+    def GetName(self):
+        return self.name
+
+    def GetDimension(self):
+        return len(self.coords)
+
+    def Clone(self, name=None):
+        clone = copy.deepcopy(self)
+        if name is not None:
+            clone.name = name
+        return clone
+
+    def Scale(self, factor):
+        self.values *= factor
+        self.sumw2 *= factor**2
+
+    def lookup(self, array, bins):
+        """ Values of the array (one per filled bin) for the given flat bin 
+            indices, 0 for bins that are not filled.
+        """
+        if bins is None:
+            return array.copy()
+        bins = np.asarray(bins, dtype=np.int64)
+        if len(self.bins) == 0:
+            return np.zeros(len(bins))
+        pos = np.minimum(np.searchsorted(self.bins, bins), len(self.bins)-1)
+        return np.where(self.bins[pos] == bins, array[pos], 0.0)
+
+class SparseHistPtr:
+    """ Result pointer of a sparse histogram action, its value is a SparseHist.
     """
-    # Find bin centers and values, skip overflow/underflow bins
-    bins_x={"Centers": [], "LowerEdges": [], "UpperEdges": []}
-    bins_y={"Centers": [], "LowerEdges": [], "UpperEdges": []}
-    bin_values=[]
-    for x_bin in range(0, root_hist.GetNbinsX()+2):
-        for y_bin in range(0, root_hist.GetNbinsY()+2):
-            bin = root_hist.GetBin(x_bin, y_bin)
-            
-            # Skip overflow and underflow bins
-            if root_hist.IsBinUnderflow(bin) or root_hist.IsBinOverflow(bin): 
-                continue
-        
-            # Collect bin information and fill into array
-            bins_x["Centers"].append(root_hist.GetXaxis().GetBinCenter(x_bin))
-            bins_y["Centers"].append(root_hist.GetYaxis().GetBinCenter(y_bin))
-            bins_x["LowerEdges"].append(root_hist.GetXaxis().GetBinLowEdge(x_bin))
-            bins_y["LowerEdges"].append(root_hist.GetYaxis().GetBinLowEdge(y_bin))
-            bins_x["UpperEdges"].append(root_hist.GetXaxis().GetBinUpEdge(x_bin))
-            bins_y["UpperEdges"].append(root_hist.GetYaxis().GetBinUpEdge(y_bin))
-            value = root_hist.GetBinContent(bin)
-            bin_values.append(value)
-    
-    # Store the data in a dictionary for pandas
-    data = {}
-    bin_dims = [bins_x,bins_y]
-    for d in range(len(bin_dims)):
-        data["BinCenters:{}".format(coords[d].name)] = bin_dims[d]["Centers"]
-        data["BinLow:{}".format(coords[d].name)] = bin_dims[d]["LowerEdges"]
-        data["BinUp:{}".format(coords[d].name)] = bin_dims[d]["UpperEdges"]
-    data["Cross sections"] = bin_values
+    def __init__(self, result_ptr, name, coords=None):
+        self.result_ptr = result_ptr
+        self.name = name
+        self.coords = coords
+        self.hist = None
+
+    def GetValue(self):
+        if self.hist is None:
+            result = self.result_ptr.GetValue()
+            self.hist = SparseHist(self.name, self.coords, 
+                                   np.array(result.bins, dtype=np.int64), 
+                                   np.array(result.sumw), 
+                                   np.array(result.sumw2))
+        return self.hist
+
+    def GetPtr(self):
+        return self.GetValue()
+
+# ------------------------------------------------------------------------------
+
+def as_numpy(buffer, n):
+    """ Zero-copy numpy view of a C++ double array with n entries (as returned
+        e.g. by TH1::GetArray).
+    """
+    if hasattr(buffer, "reshape"): # cppyy low level view
+        buffer.reshape((n,))
+    elif hasattr(buffer, "SetSize"): # Buffer of older PyROOT versions
+        buffer.SetSize(n)
+    return np.frombuffer(buffer, dtype=np.float64, count=n)
+
+def get_axes(hist):
+    """ Return the axes of the histogram that are used in its dimension.
+    """
+    axes = [hist.GetXaxis(), hist.GetYaxis(), hist.GetZaxis()]
+    return axes[:hist.GetDimension()]
+
+def strip_flow(hist, cells):
+    """ Take the flat array of all histogram cells (ROOT order, incl. under- and
+        overflow) and return the flat array of the inner bins in the order in
+        which the bin coordinates are extracted (first axis varies slowest).
+    """
+    axes = get_axes(hist)
     
-    return data
-  
-def get_data_3d(root_hist, coords):
-    """ Extract data from TH3.
+    # ROOT's global bin index has the x axis varying fastest
+    shape = [axis.GetNbins()+2 for axis in reversed(axes)]
+    cells = cells.reshape(shape)[tuple(slice(1,-1) for axis in axes)]
+    return np.transpose(cells).flatten()
+
+def select_bins(values, bins):
+    """ Select the given flat bin indices from the array of all bins (all bins 
+        if None).
     """
-    # Find bin centers and values, skip overflow/underflow bins
-    bins_x={"Centers": [], "LowerEdges": [], "UpperEdges": []}
-    bins_y={"Centers": [], "LowerEdges": [], "UpperEdges": []}
-    bins_z={"Centers": [], "LowerEdges": [], "UpperEdges": []}
-    bin_values=[]
-    for x_bin in range(0, root_hist.GetNbinsX()+2):
-        for y_bin in range(0, root_hist.GetNbinsY()+2):
-            for z_bin in range(0, root_hist.GetNbinsZ()+2):
-                bin = root_hist.GetBin(x_bin, y_bin, z_bin)
-                
-                # Skip overflow and underflow bins
-                if root_hist.IsBinUnderflow(bin) or root_hist.IsBinOverflow(bin): 
-                    continue
-            
-                # Collect bin information and fill into array
-                bins_x["Centers"].append(root_hist.GetXaxis().GetBinCenter(x_bin))
-                bins_y["Centers"].append(root_hist.GetYaxis().GetBinCenter(y_bin))
-                bins_z["Centers"].append(root_hist.GetZaxis().GetBinCenter(z_bin))
-                bins_x["LowerEdges"].append(root_hist.GetXaxis().GetBinLowEdge(x_bin))
-                bins_y["LowerEdges"].append(root_hist.GetYaxis().GetBinLowEdge(y_bin))
-                bins_z["LowerEdges"].append(root_hist.GetZaxis().GetBinLowEdge(z_bin))
-                bins_x["UpperEdges"].append(root_hist.GetXaxis().GetBinUpEdge(x_bin))
-                bins_y["UpperEdges"].append(root_hist.GetYaxis().GetBinUpEdge(y_bin))
-                bins_z["UpperEdges"].append(root_hist.GetZaxis().GetBinUpEdge(z_bin))
-                value = root_hist.GetBinContent(bin)
-                bin_values.append(value)
+    return values if bins is None else values[np.asarray(bins, dtype=np.int64)]
+
+def get_filled_bins(hist):
+    """ Return the flat indices of the filled bins for sparse histograms, None
+        for ROOT histograms (for which all bins are used).
+    """
+    if isinstance(hist, SparseHist):
+        return hist.bins
+    return None
+
+def get_values(hist, bins=None):
+    """ Return the bin contents (without under- and overflow) as numpy array,
+        in the same order in which the bin coordinates are extracted.
+        If flat bin indices are given only those bins are returned.
+    """
+    if isinstance(hist, SparseHist):
+        return hist.lookup(hist.values, bins)
+    return select_bins(
+      strip_flow(hist, as_numpy(hist.GetArray(), hist.GetNcells())), bins)
+
+def get_sumw2(hist, bins=None):
+    """ Return the sum of squared weights (squared bin errors) in the same order
+        as get_values.
+    """
+    if isinstance(hist, SparseHist):
+        return hist.lookup(hist.sumw2, bins)
+    if hist.GetSumw2N() == 0:
+        # No weights stored -> error is sqrt of content
+        return np.abs(get_values(hist, bins))
+    sumw2 = hist.GetSumw2()
+    return select_bins(
+      strip_flow(hist, as_numpy(sumw2.GetArray(), sumw2.GetSize())), bins)
+
+def get_coord_bin_grid(coords, bins):
+    """ Return the bin centers, lower and upper edges of each coordinate for the
+        given flat bin indices (same conventions as the fixed-width ROOT axes).
+    """
+    grids = []
+    axis_indices = np.unravel_index(np.asarray(bins, dtype=np.int64), 
+                                    [coord.n_bins for coord in coords])
+    for coord, indices in zip(coords, axis_indices):
+        width = (coord.max - coord.min) / coord.n_bins
+        grids.append({ "Centers": coord.min + (indices + 0.5) * width,
+                       "LowerEdges": coord.min + indices * width,
+                       "UpperEdges": coord.min + (indices + 1) * width })
+    return grids
+
+def get_bin_grid(hist, bins=None):
+    """ Return the bin centers, lower and upper edges of each axis for all bins
+        (without under- and overflow), in the same order as get_values.
+        If flat bin indices are given only those bins are returned.
+    """
+    if isinstance(hist, SparseHist):
+        return get_coord_bin_grid(hist.coords, 
+                                  hist.bins if bins is None else bins)
     
-    # Store the data in a dictionary for pandas
-    data = {}
-    bin_dims = [bins_x,bins_y,bins_z]
-    for d in range(len(bin_dims)):
-        data["BinCenters:{}".format(coords[d].name)] = bin_dims[d]["Centers"]
-        data["BinLow:{}".format(coords[d].name)] = bin_dims[d]["LowerEdges"]
-        data["BinUp:{}".format(coords[d].name)] = bin_dims[d]["UpperEdges"]
-    data["Cross sections"] = bin_values
+    grids = []
+    axes = get_axes(hist)
+    axis_bins = [range(1, axis.GetNbins()+1) for axis in axes]
+    axis_values = [
+      { "Centers": [axis.GetBinCenter(b) for b in bins], 
+        "LowerEdges": [axis.GetBinLowEdge(b) for b in bins],
+        "UpperEdges": [axis.GetBinUpEdge(b) for b in bins] }
+      for axis, bins in zip(axes, axis_bins) ]
     
-    return data
+    # Bin index grid for all axes, first axis varies slowest
+    index_grid = np.meshgrid(*[np.arange(len(bins)) for bins in axis_bins], 
+                             indexing="ij")
+    for d in range(len(axes)):
+        indices = select_bins(index_grid[d].flatten(), bins)
+        grids.append({ name: np.array(values)[indices] 
+                       for name, values in axis_values[d].items() })
+    return grids
 
 # ------------------------------------------------------------------------------
 
-def get_data(root_hist, coords):
+def get_data(root_hist, coords, bins=None):
     """ Extract the bin centers and cross section values from the given
         histogram.
+        If flat bin indices are given only those bins are extracted (sparse
+        histograms default to their filled bins).
     """
     dim = root_hist.GetDimension()
-    data = 0
     log.debug("Data is {}-dimensional.".format(dim))
+    
+    if bins is None:
+        bins = get_filled_bins(root_hist)
 
-    # Exact extraction depends on dimensionality
-    if (dim == 1):
-        data = get_data_1d(root_hist, coords)
-    elif (dim == 2):
-        data = get_data_2d(root_hist, coords)
-    elif (dim == 3):
-        data = get_data_3d(root_hist, coords)
-      
+    # Store the data in a dictionary for pandas
+    data = {}
+    bin_grid = get_bin_grid(root_hist, bins)
+    for d in range(dim):
+        data["BinCenters:{}".format(coords[d].name)] = bin_grid[d]["Centers"]
+        data["BinLow:{}".format(coords[d].name)] = bin_grid[d]["LowerEdges"]
+        data["BinUp:{}".format(coords[d].name)] = bin_grid[d]["UpperEdges"]
+    data["Cross sections"] = get_values(root_hist, bins)
+    
     return data
 
 # ------------------------------------------------------------------------------
@@ -179,10 +254,24 @@ def get_hist_ptr_3d(rdf, distr_name, coords, w_branch=None):
       return rdf.Histo3D(th3_setup, coords[0].name, coords[1].name, 
                                     coords[2].name)
 
+def get_hist_ptr_nd(rdf, distr_name, coords, w_branch=None):
+    """ Get sparse histogram pointer (any dimension), only filled bins are 
+        stored.
+    """
+    if hasattr(rdf, "SparseHisto"): # Columnar engine
+      return rdf.SparseHisto(distr_name, coords, w_branch)
+    rdf_bin, bin_column = RA.define_flat_bin(rdf, coords)
+    if not w_branch:
+      rdf_bin, w_branch = RA.define_unit_weight(rdf_bin)
+    return SparseHistPtr(
+      RA.book_sparse_hist(rdf_bin, bin_column, "long long", w_branch), 
+      distr_name, coords)
+
 def get_hist_ptr(rdf, distr_name, coords, w_branch=None):
     """ Get a histogram pointer from the RDataFrame according to the coordinates 
         given.
         w_branch ... optional weight branch
+        Beyond three dimensions a sparse histogram is used.
     """
     hist_ptr = None 
     dim = len(coords)
@@ -192,70 +281,10 @@ def get_hist_ptr(rdf, distr_name, coords, w_branch=None):
       hist_ptr = get_hist_ptr_2d(rdf, distr_name, coords, w_branch)
     elif (dim == 3):
       hist_ptr = get_hist_ptr_3d(rdf, distr_name, coords, w_branch)
+    elif (dim > 3):
+      hist_ptr = get_hist_ptr_nd(rdf, distr_name, coords, w_branch)
     else:
         raise ValueError("Invalid hist dimension: {}".format(dim))
     return hist_ptr
 
-# ------------------------------------------------------------------------------
-
-def get_bin_range_1d(hist):
-    """ Return correct index range for 1D histogram. """
-    bin_range = []
-    for x_bin in range(0, hist.GetNbinsX()+2):
-          bin = hist.GetBin(x_bin)
-              
-          # Skip overflow and underflow bins
-          if hist.IsBinUnderflow(bin) or hist.IsBinOverflow(bin): 
-              continue
-          
-          bin_range.append(bin)
-    return bin_range
-          
-    
-def get_bin_range_2d(hist):
-    """ Return correct index range for 2D histogram. """
-    bin_range = []
-    for x_bin in range(0, hist.GetNbinsX()+2):
-        for y_bin in range(0, hist.GetNbinsY()+2):
-            bin = hist.GetBin(x_bin, y_bin)
-            
-            # Skip overflow and underflow bins
-            if hist.IsBinUnderflow(bin) or hist.IsBinOverflow(bin): 
-                continue
-
-            bin_range.append(bin)
-    return bin_range
-
-
-def get_bin_range_3d(hist):
-    """ Return correct index range for 3D histogram. """
-    bin_range = []
-    for x_bin in range(0, hist.GetNbinsX()+2):
-        for y_bin in range(0, hist.GetNbinsY()+2):
-            for z_bin in range(0, hist.GetNbinsZ()+2):
-                bin = hist.GetBin(x_bin, y_bin, z_bin)
-                
-                # Skip overflow and underflow bins
-                if hist.IsBinUnderflow(bin) or hist.IsBinOverflow(bin): 
-                    continue
-
-                bin_range.append(bin)
-    return bin_range
-
-def get_bin_range(hist):
-    """ Return the bin index range that corresponds to the way the bin 
-        coordinates where extracted from the histogram.
-    """
-    bin_range = []
-    dim = hist.GetDimension()
-    if (dim == 1):
-        bin_range = get_bin_range_1d(hist)
-    elif (dim == 2):
-        bin_range = get_bin_range_2d(hist)
-    elif (dim == 3):
-        bin_range = get_bin_range_3d(hist)
-    else:
-        raise ValueError("Invalid hist dimension: {}".format(dim))
-    return bin_range
-
 # ------------------------------------------------------------------------------
\ No newline at end of file
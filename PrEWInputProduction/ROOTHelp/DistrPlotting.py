@@ -1,8 +1,7 @@
 import ROOT
-import sys
+import logging as log
 
-sys.path.append("../IO")
-import OutputHelpers as OH
+from PrEWInputProduction.IO import OutputHelpers as OH
 
 # ------------------------------------------------------------------------------
 
@@ -12,6 +11,11 @@ import OutputHelpers as OH
 # ------------------------------------------------------------------------------
 
 def draw_hist(hist, output, hist_name, extensions=["pdf","root"]):
+    if hist.GetDimension() > 3:
+      log.warning("Can't draw {}-dimensional histogram {}.".format(
+        hist.GetDimension(), hist_name))
+      return
+    
     # Draw the histogram
     canvas = ROOT.TCanvas("c_{}".format(hist_name))
     canvas.cd()
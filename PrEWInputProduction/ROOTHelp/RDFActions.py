@@ -0,0 +1,603 @@
+import hashlib
+import numpy as np
+import ROOT
+
+# Local modules
+from PrEWInputProduction.ROOTHelp import DistrHelpers as DH
+from PrEWInputProduction.ROOTHelp import RDFBooking as RB
+
+# ------------------------------------------------------------------------------
+
+""" Custom RDataFrame actions (based on jitted C++ helpers) that fill many
+    histogram variations in a single booking.
+"""
+
+# ------------------------------------------------------------------------------
+
+cpp_helpers = """
+#include <algorithm>
+#include <atomic>
+#include <chrono>
+#include <cmath>
+#include <memory>
+#include <stdexcept>
+#include <unordered_map>
+#include <utility>
+#include <vector>
+#include <ROOT/RDataFrame.hxx>
+#include <TChain.h>
+#include <TEntryList.h>
+
+namespace PrEWHelp {
+
+inline int axis_bin(double x, int n, double min, double max) {
+  /** Bin index (0..n-1) on a fixed-width axis, -1 for under- and overflow.
+      Same convention as TAxis::FindFixBin.
+   **/
+  if (x < min || !(x < max)) { return -1; }
+  int bin = int(n * (x - min) / (max - min));
+  return (bin < n) ? bin : -1;
+}
+
+inline long long flat_bin(std::initializer_list<int> bins,
+                          std::initializer_list<int> n_bins) {
+  /** Flat bin index without under- and overflow, first axis varies slowest
+      (same order as the bins in the CSV output), -1 if outside any axis.
+   **/
+  long long flat = 0;
+  auto n = n_bins.begin();
+  for (auto bin : bins) {
+    if (bin < 0) { return -1; }
+    flat = flat * (*n) + bin;
+    ++n;
+  }
+  return flat;
+}
+
+inline double min_value(std::initializer_list<double> values) {
+  /** Smallest of the values, NaN if any value is NaN (so that any cut on the
+      result fails, as it would for the NaN value itself).
+   **/
+  double min = *values.begin();
+  for (auto value : values) {
+    if (std::isnan(value)) { return value; }
+    min = std::min(min, value);
+  }
+  return min;
+}
+
+inline double max_value(std::initializer_list<double> values) {
+  /** Largest of the values, NaN if any value is NaN.
+   **/
+  double max = *values.begin();
+  for (auto value : values) {
+    if (std::isnan(value)) { return value; }
+    max = std::max(max, value);
+  }
+  return max;
+}
+
+inline bool sample_entry(unsigned long long entry, unsigned long long seed,
+                         double fraction) {
+  /** Reproducible pseudo-random selection of the fraction of all entries,
+      based on a (splitmix64) hash of the entry number and the seed.
+   **/
+  unsigned long long z = entry + seed * 0x9E3779B97F4A7C15ULL;
+  z = (z ^ (z >> 30)) * 0xBF58476D1CE4E5B9ULL;
+  z = (z ^ (z >> 27)) * 0x94D049BB133111EBULL;
+  z = z ^ (z >> 31);
+  return (z >> 11) / 9007199254740992.0 < fraction; // Uniform in [0,1)
+}
+
+inline TEntryList *sample_entry_list(TChain &chain, long long max_entries,
+                                     bool use_fraction, 
+                                     unsigned long long seed, double fraction) {
+  /** Entry list with the sampled entries of the chain: the first max_entries
+      (all if negative) entries, of which the fraction is selected by the
+      entry number in the chain (see sample_entry).
+   **/
+  long long n_entries = chain.GetEntries(); // Also sets the tree offsets
+  if (max_entries >= 0 && max_entries < n_entries) { n_entries = max_entries; }
+  auto list = new TEntryList("prew_sample", "prew_sample");
+  for (long long entry = 0; entry < n_entries; entry++) {
+    if (!use_fraction || sample_entry(entry, seed, fraction)) {
+      list->Enter(entry, &chain);
+    }
+  }
+  return list;
+}
+
+inline ROOT::RVec<double> multi_box_index(long long bin, long long n_bins,
+                                          const std::vector<double> &lows,
+                                          const std::vector<double> &highs,
+                                          std::initializer_list<double> values) {
+  /** Stacked bin indices (box * n_bins + bin) of all boxes (low, high) that
+      contain all given values. The extreme values are determined once, so the
+      cost per event scales with the number of values plus number of boxes.
+   **/
+  ROOT::RVec<double> indices {};
+  if (bin < 0) { return indices; }
+  double min = min_value(values);
+  double max = max_value(values);
+  for (std::size_t box = 0; box < lows.size(); box++) {
+    if ((min > lows[box]) && (max < highs[box])) {
+      indices.push_back(box * n_bins + bin);
+    }
+  }
+  return indices;
+}
+
+struct SparseHistResult {
+  /** Filled bins (sorted flat bin indices) with their sum of weights and sum of
+      squared weights.
+   **/
+  std::vector<long long> bins {};
+  std::vector<double> sumw {};
+  std::vector<double> sumw2 {};
+};
+
+template <typename Index_t>
+class SparseHistHelper
+  : public ROOT::Detail::RDF::RActionImpl<SparseHistHelper<Index_t>> {
+  /** RDataFrame action that fills a histogram in which only the filled bins
+      are stored, so that the memory scales with the number of filled bins
+      instead of the total number of bins. The index column is either a single
+      flat bin index or a vector of them (stacked histograms), negative indices
+      (under- and overflow) are ignored.
+   **/
+public:
+  using Result_t = SparseHistResult;
+
+private:
+  using Cells_t = std::unordered_map<long long, std::pair<double, double>>;
+  std::shared_ptr<Result_t> fResult;
+  std::vector<Cells_t> fSlotCells; // One map per thread slot, merged at the end
+
+  void fill(unsigned int slot, long long bin, double weight) {
+    if (bin < 0) { return; }
+    auto &cell = fSlotCells[slot][bin];
+    cell.first += weight;
+    cell.second += weight * weight;
+  }
+
+  void fill(unsigned int slot, const ROOT::RVec<double> &bins, double weight) {
+    for (auto bin : bins) { fill(slot, (long long)bin, weight); }
+  }
+
+public:
+  SparseHistHelper(unsigned int n_slots)
+    : fResult(std::make_shared<Result_t>()), fSlotCells(n_slots) {}
+  SparseHistHelper(SparseHistHelper &&) = default;
+  SparseHistHelper(const SparseHistHelper &) = delete;
+
+  std::shared_ptr<Result_t> GetResultPtr() const { return fResult; }
+  void Initialize() {}
+  void InitTask(TTreeReader *, unsigned int) {}
+
+  void Exec(unsigned int slot, const Index_t &index, double weight) {
+    fill(slot, index, weight);
+  }
+
+  void Finalize() {
+    auto &cells = fSlotCells[0];
+    for (std::size_t slot = 1; slot < fSlotCells.size(); slot++) {
+      for (auto &cell : fSlotCells[slot]) {
+        auto &merged = cells[cell.first];
+        merged.first += cell.second.first;
+        merged.second += cell.second.second;
+      }
+      Cells_t().swap(fSlotCells[slot]);
+    }
+
+    auto &bins = fResult->bins;
+    bins.reserve(cells.size());
+    for (auto &cell : cells) { bins.push_back(cell.first); }
+    std::sort(bins.begin(), bins.end());
+    fResult->sumw.reserve(bins.size());
+    fResult->sumw2.reserve(bins.size());
+    for (auto bin : bins) {
+      fResult->sumw.push_back(cells[bin].first);
+      fResult->sumw2.push_back(cells[bin].second);
+    }
+    Cells_t().swap(cells);
+  }
+
+  std::string GetActionName() { return "SparseHist"; }
+};
+
+struct MultiWeightResult {
+  /** Filled bins (sorted flat bin indices) with the sum of weights and sum of
+      squared weights of each weight, stored bin by bin (n_bins x n_weights).
+   **/
+  std::vector<long long> bins {};
+  std::size_t n_weights = 0;
+  std::vector<double> sumw {};
+  std::vector<double> sumw2 {};
+};
+
+class MultiWeightHelper
+  : public ROOT::Detail::RDF::RActionImpl<MultiWeightHelper> {
+  /** RDataFrame action that fills the same histogram with many weights per 
+      event. The bin index is determined once per event, then the sum of 
+      weights and sum of squared weights of all weights are accumulated.
+      Only filled bins are stored.
+   **/
+public:
+  using Result_t = MultiWeightResult;
+
+private:
+  using Cells_t = std::unordered_map<long long, std::vector<double>>;
+  std::shared_ptr<Result_t> fResult;
+  std::vector<Cells_t> fSlotCells; // One map per thread slot, merged at the end
+
+public:
+  MultiWeightHelper(unsigned int n_slots)
+    : fResult(std::make_shared<Result_t>()), fSlotCells(n_slots) {}
+  MultiWeightHelper(MultiWeightHelper &&) = default;
+  MultiWeightHelper(const MultiWeightHelper &) = delete;
+
+  std::shared_ptr<Result_t> GetResultPtr() const { return fResult; }
+  void Initialize() {}
+  void InitTask(TTreeReader *, unsigned int) {}
+
+  void Exec(unsigned int slot, long long bin, 
+            const ROOT::RVec<double> &weights) {
+    if (bin < 0) { return; }
+    std::size_t n = weights.size();
+    auto &cell = fSlotCells[slot][bin]; // sumw of all weights, then sumw2
+    if (cell.empty()) { cell.resize(2 * n, 0.0); }
+    if (cell.size() != 2 * n) {
+      throw std::runtime_error("MultiWeightHelper: varying number of weights");
+    }
+    for (std::size_t i = 0; i < n; i++) {
+      cell[i] += weights[i];
+      cell[n + i] += weights[i] * weights[i];
+    }
+  }
+
+  void Finalize() {
+    auto &cells = fSlotCells[0];
+    for (std::size_t slot = 1; slot < fSlotCells.size(); slot++) {
+      for (auto &cell : fSlotCells[slot]) {
+        auto &merged = cells[cell.first];
+        if (merged.empty()) { 
+          merged = std::move(cell.second);
+        } else {
+          for (std::size_t i = 0; i < merged.size(); i++) {
+            merged[i] += cell.second[i];
+          }
+        }
+      }
+      Cells_t().swap(fSlotCells[slot]);
+    }
+
+    auto &bins = fResult->bins;
+    bins.reserve(cells.size());
+    for (auto &cell : cells) { bins.push_back(cell.first); }
+    std::sort(bins.begin(), bins.end());
+    std::size_t n = cells.empty() ? 0 : cells.begin()->second.size() / 2;
+    fResult->n_weights = n;
+    fResult->sumw.reserve(bins.size() * n);
+    fResult->sumw2.reserve(bins.size() * n);
+    for (auto bin : bins) {
+      auto &cell = cells[bin];
+      fResult->sumw.insert(fResult->sumw.end(), cell.begin(), cell.begin() + n);
+      fResult->sumw2.insert(fResult->sumw2.end(), cell.begin() + n, cell.end());
+    }
+    Cells_t().swap(cells);
+  }
+
+  std::string GetActionName() { return "MultiWeightHist"; }
+};
+
+ROOT::RDF::RResultPtr<MultiWeightResult>
+book_multi_weight_hist(ROOT::RDF::RNode rdf, const std::string &bin_column,
+                       const std::string &weights_column) {
+  /** Book the multi-weight histogram action on the given node.
+   **/
+  return rdf.Book<long long, ROOT::RVec<double>>(
+    MultiWeightHelper(rdf.GetNSlots()), {bin_column, weights_column});
+}
+
+template <typename Index_t>
+ROOT::RDF::RResultPtr<SparseHistResult>
+book_sparse_hist(ROOT::RDF::RNode rdf, const std::string &index_column,
+                 const std::string &weight_column) {
+  /** Book the sparse histogram action on the given node.
+   **/
+  return rdf.Book<Index_t, double>(
+    SparseHistHelper<Index_t>(rdf.GetNSlots()), {index_column, weight_column});
+}
+
+inline long long clock_ns() {
+  /** Monotonic clock (ns) used to time the start of the event loops.
+   **/
+  return std::chrono::duration_cast<std::chrono::nanoseconds>(
+    std::chrono::steady_clock::now().time_since_epoch()).count();
+}
+
+inline std::atomic<long long> loop_start_ns{0}; // Earliest event loop start
+
+template <typename T>
+void record_loop_start(ROOT::RDF::RResultPtr<T> &ptr) {
+  /** Record the time at which the event loop of the result starts, i.e. 
+      after the jitted code was compiled (one-shot callback).
+   **/
+  ptr.OnPartialResultSlot(ROOT::RDF::RResultPtr<T>::kOnce, 
+                          [](unsigned int, T &) {
+    long long now = clock_ns();
+    long long start = loop_start_ns.load();
+    while ((start == 0 || now < start) && 
+           !loop_start_ns.compare_exchange_weak(start, now)) {}
+  });
+}
+
+} // namespace PrEWHelp
+"""
+
+cpp_helpers_declared = False
+declared_boxes = set()
+
+def declare_helpers():
+  """ Declare the C++ helpers to the interpreter (only done once).
+  """
+  global cpp_helpers_declared
+  if not cpp_helpers_declared:
+    ROOT.gInterpreter.Declare(cpp_helpers)
+    cpp_helpers_declared = True
+
+def unique_id(*args):
+  """ Short ID that is unique for the given arguments, used in C++ names.
+  """
+  return hashlib.md5(repr(args).encode()).hexdigest()[:10]
+
+# ------------------------------------------------------------------------------
+
+def n_bins_total(coords):
+  """ Total number of bins (without under- and overflow) for the coordinates.
+  """
+  return int(np.prod([coord.n_bins for coord in coords]))
+
+def flat_bin_expr(coords):
+  """ C++ expression for the flat bin index of the event in the histogram given
+      by the coordinates.
+  """
+  axis_bins = ["PrEWHelp::axis_bin({}, {}, {}, {})".format(
+                 coord.name, coord.n_bins, coord.min, coord.max)
+               for coord in coords]
+  return "PrEWHelp::flat_bin({{{}}}, {{{}}})".format(
+    ", ".join(axis_bins), ", ".join(str(coord.n_bins) for coord in coords))
+
+def define_flat_bin(rdf, coords):
+  """ Define the flat bin index column for the given coordinates, returns the
+      new node and the column name.
+  """
+  declare_helpers()
+  column = "prew_bin_{}".format(
+    unique_id([(c.name, c.n_bins, c.min, c.max) for c in coords]))
+  return rdf.Define(column, flat_bin_expr(coords)), column
+
+def define_extremes(rdf, branches):
+  """ Define the columns with the smallest and largest value of the given
+      branches, returns the new node and the two column names.
+  """
+  declare_helpers()
+  branch_list = ", ".join(branches)
+  extremes_id = unique_id(branches)
+  min_column = "prew_min_{}".format(extremes_id)
+  max_column = "prew_max_{}".format(extremes_id)
+  rdf_extremes = rdf.Define(min_column, 
+                            "PrEWHelp::min_value({{{}}})".format(branch_list))
+  rdf_extremes = rdf_extremes.Define(max_column, 
+                            "PrEWHelp::max_value({{{}}})".format(branch_list))
+  return rdf_extremes, min_column, max_column
+
+def define_unit_weight(rdf):
+  """ Define a column with weight 1 (for unweighted sparse histograms), returns
+      the new node and the column name.
+  """
+  column = "prew_unit_weight"
+  return rdf.Define(column, "1.0"), column
+
+class LoopStartClock:
+  """ Measures the time from its creation until the first of the event loops
+      of the given RDataFrame result pointers starts. RDataFrame compiles the
+      jitted code (expressions, actions) of a graph before its loop starts, so
+      this is the time spent jitting.
+  """
+  def __init__(self, ptrs):
+    declare_helpers()
+    ROOT.PrEWHelp.loop_start_ns.store(0)
+    for ptr in ptrs:
+      if hasattr(ptr, "OnPartialResultSlot"):
+        ROOT.PrEWHelp.record_loop_start(ptr)
+    self.start_ns = ROOT.PrEWHelp.clock_ns()
+
+  def time_to_start(self):
+    """ Seconds until the first event loop started (0 if none started).
+    """
+    loop_start_ns = ROOT.PrEWHelp.loop_start_ns.load()
+    if loop_start_ns == 0:
+      return 0.0
+    return max(0.0, (loop_start_ns - self.start_ns) * 1e-9)
+
+sampled_sources = [] # Chains and entry lists must outlive their RDataFrame
+
+def sampled_rdf(input, sampling):
+  """ RDataFrame of the input that only reads the sampled entries (see 
+      SamplingOptions).
+      The entries are selected with a TEntryList on the chain of the input
+      files, so the sample is defined by the entry numbers in the chain and
+      doesn't depend on the number of threads (rdfentry_ isn't the entry
+      number with implicit multi-threading).
+  """
+  declare_helpers()
+  chain = ROOT.TChain(input.tree_name)
+  for path in input.file_paths:
+    chain.Add(path)
+  max_entries = -1 if sampling.max_entries is None else sampling.max_entries
+  use_fraction = sampling.fraction is not None
+  entry_list = ROOT.PrEWHelp.sample_entry_list(
+    chain, max_entries, use_fraction, sampling.seed, 
+    sampling.fraction if use_fraction else 1.0)
+  chain.SetEntryList(entry_list)
+  sampled_sources.append((chain, entry_list))
+  return ROOT.RDataFrame(chain)
+
+def book_sparse_hist(rdf, index_column, index_type, w_column):
+  """ Book the sparse histogram action on the given index column (flat bin 
+      index of type "long long" or stacked indices of type "ROOT::RVec<double>")
+      with the given weight column. Returns the raw result pointer.
+  """
+  declare_helpers()
+  node = rdf.rdf if isinstance(rdf, RB.BookedRDF) else rdf
+  book = lambda: ROOT.PrEWHelp.book_sparse_hist[index_type](
+                   ROOT.RDF.AsRNode(node), index_column, w_column)
+  if isinstance(rdf, RB.BookedRDF):
+    return rdf.get_result(("SparseHist", index_column, w_column), book)
+  return book()
+
+def book_multi_weight_hist(rdf, bin_column, weights_column):
+  """ Book the multi-weight histogram action on the given flat bin index and
+      RVec<double> weights columns. Returns the raw result pointer.
+  """
+  declare_helpers()
+  node = rdf.rdf if isinstance(rdf, RB.BookedRDF) else rdf
+  book = lambda: ROOT.PrEWHelp.book_multi_weight_hist(
+                   ROOT.RDF.AsRNode(node), bin_column, weights_column)
+  if isinstance(rdf, RB.BookedRDF):
+    return rdf.get_result(("MultiWeightHist", bin_column, weights_column), book)
+  return book()
+
+# ------------------------------------------------------------------------------
+
+class StackedHistPtr:
+  """ Result pointer of a stacked histogram, its value is a (K x n_bins) array
+      with the bin contents of the K variations.
+  """
+
+  def __init__(self, hist_ptr, n_stack, n_bins):
+    self.hist_ptr = hist_ptr
+    self.n_stack = n_stack
+    self.n_bins = n_bins
+
+  def GetValue(self, bins=None):
+    """ Bin contents of all variations, optionally only for the given flat bin
+        indices (K x len(bins)).
+    """
+    if bins is None:
+      bins = np.arange(self.n_bins)
+    stacked_bins = np.arange(self.n_stack)[:,None] * self.n_bins \
+                   + np.asarray(bins)[None,:]
+    return DH.get_values(self.hist_ptr.GetValue(), 
+                         stacked_bins.flatten()).reshape(stacked_bins.shape)
+
+def get_multi_cut_ptr(rdf, distr_name, coords, branches, boxes):
+  """ Book a single histogram action that fills the histogram for each of the
+      K cut boxes (low, high) at once. An event passes a box if the values of
+      all given branches are within (low, high).
+      Beyond three dimensions only the filled bins are stored.
+      Returns a StackedHistPtr.
+  """
+  if hasattr(rdf, "MultiCutHisto"): # Columnar engine
+    return rdf.MultiCutHisto(distr_name, coords, branches, boxes)
+  declare_helpers()
+  rdf_bin, bin_column = define_flat_bin(rdf, coords)
+  n_bins = n_bins_total(coords)
+  n_stack = len(boxes)
+
+  # Cut boxes are declared once as global C++ vectors
+  box_id = unique_id(boxes)
+  lows = "PrEWHelp::box_lows_{}".format(box_id)
+  highs = "PrEWHelp::box_highs_{}".format(box_id)
+  if box_id not in declared_boxes:
+    declared_boxes.add(box_id)
+    ROOT.gInterpreter.Declare(
+      "namespace PrEWHelp {{ const std::vector<double> box_lows_{0} {{{1}}}; "
+      "const std::vector<double> box_highs_{0} {{{2}}}; }}".format(
+        box_id, ", ".join(repr(float(low)) for low, high in boxes),
+                ", ".join(repr(float(high)) for low, high in boxes)))
+
+  index_column = "prew_boxes_{}_{}".format(box_id, bin_column)
+  index_expr = "PrEWHelp::multi_box_index({}, {}, {}, {}, {{{}}})".format(
+    bin_column, n_bins, lows, highs, ", ".join(branches))
+  rdf_index = rdf_bin.Define(index_column, index_expr)
+
+  n_total = n_stack * n_bins
+  if len(coords) > 3:
+    rdf_index, w_column = define_unit_weight(rdf_index)
+    hist_ptr = DH.SparseHistPtr(
+      book_sparse_hist(rdf_index, index_column, "ROOT::RVec<double>", w_column),
+      distr_name)
+  else:
+    hist_setup = (distr_name, distr_name, n_total, -0.5, n_total - 0.5)
+    hist_ptr = rdf_index.Histo1D(hist_setup, index_column)
+  return StackedHistPtr(hist_ptr, n_stack, n_bins)
+
+# ------------------------------------------------------------------------------
+
+class MultiWeightPtr:
+  """ Result pointer of a multi-weight histogram, its value is the tuple 
+      (sum of weights, sum of squared weights) of (n_weights x n_bins) arrays.
+  """
+
+  def __init__(self, result_ptr, n_bins, n_weights=0):
+    self.result_ptr = result_ptr
+    self.n_bins = n_bins
+    self.n_weights = n_weights # Only needed if no bin is filled
+    self.result = None
+
+  def get_result(self):
+    """ Filled bins and the (n_weights x n_filled) sums (converted once).
+    """
+    if self.result is None:
+      result = self.result_ptr.GetValue()
+      bins = np.array(result.bins, dtype=np.int64)
+      shape = (len(bins), int(result.n_weights) or self.n_weights)
+      self.result = (bins, 
+                     np.array(result.sumw).reshape(shape).T,
+                     np.array(result.sumw2).reshape(shape).T)
+    return self.result
+
+  def GetValue(self, bins=None):
+    """ Sums for all weights, optionally only for the given flat bin indices.
+    """
+    filled, sumw, sumw2 = self.get_result()
+    if bins is None:
+      bins = np.arange(self.n_bins)
+    bins = np.asarray(bins, dtype=np.int64)
+    if len(filled) == 0:
+      return np.zeros((sumw.shape[0], len(bins))), \
+             np.zeros((sumw.shape[0], len(bins)))
+    pos = np.minimum(np.searchsorted(filled, bins), len(filled)-1)
+    found = filled[pos] == bins
+    return np.where(found, sumw[:,pos], 0.0), np.where(found, sumw2[:,pos], 0.0)
+
+def get_multi_weight_ptr(rdf, distr_name, coords, w_branches, n_weights=0):
+  """ Book a single action that fills the histogram given by the coordinates 
+      with all given weights at once, the bin index is only determined once per
+      event.
+      The weights are either given as list of weight columns or as the name of
+      a single RVec<double> column that holds n_weights weights (n_weights is
+      required by the columnar engine).
+      Returns a MultiWeightPtr.
+  """
+  if hasattr(rdf, "MultiWeightHisto"): # Columnar engine
+    return rdf.MultiWeightHisto(distr_name, coords, w_branches, n_weights)
+  declare_helpers()
+  rdf_bin, bin_column = define_flat_bin(rdf, coords)
+  
+  # Collect scalar weight columns in one vector column
+  if isinstance(w_branches, str):
+    weights_column = w_branches
+  else:
+    n_weights = len(w_branches)
+    weights_column = "prew_weights_{}".format(unique_id(list(w_branches)))
+    rdf_bin = rdf_bin.Define(weights_column, "ROOT::RVec<double>{{{}}}".format(
+                               ", ".join(w_branches)))
+  
+  return MultiWeightPtr(
+    book_multi_weight_hist(rdf_bin, bin_column, weights_column),
+    n_bins_total(coords), n_weights)
+
+# ------------------------------------------------------------------------------
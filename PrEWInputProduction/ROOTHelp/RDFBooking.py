@@ -0,0 +1,182 @@
+import logging as log
+import re
+
+# ------------------------------------------------------------------------------
+
+""" Booking layer between the histogram helpers and the RDataFrame, which makes
+    sure that identical Filter/Define nodes and identical results are only
+    booked once.
+"""
+
+# ------------------------------------------------------------------------------
+
+# C++ tokens: string/char literals, numbers (incl. exponents and suffixes),
+# identifiers, multi-character operators (longest first) and single characters
+token_pattern = re.compile(r"""
+    "(?:\\.|[^"\\])*" | '(?:\\.|[^'\\])*'
+  | (?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?\w*
+  | [A-Za-z_]\w*
+  | <<= | >>= | <=> | -> | :: | \+\+ | -- | && | \|\| | == | != | <= | >=
+  | << | >> | [-+*/%&|^]=
+  | [^\s\w]
+""", re.VERBOSE)
+
+# Top-level operators that bind weaker than &&, an expression containing one of
+# them can't be split into &&-terms
+weaker_than_and = {"||", "or", "?", ":", ",", "=", "+=", "-=", "*=", "/=",
+                   "%=", "&=", "|=", "^=", "<<=", ">>="}
+
+def tokenize(expr):
+    """ Split a C++ expression string into its tokens.
+    """
+    return token_pattern.findall(expr)
+
+def nesting_depths(tokens):
+    """ Bracket depth of each token (brackets count as inside).
+    """
+    depths = []
+    depth = 0
+    for token in tokens:
+        if token in ("(", "[", "{"):
+            depth += 1
+        depths.append(depth)
+        if token in (")", "]", "}"):
+            depth -= 1
+    return depths
+
+def strip_outer_parentheses(tokens):
+    """ Remove parentheses that enclose the full token list (repeatedly).
+    """
+    while len(tokens) > 1 and tokens[0] == "(" and tokens[-1] == ")":
+        depth = 0
+        for i, token in enumerate(tokens):
+            if token == "(":
+                depth += 1
+            elif token == ")":
+                depth -= 1
+            # Opening bracket closed before the end -> not enclosing everything
+            if depth == 0 and i < len(tokens) - 1:
+                return tokens
+        tokens = tokens[1:-1]
+    return tokens
+
+def canonical_expr(expr):
+    """ Canonical form of a C++ expression string: the tokens separated by
+        single spaces (so whitespace doesn't matter but operators are kept
+        apart), without enclosing parentheses.
+    """
+    return " ".join(strip_outer_parentheses(tokenize(expr)))
+
+def canonical_terms(expr):
+    """ Split a filter expression into the canonical terms of its top-level
+        conjunction (&&), so that the order in which cuts are combined does not
+        matter. Expressions with top-level operators that bind weaker than &&
+        (e.g. ||) are kept as a single term.
+        Each term is a valid expression equivalent to the original part.
+    """
+    tokens = strip_outer_parentheses(tokenize(expr))
+    depths = nesting_depths(tokens)
+    top_level = [token for token, depth in zip(tokens, depths) if depth == 0]
+    if any(token in weaker_than_and for token in top_level):
+        return frozenset([" ".join(tokens)])
+
+    terms = []
+    term = []
+    for token, depth in zip(tokens, depths):
+        if depth == 0 and token in ("&&", "and"):
+            terms.append(term)
+            term = []
+        else:
+            term.append(token)
+    terms.append(term)
+    return frozenset(" ".join(strip_outer_parentheses(term)) 
+                     for term in terms if len(term) > 0)
+
+# ------------------------------------------------------------------------------
+
+class BookingCache:
+    """ Booked nodes and results that are shared between all BookedRDF nodes
+        of one RDataFrame graph.
+    """
+    def __init__(self):
+        self.nodes = {}
+        self.results = {}
+        self.n_reused = 0
+
+    def n_booked(self):
+        """ Number of distinct nodes and results that were booked.
+        """
+        return len(self.nodes) + len(self.results)
+
+# ------------------------------------------------------------------------------
+
+class BookedRDF:
+    """ Wrapper around an RDataFrame node that canonicalises the Filter/Define
+        expressions and the histogram/result bookings and reuses already booked
+        nodes and result pointers.
+        Methods that are not wrapped are forwarded to the underlying node.
+    """
+    def __init__(self, rdf, cache=None, key=(frozenset(), frozenset())):
+        self.rdf = rdf
+        self.cache = BookingCache() if cache is None else cache
+        self.key = key # (filter terms, defined columns)
+        self.cache.nodes[key] = self
+
+    def __getattr__(self, name):
+        return getattr(self.rdf, name)
+
+    def get_node(self, key, book):
+        """ Return the node with the given key, book it if it doesn't exist.
+        """
+        if key == self.key:
+            return self
+        if key in self.cache.nodes:
+            self.cache.n_reused += 1
+            return self.cache.nodes[key]
+        return BookedRDF(book(), self.cache, key)
+
+    def get_result(self, key, book):
+        """ Return the result pointer with the given key, book it if it doesn't
+            exist.
+        """
+        key = (self.key,) + key
+        if key in self.cache.results:
+            self.cache.n_reused += 1
+            log.debug("Reusing booked result {}".format(key[1:]))
+        else:
+            self.cache.results[key] = book()
+        return self.cache.results[key]
+
+    def Filter(self, expr, *args):
+        terms, defines = self.key
+        key = (terms | canonical_terms(expr), defines)
+        return self.get_node(key, lambda: self.rdf.Filter(expr, *args))
+
+    def Define(self, name, expr):
+        terms, defines = self.key
+        key = (terms, defines | {(name, canonical_expr(expr))})
+        return self.get_node(key, lambda: self.rdf.Define(name, expr))
+
+    def Count(self):
+        return self.get_result(("Count",), lambda: self.rdf.Count())
+
+    def Mean(self, column):
+        return self.get_result(("Mean", column), lambda: self.rdf.Mean(column))
+
+    def Sum(self, column):
+        return self.get_result(("Sum", column), lambda: self.rdf.Sum(column))
+
+    # Histogram name and title (first two model entries) don't affect the result
+    def Histo1D(self, model, *columns):
+        return self.get_result(("Histo1D", tuple(model[2:]), columns),
+                               lambda: self.rdf.Histo1D(model, *columns))
+
+    def Histo2D(self, model, *columns):
+        return self.get_result(("Histo2D", tuple(model[2:]), columns),
+                               lambda: self.rdf.Histo2D(model, *columns))
+
+    def Histo3D(self, model, *columns):
+        return self.get_result(("Histo3D", tuple(model[2:]), columns),
+                               lambda: self.rdf.Histo3D(model, *columns))
+
+# ------------------------------------------------------------------------------
@@ -1,18 +1,13 @@
 import ROOT
 import logging as log
 import math
-import sys
 
 # Local modules
-sys.path.append("../Core")
-import CreatePrEWInput as CPI
-sys.path.append("../IO")
-import InputHelpers as IH
-import OutputHelpers as OH
-sys.path.append("../ROOTHelp")
-import DistrHelpers as DH
-sys.path.append("../Systematics")
-import SystematicsOptions as SSO
+from PrEWInputProduction.Core import ParallelProduction as PP
+from PrEWInputProduction.IO import InputHelpers as IH
+from PrEWInputProduction.IO import OutputHelpers as OH
+from PrEWInputProduction.ROOTHelp import DistrHelpers as DH
+from PrEWInputProduction.Systematics import SystematicsOptions as SSO
 
 # ------------------------------------------------------------------------------
 
@@ -20,7 +15,6 @@ def main():
     """ Run the SingleW code for different cases.
     """
     log.basicConfig(level=log.WARNING) # Set logging level
-    ROOT.EnableImplicitMT() # Enable multithreading in RDataFrame
     ROOT.gROOT.SetBatch(True) # Don't show graphics at runtime
 
     # Input
@@ -47,27 +41,34 @@ def main():
         DH.Coordinate("m_enu", 20, 0.0, 240.0) # in Data min and max are 0.118263 and 238.599915 
     ]
 
+    # Collect all distributions, they are filled in one event loop per input
+    # and the inputs are processed in parallel
+    batch = PP.ParallelPrEWInputBatch()
+
     # Create distributions for opposite-sign chiralities (both charges)
     for input in inputs_os:
-      CPI.create_PrEW_input(
+      batch.add(
         input = input, coords = coords, 
         output = OH.OutputInfo( output_dir, distr_name = "SingleW_eminus", create_plots = create_plots), 
         cuts = "(e_charge == -1)")
-      CPI.create_PrEW_input(
+      batch.add(
         input = input, coords = coords, 
         output = OH.OutputInfo( output_dir, distr_name = "SingleW_eplus", create_plots = create_plots), 
         cuts = "(e_charge == +1)")
 
     # Create distributions for same-sign chiralities
-    CPI.create_PrEW_input(
+    batch.add(
       input = input_RR, coords = coords, 
       output = OH.OutputInfo( output_dir, distr_name = "SingleW_eminus", create_plots = create_plots), 
       cuts = "(e_charge == -1)")
-    CPI.create_PrEW_input(
+    batch.add(
       input = input_LL, coords = coords, 
       output = OH.OutputInfo( output_dir, distr_name = "SingleW_eplus", create_plots = create_plots), 
       cuts = "(e_charge == +1)")
     
+    # Run the event loops and write the PrEW input
+    batch.run()
+
     print("Done.")
 
 # ------------------------------------------------------------------------------
@@ -1,18 +1,23 @@
 import logging as log
 import numpy as np
 import ROOT
-import scipy.optimize as opt
-import sys
-from tqdm import tqdm
 
 # Local modules
-sys.path.append("../IO")
-import OutputHelpers as OH
-sys.path.append("../ROOTHelp")
-import DistrHelpers as DH
+from PrEWInputProduction.Fitting import LinearFits as LF
+from PrEWInputProduction.IO import OutputHelpers as OH
+from PrEWInputProduction.ROOTHelp import DistrHelpers as DH
+from PrEWInputProduction.ROOTHelp import RDFActions as RA
 
 # ------------------------------------------------------------------------------
 
+def get_costh_box(cut_val, center_shift, width_shift):
+  """ Get the (lower, upper) boundary of the cos(theta) acceptance box for the
+      given cut values (see get_costh_cut).
+  """
+  pos_cut =   abs(cut_val) + center_shift + width_shift/2.0
+  neg_cut = - abs(cut_val) + center_shift - width_shift/2.0
+  return neg_cut, pos_cut
+
 def get_costh_cut(cut_val, center_shift, width_shift, costh_branch):
   """ Get the string that describes the cos(theta) cut for the given cut values.
       Four inputs are needed:
@@ -21,8 +26,7 @@ def get_costh_cut(cut_val, center_shift, width_shift, costh_branch):
         The change that of the acceptance width (width_shift).
         The name of the cos(Theta) branch.
   """
-  pos_cut =   abs(cut_val) + center_shift + width_shift/2.0
-  neg_cut = - abs(cut_val) + center_shift - width_shift/2.0
+  neg_cut, pos_cut = get_costh_box(cut_val, center_shift, width_shift)
   cut_str = "({} > {}) && ({} < {})".format(costh_branch, neg_cut, costh_branch,
                                             pos_cut)
   return cut_str
@@ -51,139 +55,176 @@ def muon_acc_factor(coords, k_0, k_c, k_w, k_c2, k_w2, k_cw):
          
 # ------------------------------------------------------------------------------
 
-def get_exact_coefs(R, delta):
-  """ Exactly calculate the coefficients of the 2D quadratic polynomial by
-      solving the linear equation system for the 6 coefficients given 6 points.
-      The points:
-        # | delta_c [delta] | delta_w [delta]
-        0 |  0              |  0
-        1 |  0              |  2
-        2 |  0              | -2
-        3 |  0.5            |  2
-        4 | -0.5            | -2
-        5 |  1              | -2 
-      In addition, the value for delta is needed.
+def muon_acc_design(cut_deltas):
+  """ Design matrix of the (linear in the coefficients) muon acceptance factor
+      for the given cut deviation points [[dcenter],[dwidth]], the columns 
+      belong to k_0, k_c, k_w, k_c2, k_w2, k_cw.
   """
-  if (len(R) != 6):
-    raise ValueError("Need exactly 6 points to solve equation system, got {}.".format(len(R)))
-    
-  return [
-    R[0],
-    1.0/delta * ( - R[1] + R[2] + R[3] - R[4]),
-    1.0/(4.0*delta) * ( R[1] - R[2] ),
-    2.0/(3.0*delta**2) * ( -3.0 * R[2] + 2.0 * R[4] + R[5]),
-    1.0/(8.0*delta**2) * ( -2.0 * R[0] + R[1] + R[2]),
-    1.0/delta**2 * (-1.0/2.0 * R[1] + 1.0/2.0 * R[3] + 1.0/6.0 * R[4] - 1.0/6.0 * R[5])
-  ]
-  
-def get_fitted_coefs(cut_deltas, R, sigma, coefs_ini):
-  """ Perform fit to extract the coefficients of the 2D quadratic polynomial
-      using a wider array of points:
-      - First try to estimate an uncertainty on the bin values using the 
-        MC statistics uncertainty
-      - Check if that leads to a good initial chi^2, if not scale the 
-        uncertainties
-      - Then perform fit using all points
-      Needs:
-        cut_deltas ... cut deviation values for each point
-        R ... value at each point
-        sigma ... estimation of uncertainty on R at each point
-        coefs_ini ... initial guess for coefficients
-  """
-  # Determine fit starting point
-  R_prefit = muon_acc_factor(np.array(cut_deltas), coefs_ini[0], coefs_ini[1], coefs_ini[2], coefs_ini[3], coefs_ini[4], coefs_ini[5])
-  
-  # Check if sigma needs to be enlarged to get better behaved chi-squared
-  chi_sq_ndf = np.sum( ( ( R_prefit - np.array(R) ) / np.array(sigma) )**2 ) / (len(R) - len(coefs_ini))
-  if (chi_sq_ndf > 3) or ((chi_sq_ndf > 1e-15) and (chi_sq_ndf < 0.1)):
-    sigma = [ s * np.sqrt(chi_sq_ndf) for s in sigma ]
-      
-  # Perform fit
-  coefs, cov = opt.curve_fit(muon_acc_factor, cut_deltas, R, sigma=sigma, p0=coefs_ini)
-  return coefs
+  delta_c, delta_w = np.array(cut_deltas)
+  return np.stack([ np.ones(len(delta_c)), delta_c, delta_w, 
+                    delta_c**2, delta_w**2, delta_c * delta_w ], axis=1)
 
 # ------------------------------------------------------------------------------
 
-def get_coef_data(hist_nocut, hist_0, hist_1, hist_2, hist_3, hist_4, hist_5, 
-                  delta, cut_deltas, hists):
+def get_coef_data(N_nocut, cut_deltas, N_cut):
   """ Calculate all the coefficients and return them in a dictionary that can be
       written out by pandas into CSV.
-      A two step approach is used:
-        1. Six specific cuts are used to solve the linear equations for a first
-           estimate of the coefficients.
-        2. Using the first estimates as starting values, and a larger number of
-           cuts, a fit is performed to get more accurate coefficients.
-      Seven histograms are needed for the first step:
-        - original without any cut at all
-        - 6 histograms with cuts at predetermined points to determine the
-          polynomial coefficients.
+      The factor is linear in the coefficients, so the fit in each bin is a
+      weighted linear least-squares problem which is solved for all bins at 
+      once. The uncertainty on the ratios is estimated from the MC statistics.
+      (Scaling the uncertainties to get a better behaved chi^2 only affects the
+      coefficient covariance, not the coefficients, so that is not needed.)
+      The bin contents are needed as arrays:
+        - N_nocut: original without any cut at all (n_bins)
+        - N_cut: cuts at the cut_deltas points used in the fit (K x n_bins)
   """
-  hists_ini = [hist_0, hist_1, hist_2, hist_3, hist_4, hist_5]
+  N_nocut = np.asarray(N_nocut, dtype=float)
+  N_cut = np.asarray(N_cut, dtype=float)
+  coefs = np.zeros((len(N_nocut), 6))
   
-  # Coefficients to collect:
-  k_0 = []
-  k_c = []
-  k_w = []
-  k_c2 = []
-  k_w2 = []
-  k_cw = []
+  # Check if there are too few MC events to say anything about the behaviour
+  insufficient = N_nocut < 3.5
+  coefs[insufficient,0] = 1.0 # Constant term 1, all other 0
+  insufficient_MC_bins = np.count_nonzero(insufficient)
   
-  # Doing this in loop instead of with TH1-operators to control each case
-  bin_range = DH.get_bin_range(hist_nocut)
-  insufficient_MC_bins = 0 # Count the number of bins w/ insufficient MC
-  for bin in tqdm(bin_range, desc="Calculate muon acc. coefs"):
-    # Skip overflow and underflow bins
-    if hist_nocut.IsBinUnderflow(bin) or hist_nocut.IsBinOverflow(bin): 
-      continue
-      
-    N_nocut = hist_nocut.GetBinContent(bin)
+  # Ratios in each bin for each cut point
+  N = np.where(insufficient, 1.0, N_nocut)
+  R = N_cut / N
+  
+  # Check if the different points differ at all, if not set constant term to 
+  # the value (equal for all), other terms to 0
+  constant = (~insufficient) & np.all(R == R[0], axis=0)
+  coefs[constant,0] = R[0,constant]
+  
+  # Fit all other bins, first get some uncertainty estimate on the ratios
+  fit = ~(insufficient | constant)
+  if np.any(fit):
+    sigma = np.where(N_cut == 0, 1.0/np.sqrt(N), np.sqrt(N_cut)/N)
+    coefs[fit] = LF.batched_weighted_lstsq(muon_acc_design(cut_deltas), 
+                                           R[:,fit], sigma[:,fit])
+  
+  if (insufficient_MC_bins > 0):
+    log.info("Had to skip {} bins due to insufficient MC.".format(insufficient_MC_bins))
+
+  return {"MuonAcc_k0": coefs[:,0], 
+          "MuonAcc_kc": coefs[:,1], "MuonAcc_kw": coefs[:,2], 
+          "MuonAcc_kc2": coefs[:,3], "MuonAcc_kw2": coefs[:,4], 
+          "MuonAcc_kcw": coefs[:,5]}
+
+# ------------------------------------------------------------------------------
+
+class MuonAccScan:
+  """ Acceptance-scan engine: collects for each analysis bin the sorted 
+      smallest and largest cos(theta) (over all given branches) of the events
+      in a single pass.
+      The yield for any box cut can then be calculated without another event 
+      loop, an event passes the cut (low, high) if min > low and max < high.
+  """
+  
+  def __init__(self, rdf, coords, costh_branch):
+    """ Books the collection of the needed columns on the dataframe.
+    """
+    # Need branch(es) as array, and allow passing as string
+    if isinstance(costh_branch, str):
+      costh_branch = [costh_branch]
+    
+    self.n_bins = RA.n_bins_total(coords)
+    
+    rdf_bin, bin_column = RA.define_flat_bin(rdf, coords)
+    rdf_bin = rdf_bin.Filter("{} >= 0".format(bin_column)) # No under/overflow
+    rdf_ext, min_column, max_column = RA.define_extremes(rdf_bin, costh_branch)
     
-    # Check if there are too few MC events to say anything about the behaviour
-    if (N_nocut < 3.5):
-      k_0.append(1.0) # Constant term 1, all other 0
-      for k in [k_c, k_w, k_c2, k_w2, k_cw]:
-        k.append(0.0)
-      insufficient_MC_bins += 1
-      continue 
+    # The Take actions of one dataframe keep the same event order
+    self.bin_ptr = rdf_ext.Take['long long'](bin_column)
+    self.min_ptr = rdf_ext.Take['double'](min_column)
+    self.max_ptr = rdf_ext.Take['double'](max_column)
+    
+    self.filled_bins = None
+    self.bin_offsets = None
+    self.mins = None # Sorted min values in each bin
+    self.maxs = None # Sorted max values in each bin
+    self.max_by_min = None # Max values in each bin sorted by their min value
+    
+  def sort_values(self):
+    """ Sort the collected values in each bin (only done once).
+    """
+    if self.bin_offsets is not None:
+      return
       
-    # Ratios in this bin for each histogram (with different cut points)
-    R_ini = np.array([float(hist.GetBinContent(bin)) / N_nocut for hist in hists_ini])
-    R = np.array([float(hist.GetBinContent(bin)) / N_nocut for hist in hists])
+    bins = np.array(self.bin_ptr.GetValue())
+    mins = np.array(self.min_ptr.GetValue())
+    maxs = np.array(self.max_ptr.GetValue())
     
-    # Check if the different points differ at all
-    if (np.all(R == R[0])):
-      # Set constant term to the value (equal for all), other terms to 0
-      k_0.append(R[0]) 
-      for k in [k_c, k_w, k_c2, k_w2, k_cw]:
-        k.append(0.0)
-      continue # No further calulcation necessary
+    # Any cut fails for NaN values, so they never contribute to a yield
+    valid = ~(np.isnan(mins) | np.isnan(maxs))
+    bins, mins, maxs = bins[valid], mins[valid], maxs[valid]
     
-    # Analytical calculation of initial guess for coefficients
-    initial_guess = get_exact_coefs(R_ini, delta)
+    min_order = np.lexsort((mins, bins))
+    max_order = np.lexsort((maxs, bins))
     
-    # Now perform fit using wider array of points
-    sigma = [] # First get some uncertainty estimate on the ratios
-    for hist in hists:
-      if float(hist.GetBinContent(bin)) == 0:
-        sigma.append(1.0/np.sqrt(N_nocut))
-      else:
-        sigma.append(np.sqrt(hist.GetBinContent(bin))/N_nocut)
-    coefs = get_fitted_coefs(cut_deltas, R, sigma, initial_guess)
+    # Only filled bins are stored (memory doesn't scale with the total number)
+    self.filled_bins, starts = np.unique(bins[min_order], return_index=True)
+    self.bin_offsets = np.append(starts, len(bins))
+    self.mins = mins[min_order]
+    self.maxs = maxs[max_order]
+    self.max_by_min = maxs[min_order]
     
-    # Extract final coefficients
-    k_0.append( coefs[0] )
-    k_c.append( coefs[1] )
-    k_w.append( coefs[2] )
-    k_c2.append( coefs[3] )
-    k_w2.append( coefs[4] )
-    k_cw.append( coefs[5] )
-
-  if (insufficient_MC_bins > 0):
-    log.info("Had to skip {} bins due to insufficient MC.".format(insufficient_MC_bins))
+  def yields(self, boxes, bins=None):
+    """ Number of events in each bin that pass the given cut boxes 
+        [(low, high), ...], returned as (K x n_bins) array.
+        If (sorted) flat bin indices are given only those bins are returned.
+    """
+    self.sort_values()
+    lows = np.array([low for low, high in boxes])
+    highs = np.array([high for low, high in boxes])
+    
+    if bins is None:
+      bins = np.arange(self.n_bins)
+    bins = np.asarray(bins)
+    
+    yields = np.zeros((len(boxes), len(bins)))
+    for i_filled, filled_bin in enumerate(self.filled_bins):
+      bin = np.searchsorted(bins, filled_bin)
+      if bin == len(bins) or bins[bin] != filled_bin:
+        continue
+      start = self.bin_offsets[i_filled]
+      end = self.bin_offsets[i_filled+1]
+      n = end - start
+      
+      # Events failing the lower/upper cut
+      n_low = np.searchsorted(self.mins[start:end], lows, side="right")
+      n_high = n - np.searchsorted(self.maxs[start:end], highs, side="left")
+      
+      # Events failing both cuts are subtracted twice, they are all within the
+      # events that fail the lower cut (usually very few)
+      n_both = np.zeros(len(boxes))
+      n_low_max = np.max(n_low)
+      if n_low_max > 0:
+        max_by_min = self.max_by_min[start:start+n_low_max]
+        fails_both = (max_by_min[None,:] >= highs[:,None]) \
+                     & (np.arange(n_low_max)[None,:] < n_low[:,None])
+        n_both = np.sum(fails_both, axis=1)
+        
+      yields[:,bin] = n - n_low - n_high + n_both
+    return yields
+    
+  def yields_for_cut(self, cut_val, center_shift, width_shift):
+    """ Number of events in each bin that pass the given cut (see 
+        get_costh_cut).
+    """
+    return self.yields([get_costh_box(cut_val, center_shift, width_shift)])[0]
 
-  return {"MuonAcc_k0": k_0, 
-          "MuonAcc_kc": k_c, "MuonAcc_kw": k_w, 
-          "MuonAcc_kc2": k_c2, "MuonAcc_kw2": k_w2, "MuonAcc_kcw": k_cw}
+class ScanYieldsPtr:
+  """ Result pointer of the yields of the given cut boxes from a MuonAccScan,
+      same interface as RDFActions.StackedHistPtr.
+  """
+  
+  def __init__(self, scan, boxes):
+    self.scan = scan
+    self.boxes = boxes
+    
+  def GetValue(self, bins=None):
+    return self.scan.yields(self.boxes, bins)
 
 # ------------------------------------------------------------------------------
 
@@ -198,13 +239,18 @@ class MuonAccParametrisation:
         - by keeping the center constant and changing the width (width_shift).
   """
   
-  def __init__(self, rdf, cut_val, delta, costh_branch, distr_name, coords):
+  def __init__(self, rdf, cut_val, delta, costh_branch, distr_name, coords,
+               scan=None):
     """ Takes four cut-related inputs:
           The dataframe that can be used to extract the changes with the cuts.
           The initial cut value which is the same on both side (+-cos(theta)).
           The deviation that is used in the test to find the cut-dependence.
           The name of the cos(Theta_muon) branch (can be string or array).
         And two histogram-related input (name and coordinate information).
+        If a MuonAccScan is given the cut variations are evaluated from it
+        instead of being filled in the event loop.
+        Without dataframe (rdf=None) nothing is booked and the result pointers
+        have to be set from cached results.
     """
     self.cut_val = cut_val
     self.delta = delta
@@ -214,25 +260,8 @@ class MuonAccParametrisation:
     if isinstance(costh_branch, str):
       costh_branch = [costh_branch]
     
-    # These six points are used to find initial estimates for the coefficients
-    rdf_0 =  rdf.Filter(get_ndim_costh_cut(cut_val, 0, 0, costh_branch))
-    rdf_1 =  rdf.Filter(get_ndim_costh_cut(cut_val, 0, 2.0*delta, costh_branch))
-    rdf_2 =  rdf.Filter(get_ndim_costh_cut(cut_val, 0, -2.0*delta, costh_branch))
-    rdf_3 =  rdf.Filter(get_ndim_costh_cut(cut_val, 0.5*delta, 2.0*delta, costh_branch))
-    rdf_4 =  rdf.Filter(get_ndim_costh_cut(cut_val, -0.5*delta, -2.0*delta, costh_branch))
-    rdf_5 =  rdf.Filter(get_ndim_costh_cut(cut_val, delta, -2.0*delta, costh_branch))
-    
-    self.histptr_nocut =  DH.get_hist_ptr(rdf, distr_name + "_nocut", coords)
-    self.histptr_0 = DH.get_hist_ptr(rdf_0, distr_name + "_0", coords)
-    self.histptr_1 = DH.get_hist_ptr(rdf_1, distr_name + "_1", coords)
-    self.histptr_2 = DH.get_hist_ptr(rdf_2, distr_name + "_2", coords)
-    self.histptr_3 = DH.get_hist_ptr(rdf_3, distr_name + "_3", coords)
-    self.histptr_4 = DH.get_hist_ptr(rdf_4, distr_name + "_4", coords)
-    self.histptr_5 = DH.get_hist_ptr(rdf_5, distr_name + "_5", coords)
-  
-    # These points below (larger grid of points) is used to fit the coefficients
+    # This grid of points is used to fit the coefficients
     self.cut_deltas = [[],[]] # Cut values [[dcenter],[dwidth]]
-    self.hist_ptrs = [] # Histograms at those cut values
     d_vals = np.array([-1.5, -1, -0.5, 0, 0.5, 1, 1.5])*delta
     d_max = 1.5*delta * 1.001 # *1.001 for numerical uncertainty
     for dc in d_vals:
@@ -240,29 +269,39 @@ class MuonAccParametrisation:
         # Restrict to a circle of 1.5 to avoid too much weight on outer points
         if np.sqrt(dc**2 + dw**2) > d_max:
           continue
-        
-        # Set up the cut test
         self.cut_deltas[0].append(dc)
         self.cut_deltas[1].append(dw)
-        rdf_cut = rdf.Filter(get_ndim_costh_cut(cut_val, dc, dw, costh_branch))
-        self.hist_ptrs.append( DH.get_hist_ptr(rdf_cut, distr_name + "_cut_{}_{}".format(dc,dw), coords) )
+    
+    # All cut points are filled in a single stacked histogram action
+    self.boxes = [get_costh_box(cut_val, dc, dw) 
+                  for dc, dw in zip(*self.cut_deltas)]
+    if rdf is None:
+      self.histptr_nocut = None
+      self.cutptr = None
+      return
+    self.histptr_nocut =  DH.get_hist_ptr(rdf, distr_name + "_nocut", coords)
+    if scan is not None:
+      self.cutptr = ScanYieldsPtr(scan, self.boxes)
+    else:
+      self.cutptr = RA.get_multi_cut_ptr(rdf, distr_name + "_cuts", coords,
+                                         costh_branch, self.boxes)
   
-  def add_coefs_to_data(self, distr_data):
+  def get_cut_values(self, bins=None):
+    """ Bin contents for all cut points (K x n_bins), optionally only for the
+        given flat bin indices.
+    """
+    return self.cutptr.GetValue(bins)
+  
+  def add_coefs_to_data(self, distr_data, bins=None):
     """ Parametrisation uses 2nd order polynomial approach for 2 parameters.
         Details are not described here (probably in PrEW, else in thesis).
-        Coefficients are added to data.
+        Coefficients are added to data (for the given flat bin indices if the
+        data only contains those bins).
     """
-    hist_nocut = self.histptr_nocut.GetValue()
-    hist_0 = self.histptr_0.GetValue()
-    hist_1 = self.histptr_1.GetValue()
-    hist_2 = self.histptr_2.GetValue()
-    hist_3 = self.histptr_3.GetValue()
-    hist_4 = self.histptr_4.GetValue()
-    hist_5 = self.histptr_5.GetValue()
-    hists = [histptr.GetValue() for histptr in self.hist_ptrs]
+    N_nocut = DH.get_values(self.histptr_nocut.GetValue(), bins)
+    N_cut = self.get_cut_values(bins)
     
-    coef_data = get_coef_data(hist_nocut, hist_0, hist_1, hist_2, hist_3, 
-                              hist_4, hist_5, self.delta, self.cut_deltas, hists)
+    coef_data = get_coef_data(N_nocut, self.cut_deltas, N_cut)
     
     for coef_name, coefs in coef_data.items():
         distr_data["Coef:{}".format(coef_name)] = coefs
@@ -275,10 +314,15 @@ class MuonAccParametrisation:
         seen anyway).
     """
     hist_nocut = self.histptr_nocut.GetValue()
-    hist_cut = self.histptr_0.GetValue()
     if not hist_nocut.GetDimension() == 1:
       log.error("Cut plotting not implemented for histograms with dim != 1")
       return
+    
+    # Histogram with the cut without deviations
+    i_nominal = list(zip(*self.cut_deltas)).index((0, 0))
+    hist_cut = hist_nocut.Clone("{}_0".format(hist_nocut.GetName()))
+    for bin, N_cut in enumerate(self.get_cut_values()[i_nominal]):
+      hist_cut.SetBinContent(bin+1, N_cut)
       
     # Plot the two histograms
     canvas = ROOT.TCanvas("c_{}_CutEffect".format(hist_cut.GetName()))
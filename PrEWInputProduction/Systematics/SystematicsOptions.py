@@ -5,10 +5,14 @@ class SystematicsOptions:
       considered.
   """
   
-  def __init__(self, use_muon_acc=False, costh_branch="costh"):
+  def __init__(self, use_muon_acc=False, costh_branch="costh", 
+               muon_acc_mode="stacked"):
     """ All the potential options can be set here and are turned off by default.
+        The muon acceptance cut variations can either be filled directly 
+        ("stacked") or evaluated from the per-bin cos(theta) values ("scan").
     """
     self.use_muon_acc = use_muon_acc
     self.costh_branch = costh_branch # Can be str or array of str
+    self.muon_acc_mode = muon_acc_mode
     
 # ------------------------------------------------------------------------------
\ No newline at end of file
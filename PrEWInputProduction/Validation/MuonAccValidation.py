@@ -5,20 +5,17 @@
 
 # ------------------------------------------------------------------------------
 
-import ctypes
 import logging as log
 import numpy as np
 import pandas as pd
-import sys
 
 # Local modules
-sys.path.append("../IO")
-import CSVMetadata as CSVM
-import OutputHelpers as OH
-sys.path.append("../ROOTHelp")
-import DistrHelpers as DH
-sys.path.append("../Systematics")
-import MuonAcceptance as SMA
+from PrEWInputProduction.IO import BinaryOutput as BO
+from PrEWInputProduction.IO import CSVMetadata as CSVM
+from PrEWInputProduction.IO import OutputHelpers as OH
+from PrEWInputProduction.ROOTHelp import DistrHelpers as DH
+from PrEWInputProduction.ROOTHelp import RDFActions as RA
+from PrEWInputProduction.Systematics import MuonAcceptance as SMA
 
 # ------------------------------------------------------------------------------
 
@@ -47,61 +44,19 @@ def binned_muon_acc_factors(coef_data, delta_c, delta_w):
 
 # ------------------------------------------------------------------------------
 
-class SingleCutTest:
-  """ Class for everything needed to test a single cut value.
-  """
-  
-  def __init__(self, rdf, cut_val, delta_c, delta_w, costh_branch, distr_name, coords):
-    rdf_filtered = rdf.Filter(SMA.get_ndim_costh_cut(cut_val, delta_c, delta_w, costh_branch))
-    cut_distr_name = "{}_dc{}_dw{}".format(distr_name, delta_c, delta_w)
-    self.hist_cut_ptr = DH.get_hist_ptr(rdf_filtered, cut_distr_name, coords)
-    self.hist_cut = None
-    self.hist_par = None
-    
-    self.delta_c = delta_c # Cut values
-    self.delta_w = delta_w
-    
-  def evaluate(self, coef_data, hist_nocuts):
-    """ Evaluates the histograms of the test for both the actual cut and the
-        parametrisation of the cut.
-        Requires the coefficients and the histogram without cuts to calculate
-        the parametrised cut effect.
-    """
-    self.hist_cut = self.hist_cut_ptr.GetPtr()
-    
-    self.hist_par = hist_nocuts.Clone()
-    self.hist_par.SetName("{}_par".format(self.hist_cut.GetName()))
-    
-    # Get the factors that describe the result of the parametrisation
-    factors = binned_muon_acc_factors(coef_data, self.delta_c, self.delta_w)
-    
-    i = 0 # bin index not including under/over-flow
-    for bin in DH.get_bin_range(self.hist_cut):
-      # Skip overflow and underflow bins
-      if self.hist_cut.IsBinUnderflow(bin) or self.hist_cut.IsBinOverflow(bin): 
-        continue
-      
-      # Determine the factor for the bin (caused by the cut)  
-      factor = factors[i]
-      if factor > 1:
-        factor = 1
-      elif factor < 0:
-        factor = 0
-    
-      # Scale the current bin 
-      self.hist_par.SetBinContent(bin, factor*self.hist_par.GetBinContent(bin))
-      i += 1 # Increment bin index without under/over-flow
-
-# ------------------------------------------------------------------------------
-
 class MuonAccValidator:
   """ Class that performs tests of the validity of the muon acceptance 
       parametrisation.
   """
   
-  def __init__(self, rdf, cut_val, delta, costh_branch, distr_name, coords):
+  def __init__(self, rdf, cut_val, delta, costh_branch, distr_name, coords,
+               scan=None):
     """ Essentially the same as muon acceptance calculation itself, uses way 
         more points to test.
+        If a MuonAccScan is given the tested cuts are evaluated from it instead
+        of being filled in the event loop.
+        Without dataframe (rdf=None) nothing is booked and the result pointers
+        have to be set from cached results.
     """
     self.cut_val = cut_val
     self.delta = delta
@@ -124,62 +79,58 @@ class MuonAccValidator:
         else:
           self.test_vals.append([dc*delta,dw*delta])
         
-    # Set up tests
-    self.tests = [SingleCutTest(rdf, cut_val, delta_c, delta_w, costh_branch, distr_name, coords) for delta_c, delta_w in self.test_vals]
+    # Set up tests, all cut points are filled in a single stacked histogram
+    self.boxes = [SMA.get_costh_box(cut_val, delta_c, delta_w) 
+                  for delta_c, delta_w in self.test_vals]
+    if rdf is None:
+      self.cutptr = None
+      self.histptr_nocut = None
+      return
+    if scan is not None:
+      self.cutptr = SMA.ScanYieldsPtr(scan, self.boxes)
+    else:
+      self.cutptr = RA.get_multi_cut_ptr(rdf, distr_name + "_val_cuts", coords,
+                                         costh_branch, self.boxes)
     self.histptr_nocut =  DH.get_hist_ptr(rdf, distr_name + "_nocut_val", coords)
 
   def write_validation_data(self, coef_data, output, base_name, metadata, 
-                            n_total, cross_section):
+                            n_total, cross_section, bins=None):
     """ Write the histogram data for all the validation histograms to the 
         output directory.
+        If flat bin indices are given (coef_data only contains those bins) 
+        only those bins are validated.
+        Returns the paths of the validation data files (one per output 
+        format).
     """
     hist_nocuts = self.histptr_nocut.GetPtr()
-    dim = hist_nocuts.GetDimension()
-      
-    # Find the histogram that has the cut without deviations
-    hist_0_arr = [test for test in self.tests if (test.delta_c == 0 and test.delta_w == 0)]
-    if not len(hist_0_arr) == 1:
-      raise ValueError("Didn't find exactly one zero-cut array, found {}".format(len(hist_0_arr)))
-    hist_0 = hist_0_arr[0].hist_cut_ptr.GetPtr()
-    
-    # Get the bin_indices without under/overflow bins:
-    bin_range = DH.get_bin_range(hist_nocuts)
-    n_bins = len(bin_range)
     
     # --- Determine the csv data for validation --------------------------------
     
+    # Bin values with the true cuts and from the parametrisation (K x n_bins)
+    nocut_values = DH.get_values(hist_nocuts, bins)
+    cut_values = self.cutptr.GetValue(bins)
+    par_values = np.zeros(cut_values.shape)
+    for i_test, (delta_c, delta_w) in enumerate(self.test_vals):
+      # Factor for each bin (caused by the cut), limited to [0,1]
+      factors = binned_muon_acc_factors(coef_data, delta_c, delta_w)
+      par_values[i_test] = np.clip(factors, 0, 1) * nocut_values
+    
     # Create the dictionary for the validation data
     val_data = {
-      "Delta-c" : [],
-      "Delta-w" : []
+      "Delta-c" : [delta_c for delta_c, delta_w in self.test_vals],
+      "Delta-w" : [delta_w for delta_c, delta_w in self.test_vals]
     }
-    for i_bin in range(n_bins):
-      val_data["C{}".format(i_bin)] = [] # Value with true cut
-      val_data["P{}".format(i_bin)] = [] # Value from parametrisation
-    
-    # Get the data from all the tested histograms
-    for test in self.tests:
-      # Evaluate the test histograms
-      test.evaluate(coef_data, hist_nocuts)
-      
-      # Save the tested values
-      val_data["Delta-c"].append(test.delta_c)
-      val_data["Delta-w"].append(test.delta_w)
-      
-      # Get all the bin values from the histogram
-      for i_bin in range(n_bins):
-        bin = bin_range[i_bin] # Histogram-internal bin index
-        val_data["C{}".format(i_bin)].append(test.hist_cut.GetBinContent(bin) ) # Value with true cut
-        val_data["P{}".format(i_bin)].append(test.hist_par.GetBinContent(bin) ) # Value from parametrisation
+    for i_bin in range(cut_values.shape[1]):
+      val_data["C{}".format(i_bin)] = cut_values[:,i_bin] # Value with true cut
+      val_data["P{}".format(i_bin)] = par_values[:,i_bin] # Value from parametrisation
       
     # Create a pandas dataframe
     df = pd.DataFrame(val_data)
 
-    # Write the dataframe to a csv file
+    # Base path of the output files
     val_subdir = "{}/validation".format(output.dir)
     OH.create_dir(val_subdir)
-    file_path = "{}/{}_valdata.csv".format(val_subdir,base_name)
-    df.to_csv(file_path)
+    file_base = "{}/{}_valdata".format(val_subdir,base_name)
 
     # --- Determine all the needed metadata ------------------------------------
     
@@ -190,23 +141,12 @@ class MuonAccValidator:
     coord_maxs = [coord.max for coord in self.coords]
     
     # Get the data for the histogram without any cut
-    nocut_data = [hist_nocuts.GetBinContent(bin) for bin in bin_range]
+    nocut_data = nocut_values.tolist()
     
     # Determine the bin centers
-    bin_centers = []
-    for bin in bin_range:
-      # Find the axis-specific bin indices
-      bin_xyz = [ctypes.c_int(0) for d in range(3)]
-      hist_0.GetBinXYZ(bin,bin_xyz[0],bin_xyz[1],bin_xyz[2])
-      bin_xyz = [int(bin_d.value) for bin_d in bin_xyz]
-          
-      # Find the bin center value for each axis
-      bin_center = [hist_0.GetXaxis().GetBinCenter(bin_xyz[0])]
-      if dim > 1: 
-        bin_center.append(hist_0.GetYaxis().GetBinCenter(bin_xyz[1]))
-      if dim > 2:
-        bin_center.append(hist_0.GetZaxis().GetBinCenter(bin_xyz[2]))
-      bin_centers.append(bin_center)
+    bin_grid = DH.get_bin_grid(hist_nocuts, bins)
+    bin_centers = np.stack([axis_grid["Centers"] for axis_grid in bin_grid], 
+                           axis=1).tolist()
 
     # Attach metadata to beginning of file
     val_metadata = CSVM.CSVMetadata()
@@ -221,7 +161,8 @@ class MuonAccValidator:
     val_metadata["NoCutData"] = nocut_data
     val_metadata["Delta"] = self.delta
 
-    # Attach the metadata to the data file
-    val_metadata.write(file_path)
+    # Write the metadata and the dataframe in the requested formats
+    return BO.write_table(file_base, df, val_metadata, output.formats,
+                          output.float_dtype)
 
 # ------------------------------------------------------------------------------
@@ -1,20 +1,14 @@
 import ROOT
 import logging as log
 import math
-import sys
 
 # Local modules
-sys.path.append("../Core")
-import CreatePrEWInput as CPI
-sys.path.append("../IO")
-import InputHelpers as IH
-import OutputHelpers as OH
-sys.path.append("../Physics")
-import PhysicsOptions as PPO
-sys.path.append("../ROOTHelp")
-import DistrHelpers as DH
-sys.path.append("../Systematics")
-import SystematicsOptions as SSO
+from PrEWInputProduction.Core import ParallelProduction as PP
+from PrEWInputProduction.IO import InputHelpers as IH
+from PrEWInputProduction.IO import OutputHelpers as OH
+from PrEWInputProduction.Physics import PhysicsOptions as PPO
+from PrEWInputProduction.ROOTHelp import DistrHelpers as DH
+from PrEWInputProduction.Systematics import SystematicsOptions as SSO
 
 # ------------------------------------------------------------------------------
 
@@ -22,7 +16,6 @@ def main():
     """ Run the WW code for different cases.
     """
     log.basicConfig(level=log.WARNING) # Set logging level
-    ROOT.EnableImplicitMT() # Enable multithreading in RDataFrame
     ROOT.gROOT.SetBatch(True) # Don't show graphics at runtime
 
     # Input
@@ -51,31 +44,36 @@ def main():
         DH.Coordinate("phi_l_star", 10, -math.pi, math.pi),
     ]
 
-    # Create all WW distributions
+    # Collect all WW distributions, they are filled in one event loop per input
+    # and the inputs are processed in parallel
+    batch = PP.ParallelPrEWInputBatch()
     for input in inputs:
-      CPI.create_PrEW_input(
+      batch.add(
         input = input, coords = coords,
         output = OH.OutputInfo( output_dir, distr_name = "WW_muminus", create_plots = create_plots),
         cuts = "(decay_to_mu == 1) && (l_charge == -1)",
         syst = SSO.SystematicsOptions(use_muon_acc=True,costh_branch="costh_l"),
         phys = phys_options)
-      CPI.create_PrEW_input(
+      batch.add(
         input = input, coords = coords,
         output = OH.OutputInfo( output_dir, distr_name = "WW_muplus", create_plots = create_plots),
         cuts = "(decay_to_mu == 1) && (l_charge == +1)",
         syst = SSO.SystematicsOptions(use_muon_acc=True,costh_branch="costh_l"),
         phys = phys_options)
-      CPI.create_PrEW_input(
+      batch.add(
         input = input, coords = coords,
         output = OH.OutputInfo( output_dir, distr_name = "WW_tauminus", create_plots = create_plots),
         cuts = "(decay_to_tau == 1) && (l_charge == -1)",
         phys = phys_options)
-      CPI.create_PrEW_input(
+      batch.add(
         input = input, coords = coords,
         output = OH.OutputInfo( output_dir, distr_name = "WW_tauplus", create_plots = create_plots),
         cuts = "(decay_to_tau == 1) && (l_charge == +1)",
         phys = phys_options)
 
+    # Run the event loops and write the PrEW input
+    batch.run()
+
     print("Done.")
 
 # ------------------------------------------------------------------------------
@@ -0,0 +1,3 @@
+""" Production of the PrEW input distributions from the ROOT TTrees of the
+    processors (see Readme.md).
+"""
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# ------------------------------------------------------------------------------
+
+""" Command line runner that produces the PrEW input for all distributions
+    described in one or more job files (see Core/ProductionConfig.py), e.g.:
+      prew-produce jobs/WW.toml jobs/DifermionLeptonic.toml --n-cores 64
+    Installed as the prew-produce console script (see pyproject.toml), can
+    also be run as python -m PrEWInputProduction.run_production.
+"""
+
+# ------------------------------------------------------------------------------
+
+import argparse
+import logging as log
+import ROOT
+
+# Local modules
+from PrEWInputProduction.Core import ParallelProduction as PP
+from PrEWInputProduction.Core import ProductionConfig as PC
+from PrEWInputProduction.Core import SamplingOptions as SO
+from PrEWInputProduction.IO import HistogramCache as HC
+from PrEWInputProduction.IO import SkimCache as SC
+
+# ------------------------------------------------------------------------------
+
+def parse_args():
+  parser = argparse.ArgumentParser(
+    description="Produce the PrEW input described in the job file(s).")
+  parser.add_argument("job_files", nargs="+", help="TOML or YAML job files")
+  parser.add_argument("--n-cores", type=int,
+                      help="Total thread budget (default: all cores)")
+  parser.add_argument("--max-workers", type=int,
+                      help="Maximum number of worker processes")
+  parser.add_argument("--engine", choices=["rdf", "numpy"],
+                      help="Histogram filling engine (default: rdf)")
+  parser.add_argument("--force", action="store_true", default=None,
+                      help="Produce also distributions that are up to date")
+  parser.add_argument("--cache-dir", help="Use the histogram cache in this "
+                                          "directory")
+  parser.add_argument("--skim-dir", help="Read the inputs from skims of the "
+                                        "needed branches in this directory")
+  parser.add_argument("--sample-fraction", type=float,
+                      help="Quick look: only use this random fraction of the "
+                           "events")
+  parser.add_argument("--max-entries", type=int,
+                      help="Quick look: only use the first entries of each "
+                           "input (quick looks are written to a sampled/ "
+                           "subdirectory of the output directory)")
+  parser.add_argument("--report", help="Write the JSON profiling report of "
+                                      "the run to this file")
+  parser.add_argument("--cprofile", help="Write the cProfile statistics of "
+                                        "each job to this directory")
+  parser.add_argument("--log-level", default=None,
+                      help="Logging level (default: WARNING)")
+  parser.add_argument("--dry-run", action="store_true",
+                      help="Only print the distributions that would be "
+                           "produced")
+  return parser.parse_args()
+
+def main():
+  """ Expand the job files and run all distributions in the process pool.
+  """
+  args = parse_args()
+  run_options, entries = PC.get_plan(args.job_files)
+
+  # Command line arguments take precedence over the [run] tables
+  def option(name, default=None):
+    value = getattr(args, name)
+    return run_options.get(name, default) if value is None else value
+
+  log.basicConfig(level=option("log_level", "WARNING").upper())
+  ROOT.gROOT.SetBatch(True) # Don't show graphics at runtime
+
+  print("Planned {} distributions.".format(len(entries)))
+  if args.dry_run:
+    for entry in entries:
+      print("\t" + PC.describe(entry))
+    return
+
+  cache = None
+  if option("cache_dir") is not None:
+    cache = HC.HistogramCache(
+      option("cache_dir"),
+      int(run_options.get("cache_max_size_gb", 10) * 1024**3))
+
+  skim_cache = None
+  if option("skim_dir") is not None:
+    skim_cache = SC.SkimCache(
+      option("skim_dir"),
+      int(run_options.get("skim_max_size_gb", 100) * 1024**3))
+
+  batch = PP.ParallelPrEWInputBatch(n_cores=option("n_cores"),
+                                    max_workers=option("max_workers"),
+                                    engine=option("engine", "rdf"),
+                                    force=bool(option("force", False)),
+                                    cache=cache,
+                                    report_path=option("report"),
+                                    profile_dir=option("cprofile"),
+                                    skim_cache=skim_cache,
+                                    sampling=SO.SamplingOptions(
+                                      option("sample_fraction"),
+                                      option("max_entries")))
+  for entry in entries:
+    batch.add(**PC.get_spec(entry))
+  batch.run()
+
+  print("Done.")
+
+# ------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+  main()